@@ -0,0 +1,107 @@
+"""
+对比每个画面同时比较 2/3/4 个专业时，一个会话需要的画面数、LLM 调用次数、token 总量和等待时间
+
+用真实的专业树和揭示 prompt 模拟学生按随机偏好做完整个会话：
+- 画面数即学生需要做的选择次数；逐画面揭示时每个画面一次 LLM 调用，整轮批量揭示时按 ROUND_BATCH_CHUNK_SIZE 分块
+- 输入 token 按 prompt 实际长度估算，输出 token 按每个专业的描述长度估算
+- 等待时间按“首 token 延迟 + 输出 token / 解码速度”逐画面累加，不实际调用模型
+
+在仓库根目录运行（config 需要从当前目录读取 majors.json）：
+    PYTHONPATH=src/server python -m benchmarks.comparison_size --sessions 500
+"""
+import argparse
+import json
+import math
+import os
+import random
+from statistics import mean
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=500, help="每种配置模拟的会话数")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[2, 3, 4], help="每个画面同时比较的专业数")
+    parser.add_argument("--chars-per-token", type=float, default=1.5, help="中文文本平均每个 token 的字符数")
+    parser.add_argument("--description-chars", type=int, default=300, help="每个专业揭示描述的平均字符数")
+    parser.add_argument("--ttft", type=float, default=0.8, help="首 token 延迟（秒）")
+    parser.add_argument("--decode-tps", type=float, default=40.0, help="解码速度（token/秒）")
+    return parser.parse_args()
+
+def play_round(candidates: list[str], rank: dict[str, int], rng: random.Random, group_size: int):
+    """与 CreateRound 相同的排阵方式走完一轮，返回 (本轮结果, 各画面的专业)"""
+    from pairing import RoundResult, split_into_groups
+
+    groups, byes = split_into_groups(rng.sample(candidates, len(candidates)), group_size)
+    result = RoundResult(winners=[], screens=len(groups))
+    for group in groups:
+        winner = min(group, key=rank.__getitem__)
+        result.winners.append(winner)
+        result.comparisons.extend((winner, loser) for loser in group if loser != winner)
+    result.winners.extend(byes)
+    return result, groups
+
+def play_session(strategy: str, major_tree: dict[str, list[str]], rng: random.Random, group_size: int) -> list[list[list[str]]]:
+    """按随机偏好走完一个会话，返回每一轮各画面的专业"""
+    from pairing import Top3Selection
+
+    majors = list(major_tree) + [major for children in major_tree.values() for major in children]
+    rank = {major: position for position, major in enumerate(rng.sample(majors, len(majors)))}
+    rounds = []
+    if strategy == "top3":
+        selection = Top3Selection(major_tree)
+        while not selection.finished:
+            result, groups = play_round(selection.candidates, rank, rng, group_size)
+            rounds.append(groups)
+            selection.feed(result)
+        return rounds
+
+    candidates = list(major_tree)
+    while len(candidates) > 1:
+        result, groups = play_round(candidates, rank, rng, group_size)
+        rounds.append(groups)
+        candidates = result.winners
+        if len(candidates) == 1:
+            candidates = list(major_tree.get(candidates[0], []))
+    return rounds
+
+def main():
+    args = parse_args()
+    from config import MAJOR_TREE, ROUND_BATCH_CHUNK_SIZE
+    from llm import reveal_messages
+
+    infos = json.dumps({
+        "max_living_expenses_from_parents": "1500",
+        "enough_savings_for_college": "是",
+        "pocket_money_usage": "买书和吃饭",
+        "willing_to_repeat_high_school_for_money": "否",
+        "city_tier": "二线",
+        "parents_in_public_sector": "否",
+        "has_stable_hobby": "是",
+        "self_learning_after_gaokao": "是",
+        "proactive_in_competitions": "否",
+        "likes_reading_extracurricular_books": "是",
+    }, ensure_ascii=False)
+
+    def tokens(chars: float) -> float:
+        return chars / args.chars_per_token
+
+    print("strategy  k  screens  calls(per screen/batched)  input_tokens  output_tokens  wait_s(per screen)")
+    for strategy in ("knockout", "top3"):
+        for group_size in args.sizes:
+            rng = random.Random(group_size)
+            screens, batched_calls, input_tokens, output_tokens, wait = [], [], [], [], []
+            for _ in range(args.sessions):
+                rounds = play_session(strategy, MAJOR_TREE, rng, group_size)
+                groups = [group for round_groups in rounds for group in round_groups]
+                outputs = [tokens(len(group) * args.description_chars) for group in groups]
+                screens.append(len(groups))
+                batched_calls.append(sum(math.ceil(len(round_groups) / ROUND_BATCH_CHUNK_SIZE) for round_groups in rounds))
+                input_tokens.append(sum(tokens(sum(len(message["content"]) for message in reveal_messages(infos, group))) for group in groups))
+                output_tokens.append(sum(outputs))
+                wait.append(sum(args.ttft + output / args.decode_tps for output in outputs))
+            print(f"{strategy:<9} {group_size:<2} {mean(screens):>7.1f}  {mean(screens):>7.1f}/{mean(batched_calls):<17.1f} "
+                  f"{mean(input_tokens):>12.0f}  {mean(output_tokens):>13.0f}  {mean(wait):>18.1f}")
+
+if __name__ == "__main__":
+    # 只用到 prompt 模板，不会真正请求模型
+    os.environ.setdefault("API_KEY", "benchmark")
+    main()
@@ -0,0 +1,139 @@
+"""
+对比专业揭示开启与关闭对冲请求时的延迟分布
+
+在本地启动一个兼容 OpenAI 接口的假模型服务，响应时间服从重尾分布：
+大部分调用耗时在 base-latency 附近，tail-prob 比例的调用再乘上 Pareto 分布的放大倍数。
+先关闭对冲跑一遍（同时积累延迟样本），再开启对冲跑一遍，输出两次的 p50/p90/p99 和额外调用比例。
+对冲阈值下限和每分钟预算默认与线上配置相同（HEDGE_MIN_DELAY、HEDGE_BUDGET_PER_MINUTE），
+用 --min-delay 和 --budget 改动时，输出的第一行会注明实际使用的值
+
+在仓库根目录运行（config 需要从当前目录读取 majors.json）：
+    PYTHONPATH=src/server python -m benchmarks.hedging --requests 400 --concurrency 8
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import re
+import socket
+import sys
+import time
+
+from loguru import logger
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400, help="每种配置发出的揭示请求数")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发的请求数")
+    parser.add_argument("--base-latency", type=float, default=0.1, help="普通调用的中位耗时（秒）")
+    parser.add_argument("--tail-prob", type=float, default=0.05, help="慢调用的比例")
+    parser.add_argument("--tail-alpha", type=float, default=1.5, help="慢调用放大倍数的 Pareto 形状参数，越小尾部越重")
+    parser.add_argument("--tail-scale", type=float, default=10.0, help="慢调用放大倍数的下限")
+    parser.add_argument("--min-delay", type=float, default=None, help="对冲阈值的下限（秒），默认使用 HEDGE_MIN_DELAY")
+    parser.add_argument("--budget", type=int, default=None, help="每分钟的对冲预算，默认使用 HEDGE_BUDGET_PER_MINUTE")
+    return parser.parse_args()
+
+def create_fake_endpoint(args, rng: random.Random):
+    from fastapi import FastAPI, Request
+
+    app = FastAPI()
+    app.state.requests = 0
+
+    def latency() -> float:
+        value = args.base_latency * math.exp(rng.gauss(0, 0.25))
+        if rng.random() < args.tail_prob:
+            value *= args.tail_scale * rng.paretovariate(args.tail_alpha)
+        return min(value, 30.0)
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        app.state.requests += 1
+        body = await request.json()
+        content = body["messages"][-1]["content"]
+        names = re.findall(r"你要揭示的专业：\s*\n(.+)", content)[-1].split(", ")
+        await asyncio.sleep(latency())
+        output = "<Majors>" + "".join(
+            f"<Major><Name>{name}</Name><Description>{name}的揭示</Description></Major>" for name in names
+        ) + "</Majors>"
+        return {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": output}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(content), "completion_tokens": len(output), "total_tokens": len(content) + len(output)},
+        }
+
+    return app
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+async def run_requests(args, majors: list[str], rng: random.Random) -> list[float]:
+    import llm
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def request(index: int):
+        async with semaphore:
+            # 每个请求的专业组合不同，避免被进行中调用的合并影响结果
+            group = [f"{major}#{index}" for major in rng.sample(majors, 2)]
+            start = time.perf_counter()
+            await llm.gen_majors_reveal("{}", group)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[request(i) for i in range(args.requests)])
+    return latencies
+
+async def main(args, port: int):
+    import uvicorn
+    from config import MAJOR_TREE
+    from hedging import reveal_hedger
+
+    rng = random.Random(0)
+    app = create_fake_endpoint(args, rng)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="critical"))
+    serve = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    majors = [major for children in MAJOR_TREE.values() for major in children]
+    print(f"min_delay={reveal_hedger.min_delay}s  budget={reveal_hedger.budget_per_minute}/min  "
+          f"base_latency={args.base_latency}s  tail_prob={args.tail_prob}")
+    print("hedging  requests  endpoint_calls  hedged  extra   p50     p90     p99     max     threshold")
+    try:
+        for enabled in (False, True):
+            reveal_hedger.enabled = enabled
+            calls_before, hedged_before = app.state.requests, reveal_hedger.counters["hedged"]
+            latencies = await run_requests(args, majors, rng)
+            calls = app.state.requests - calls_before
+            hedged = reveal_hedger.counters["hedged"] - hedged_before
+            threshold = reveal_hedger.threshold() or 0.0
+            print(f"{'on ' if enabled else 'off'}      {args.requests:<9} {calls:<15} {hedged:<7} {calls / args.requests - 1:>5.1%}  "
+                  f"{percentile(latencies, 0.5):.3f}s  {percentile(latencies, 0.9):.3f}s  {percentile(latencies, 0.99):.3f}s  "
+                  f"{max(latencies):.3f}s  {threshold:.3f}s")
+    finally:
+        server.should_exit = True
+        await serve
+
+if __name__ == "__main__":
+    args = parse_args()
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    os.environ.update({
+        "BASE_URL": f"http://127.0.0.1:{port}/v1",
+        "API_KEY": "benchmark",
+        "LLM_CACHE_ENABLED": "false",
+        "LLM_MAX_CONCURRENCY": str(max(args.concurrency * 2, 16)),
+    })
+    if args.min_delay is not None:
+        os.environ["HEDGE_MIN_DELAY"] = str(args.min_delay)
+    if args.budget is not None:
+        os.environ["HEDGE_BUDGET_PER_MINUTE"] = str(args.budget)
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    asyncio.run(main(args, port))
@@ -0,0 +1,48 @@
+"""
+比较各配对策略需要的比较次数，并验证 top3 策略选出的前三名与真实偏好一致
+
+单层的 knockout 只决出冠军（n - 1 次），top3 要决出有序的前三名，比它多几次比较；
+top3 应当接近下界，并远少于反复淘汰赛（rerun_knockout）取前三名的次数
+
+在仓库根目录运行（config 需要从当前目录读取 majors.json）：
+    PYTHONPATH=src/server python -m benchmarks.pairing --trials 2000
+"""
+import argparse
+import random
+from statistics import mean
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=2000, help="每个规模随机模拟的次数")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[3, 4, 8, 16, 43, 100], help="候选专业数")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    from config import MAJOR_TREE
+    from pairing import PAIRING_STRATEGIES, simulate_selection, top3_comparisons_lower_bound
+
+    rng = random.Random(0)
+    print("n     knockout  top3(avg/max)  lower_bound  rerun_knockout  top3_correct")
+    for n in args.sizes:
+        majors = [f"major-{i}" for i in range(n)]
+        counts, correct = [], 0
+        for _ in range(args.trials):
+            order = rng.sample(majors, n)
+            rank = {major: position for position, major in enumerate(order)}
+            comparisons, selection = simulate_selection({"category": majors}, rank, rng)
+            counts.append(comparisons)
+            correct += selection.podium == order[:3]
+        # 不用锦标赛树时，反复淘汰赛取前三名需要 (n-1) + (n-2) + (n-3) 次比较
+        rerun = sum(max(n - k, 0) for k in (1, 2, 3))
+        print(f"{n:<5} {n - 1:<9} {mean(counts):>6.2f}/{max(counts):<6} {top3_comparisons_lower_bound(n):<12} "
+              f"{rerun:<15} {correct}/{args.trials}")
+
+    print()
+    knockout = PAIRING_STRATEGIES["knockout"].expected_comparisons(MAJOR_TREE)
+    for strategy in PAIRING_STRATEGIES.values():
+        expected = strategy.expected_comparisons(MAJOR_TREE)
+        print(f"{strategy.name}: 预计每个会话比较 {expected:.2f} 次（{len(MAJOR_TREE)} 个类别），比 knockout 多 {expected - knockout:.2f} 次")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+对比旧的单条 user 消息 prompt（v1）与按静态前缀、会话块、调用后缀分层的 prompt（v2）
+
+离线模式用真实的专业树模拟学生做完整个会话，按调用顺序估算每次调用的输入 token，
+以及其中与之前任意一次调用相同、可被上游前缀缓存复用的部分（按 cache-block 对齐，不足 cache-min 时不缓存）。
+v1 的学生信息紧跟在角色之后，不同学生之间只能复用角色这一小段，每个会话的第一次调用几乎没有缓存；
+v1 由 v2 的各段按原来的顺序拼回，规则中专业数量的措辞沿用 v2，长度与原 prompt 基本一致。
+
+--live 时对 BASE_URL/API_KEY/MODEL 配置的真实上游交替发出两种布局的揭示调用，
+输出两种布局的延迟分布以及 usage 中的 prompt/前缀缓存命中/completion token。
+
+在仓库根目录运行（config 需要从当前目录读取 majors.json）：
+    PYTHONPATH=src/server python -m benchmarks.prompt_layout --students 50
+    PYTHONPATH=src/server python -m benchmarks.prompt_layout --live --calls 20
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import random
+import time
+from statistics import mean
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=50, help="模拟的学生数，每个学生一个会话")
+    parser.add_argument("--group-size", type=int, default=2, help="每个画面同时比较的专业数")
+    parser.add_argument("--chars-per-token", type=float, default=1.5, help="中文文本平均每个 token 的字符数")
+    parser.add_argument("--cache-block", type=int, default=64, help="上游前缀缓存的粒度（token）")
+    parser.add_argument("--cache-min", type=int, default=64, help="上游前缀缓存的最短长度（token）")
+    parser.add_argument("--live", action="store_true", help="对真实上游发出调用，测量延迟和 usage")
+    parser.add_argument("--calls", type=int, default=20, help="--live 时每种布局的调用次数")
+    return parser.parse_args()
+
+def legacy_reveal_messages(infos: str, majors: list[str]) -> list[dict]:
+    """v1 布局：学生信息夹在角色和规则之间，专业和引言在最后，全部放在一条 user 消息里"""
+    from llm import COUNT_WORDS, REVEAL_ROLE, REVEAL_RULES, REVEAL_EXAMPLES, REVEAL_QUOTE, REVEAL_CALL_SUFFIX
+
+    instruction = f"<Instruction>\n以下是这个高中生的部分信息：\n{infos}\n</Instruction>"
+    suffix = REVEAL_CALL_SUFFIX.format(count=COUNT_WORDS.get(len(majors), str(len(majors))), majors=", ".join(majors))
+    content = "\n\n".join([REVEAL_ROLE, instruction, REVEAL_RULES, REVEAL_EXAMPLES, suffix, "---", REVEAL_QUOTE])
+    return [{"role": "user", "content": content}]
+
+def serialize(messages: list[dict]) -> str:
+    return "".join(f"<{message['role']}>\n{message['content']}\n" for message in messages)
+
+def common_prefix(a: str, b: str) -> int:
+    # 二分查找最长的相同前缀，切片比较比逐字符比较快得多
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def random_infos(rng: random.Random) -> str:
+    return json.dumps({
+        "max_living_expenses_from_parents": rng.choice(["800", "1500", "3000"]),
+        "enough_savings_for_college": rng.choice(["是", "否"]),
+        "pocket_money_usage": rng.choice(["买书和吃饭", "游戏充值", "存起来"]),
+        "willing_to_repeat_high_school_for_money": rng.choice(["是", "否"]),
+        "city_tier": rng.choice(["一线", "二线", "三线及以下"]),
+        "parents_in_public_sector": rng.choice(["是", "否"]),
+        "has_stable_hobby": rng.choice(["是", "否"]),
+        "self_learning_after_gaokao": rng.choice(["是", "否"]),
+        "proactive_in_competitions": rng.choice(["是", "否"]),
+        "likes_reading_extracurricular_books": rng.choice(["是", "否"]),
+    }, ensure_ascii=False)
+
+def simulate(args, layout, sessions: list[tuple[str, list[list[str]]]]) -> dict:
+    """按会话顺序估算每次调用的输入 token 和可命中前缀缓存的 token"""
+    def tokens(chars: float) -> float:
+        return chars / args.chars_per_token
+
+    seen: list[str] = []  # 按字典序排好的之前的调用
+    prompt_tokens, cached_tokens = [], []
+    for infos, groups in sessions:
+        for group in groups:
+            text = serialize(layout(infos, group))
+            # 与之前所有调用的最长公共前缀，只可能出现在字典序相邻的两个调用上；上游按块缓存
+            index = bisect.bisect_left(seen, text)
+            prefix = tokens(max((common_prefix(text, previous) for previous in seen[max(index - 1, 0):index + 1]), default=0))
+            cached = prefix // args.cache_block * args.cache_block if prefix >= args.cache_min else 0
+            prompt_tokens.append(tokens(len(text)))
+            cached_tokens.append(cached)
+            seen.insert(index, text)
+    return {
+        "calls": len(prompt_tokens),
+        "avg_prompt": mean(prompt_tokens),
+        "avg_cached": mean(cached_tokens),
+        "hit_ratio": sum(cached_tokens) / sum(prompt_tokens),
+    }
+
+def offline(args):
+    from config import MAJOR_TREE
+    from llm import reveal_messages
+    from benchmarks.comparison_size import play_session
+
+    rng = random.Random(0)
+    sessions = []
+    for _ in range(args.students):
+        infos = random_infos(rng)
+        rounds = play_session("knockout", MAJOR_TREE, rng, args.group_size)
+        sessions.append((infos, [group for round_groups in rounds for group in round_groups]))
+
+    print("layout  calls   avg_prompt_tokens  avg_cached_tokens  cache_hit_ratio  avg_uncached_tokens")
+    for name, layout in (("v1", legacy_reveal_messages), ("v2", reveal_messages)):
+        result = simulate(args, layout, sessions)
+        print(f"{name}      {result['calls']:<7} {result['avg_prompt']:<18.0f} {result['avg_cached']:<18.0f} "
+              f"{result['hit_ratio']:<16.1%} {result['avg_prompt'] - result['avg_cached']:.0f}")
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+async def live(args):
+    from openai import AsyncOpenAI
+    from config import BASE_URL, API_KEY, MODEL, MAJOR_TREE
+    from llm import reveal_messages
+    from prompt_usage import cached_tokens
+
+    client = AsyncOpenAI(base_url=BASE_URL, api_key=API_KEY)
+    rng = random.Random(0)
+    infos = random_infos(rng)
+    majors = [major for children in MAJOR_TREE.values() for major in children]
+    results = {"v1": [], "v2": []}
+    try:
+        # 两种布局交替调用，抵消上游负载随时间的变化；同一个学生的多次调用模拟一个会话
+        for _ in range(args.calls):
+            group = rng.sample(majors, args.group_size)
+            for name, layout in (("v1", legacy_reveal_messages), ("v2", reveal_messages)):
+                start = time.perf_counter()
+                response = await client.chat.completions.create(model=MODEL, messages=layout(infos, group))
+                usage = response.usage
+                results[name].append((time.perf_counter() - start, usage.prompt_tokens, cached_tokens(usage), usage.completion_tokens))
+    finally:
+        await client.close()
+
+    print("layout  calls  p50      p95      avg_prompt_tokens  avg_cached_tokens  avg_completion_tokens")
+    for name, rows in results.items():
+        latencies = [row[0] for row in rows]
+        print(f"{name}      {len(rows):<6} {percentile(latencies, 0.5):.3f}s   {percentile(latencies, 0.95):.3f}s   "
+              f"{mean(row[1] for row in rows):<18.0f} {mean(row[2] for row in rows):<18.0f} {mean(row[3] for row in rows):.0f}")
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.live:
+        asyncio.run(live(args))
+    else:
+        offline(args)
@@ -0,0 +1,69 @@
+"""
+对比组提交写队列开启与关闭时的写入吞吐
+
+在仓库根目录运行（config 需要从当前目录读取 majors.json）：
+    PYTHONPATH=src/server python -m benchmarks.write_queue --clients 200 --writes 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from loguru import logger
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200, help="并发的客户端数")
+    parser.add_argument("--writes", type=int, default=5, help="每个客户端的写操作数")
+    return parser.parse_args()
+
+async def run_clients(clients: int, writes: int) -> tuple[float, int]:
+    from fastapi import HTTPException
+    from database.base import AsyncSessionLocal
+    from database.crud import CreateSession, UpdateSession, create_session, update_session
+    from schemas import BaseInformation
+
+    info = BaseInformation(**{field: "benchmark" for field in BaseInformation.model_fields})
+    errors = 0
+
+    async def client(index: int):
+        nonlocal errors
+        async with AsyncSessionLocal() as db:
+            try:
+                session = await create_session(db, CreateSession(user_id=f"bench-{index}", base_information=info))
+                for round_number in range(2, writes + 1):
+                    await update_session(db, UpdateSession(session_id=session.uuid, current_round_number=round_number))
+            except HTTPException:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(i) for i in range(clients)])
+    return time.perf_counter() - start, errors
+
+async def main():
+    args = parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    from database.base import init_db
+    from database import models  # noqa: F401  注册表结构
+    from database.write_queue import write_queue
+    await init_db()
+
+    total = args.clients * args.writes
+    for enabled in (False, True):
+        if enabled:
+            write_queue.start()
+        elapsed, errors = await run_clients(args.clients, args.writes)
+        stats = write_queue.stats() if enabled else {}
+        await write_queue.stop()
+        print(f"write_queue={'on ' if enabled else 'off'} writes={total} errors={errors} "
+              f"elapsed={elapsed:.2f}s throughput={total / elapsed:.0f} writes/s "
+              f"avg_batch={stats.get('average_batch_size', 1.0):.1f}")
+
+if __name__ == "__main__":
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench_sessions.db")
+    os.environ.setdefault("CACHE_DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench_cache.db")
+    asyncio.run(main())
@@ -1,14 +1,27 @@
 import asyncio
+import random
+import time
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
 from functools import wraps
 from fastapi import HTTPException
 from typing import Callable, Type, Tuple, Optional
 
+import httpx
+import openai
+
+from metrics import retries, retries_suppressed
+from tracing import span
+from deadline import DeadlineExceeded, remaining, within_deadline
+from config import RETRY_BUDGET_RATIO, RETRY_BUDGET_PER_SECOND, RETRY_BUDGET_CAPACITY, RETRY_MAX_DELAY, RETRY_AFTER_MAX
+
 def timeout(seconds: float = 10):
+    """单次操作的超时，同时不超过当前请求剩余的时间预算"""
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
             try:
-                return await asyncio.wait_for(func(*args, **kwargs), timeout=seconds)
+                return await within_deadline(func(*args, **kwargs), timeout=seconds, what=func.__name__)
             except asyncio.TimeoutError:
                 raise HTTPException(
                     status_code=504,
@@ -17,26 +30,170 @@ def timeout(seconds: float = 10):
         return wrapper
     return decorator
 
+def classify_error(e: BaseException) -> Optional[str]:
+    """返回异常的重试原因：throttled / server / timeout / network / other，None 表示重试也不会成功"""
+    if isinstance(e, HTTPException):
+        return None
+    if isinstance(e, (openai.APITimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(e, (openai.APIConnectionError, httpx.TransportError)):
+        return "network"
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code == 429:
+            # 额度用完也返回 429，但等多久都不会恢复
+            return None if getattr(e, "code", None) == "insufficient_quota" else "throttled"
+        if e.status_code >= 500 or e.status_code in (408, 409):
+            return "server"
+        return None
+    # 其余异常（如模型输出无法解析）重新调用一次可能就会成功
+    return "other"
+
+def retry_after(e: BaseException) -> Optional[float]:
+    """从错误响应的 retry-after-ms / retry-after 头中读取服务端要求的等待秒数"""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class RetryBudget:
+    """
+    所有调用方共享的重试令牌桶
+
+    每次重试消耗一个令牌；令牌每秒补充 per_second 个，每次首次调用另外存入 ratio 个，最多 capacity 个。
+    正常时重试不受限制；上游大面积故障时令牌很快耗尽，重试总量被限制在首次调用的 ratio 倍左右，
+    不会让大量请求的重试叠加成重试风暴
+    """
+    def __init__(self, ratio: float, per_second: float, capacity: float):
+        self.ratio = ratio
+        self.per_second = per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self.counters = {
+            "calls": 0,
+            "retries": 0,
+            "recovered": 0,
+            "exhausted": 0,
+            "non_retryable": 0,
+            "suppressed_budget": 0,
+            "suppressed_retry_after": 0,
+            "suppressed_deadline": 0,
+        }
+        self.reasons = {reason: 0 for reason in ("throttled", "server", "timeout", "network", "other")}
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.per_second)
+        self._updated = now
+
+    def deposit(self):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+        self.counters["calls"] += 1
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.tokens < 1:
+            self.counters["suppressed_budget"] += 1
+            return False
+        self.tokens -= 1
+        return True
+
+    def stats(self) -> dict:
+        self._refill()
+        return {
+            **self.counters,
+            "reasons": dict(self.reasons),
+            "tokens": round(self.tokens, 2),
+            "capacity": self.capacity,
+        }
+
+retry_budget = RetryBudget(ratio=RETRY_BUDGET_RATIO, per_second=RETRY_BUDGET_PER_SECOND, capacity=RETRY_BUDGET_CAPACITY)
+
+# 当前处于最内层 retry 的第几次尝试（从 1 开始），LLM 调用明细账据此区分首次调用和重试
+retry_attempt: ContextVar[int] = ContextVar("retry_attempt", default=1)
+
 def retry(
     exceptions: Tuple[Type[Exception], ...] = (Exception,),
     max_retries: int = 3,
     delay: float = 1.0,
     backoff: float = 2.0,
-    logger: Optional[Callable] = None
+    max_delay: float = RETRY_MAX_DELAY,
+    logger: Optional[Callable] = None,
+    budget: Optional[RetryBudget] = None,
 ):
+    """
+    失败时重试，只重试 classify_error 认为可重试的异常
+
+    第 n 次重试前等待 [0, min(max_delay, delay * backoff^n)) 之间的随机时间（full jitter），
+    服务端给出 Retry-After 时至少等待这么久，超过 RETRY_AFTER_MAX 时直接放弃；
+    每次重试从共享的 RetryBudget 中取一个令牌，取不到时不再重试；
+    等待时间超出当前请求剩余的时间预算时直接抛出 DeadlineExceeded
+    """
     def decorator(func):
         @wraps(func)
         async def async_wrapper(*args, **kwargs):
-            current_delay = delay
+            bucket = budget or retry_budget
+            bucket.deposit()
             for attempt in range(max_retries + 1):
                 try:
-                    return await func(*args, **kwargs)
+                    with span(func.__name__, attempt=attempt + 1):
+                        token = retry_attempt.set(attempt + 1)
+                        try:
+                            result = await func(*args, **kwargs)
+                        finally:
+                            retry_attempt.reset(token)
+                except DeadlineExceeded:
+                    raise
                 except exceptions as e:
+                    reason = classify_error(e)
+                    if reason is None:
+                        bucket.counters["non_retryable"] += 1
+                        retries_suppressed.labels(func.__name__, "non_retryable").inc()
+                        raise
                     if attempt == max_retries:
+                        bucket.counters["exhausted"] += 1
+                        retries_suppressed.labels(func.__name__, "exhausted").inc()
                         raise
+                    wait = random.uniform(0, min(max_delay, delay * backoff ** attempt))
+                    hint = retry_after(e)
+                    if hint is not None:
+                        if hint > RETRY_AFTER_MAX:
+                            bucket.counters["suppressed_retry_after"] += 1
+                            retries_suppressed.labels(func.__name__, "retry_after").inc()
+                            raise
+                        wait = max(wait, hint)
+                    left = remaining()
+                    if left is not None and wait >= left:
+                        bucket.counters["suppressed_deadline"] += 1
+                        retries_suppressed.labels(func.__name__, "deadline").inc()
+                        raise DeadlineExceeded(func.__name__) from e
+                    if not bucket.withdraw():
+                        retries_suppressed.labels(func.__name__, "budget").inc()
+                        if logger:
+                            logger(f"Not retrying {func.__name__}: retry budget exhausted, error: {str(e)}")
+                        raise
+                    bucket.counters["retries"] += 1
+                    bucket.reasons[reason] += 1
+                    retries.labels(func.__name__, reason).inc()
                     if logger:
-                        logger(f"Retrying {func.__name__} after {current_delay} seconds (attempt {attempt + 1}/{max_retries}) due to: {str(e)}")
-                    await asyncio.sleep(current_delay)
-                    current_delay *= backoff
+                        logger(f"Retrying {func.__name__} after {wait:.2f} seconds (attempt {attempt + 1}/{max_retries}, {reason}) due to: {str(e)}")
+                    with span("retry_wait", seconds=round(wait, 3), reason=reason):
+                        await asyncio.sleep(wait)
+                else:
+                    if attempt:
+                        bucket.counters["recovered"] += 1
+                    return result
         return async_wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -18,4 +18,139 @@ CASDOOR_APP_NAME: str = os.environ.get("CASDOOR_APP_NAME")
 CASDOOR_ORGANIZATION_NAME: str = os.environ.get("CASDOOR_ORGANIZATION_NAME")
 ALLOW_ORIGINS: list[str] = os.environ.get("ALLOW_ORIGINS", "*").split(",")
 
+# 访问 Casdoor 的 HTTP 连接池
+CASDOOR_HTTP_MAX_CONNECTIONS: int = int(os.environ.get("CASDOOR_HTTP_MAX_CONNECTIONS", 100))
+CASDOOR_HTTP_MAX_KEEPALIVE: int = int(os.environ.get("CASDOOR_HTTP_MAX_KEEPALIVE", 20))
+CASDOOR_HTTP_KEEPALIVE_EXPIRY: float = float(os.environ.get("CASDOOR_HTTP_KEEPALIVE_EXPIRY", 30))  # 秒
+CASDOOR_HTTP_TIMEOUT: float = float(os.environ.get("CASDOOR_HTTP_TIMEOUT", 10))  # 秒，读写超时
+CASDOOR_HTTP_CONNECT_TIMEOUT: float = float(os.environ.get("CASDOOR_HTTP_CONNECT_TIMEOUT", 5))  # 秒
+CASDOOR_HTTP_POOL_TIMEOUT: float = float(os.environ.get("CASDOOR_HTTP_POOL_TIMEOUT", 5))  # 秒，等待空闲连接的超时
+
+# 本地校验 Casdoor 签发的 JWT
+CASDOOR_JWKS_URL: str = os.environ.get("CASDOOR_JWKS_URL") or f"{CASDOOR_ENDPOINT}/.well-known/jwks"
+CASDOOR_CERTIFICATE: str | None = os.environ.get("CASDOOR_CERTIFICATE") or None  # 可选，PEM 格式的签名证书，配置后无需拉取 JWKS
+JWKS_REFRESH_INTERVAL: int = int(os.environ.get("JWKS_REFRESH_INTERVAL", 3600))  # 秒
+USER_CACHE_TTL: int = int(os.environ.get("USER_CACHE_TTL", 300))  # 秒，不会超过 token 自身的过期时间
+USER_CACHE_SIZE: int = int(os.environ.get("USER_CACHE_SIZE", 10000))
+
+# 数据库
+DATABASE_URL: str = os.environ.get("DATABASE_URL") or "sqlite+aiosqlite:///./sessions.db"
+CACHE_DATABASE_URL: str = os.environ.get("CACHE_DATABASE_URL") or "sqlite+aiosqlite:///./llm_cache.db"
+USAGE_DATABASE_URL: str = os.environ.get("USAGE_DATABASE_URL") or "sqlite+aiosqlite:///./llm_usage.db"
+DB_JOURNAL_MODE: str = os.environ.get("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS: str = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT_MS: int = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+DB_MMAP_SIZE: int = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))  # 字节
+DB_CACHE_SIZE: int = int(os.environ.get("DB_CACHE_SIZE", -64 * 1024))  # 负数表示 KiB
+# 会话库的读连接池：save_and_next 的事务在等待 LLM 时仍占着连接，并发的学生数接近 pool_size + max_overflow 时
+# 后来的请求要等 DB_POOL_TIMEOUT；默认与原来的 5 + 10 相同。写入仍由 SQLite 的写锁串行化
+DB_POOL_SIZE: int = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW: int = int(os.environ.get("DB_MAX_OVERFLOW", 10))  # 高峰时超出 pool_size 临时打开的连接数，空闲后关闭
+DB_POOL_TIMEOUT: float = float(os.environ.get("DB_POOL_TIMEOUT", 30))  # 秒
+
+# 单写者组提交队列
+WRITE_QUEUE_ENABLED: bool = os.environ.get("WRITE_QUEUE_ENABLED", "false").lower() == "true"
+WRITE_QUEUE_WINDOW_MS: float = float(os.environ.get("WRITE_QUEUE_WINDOW_MS", 5))  # 等待更多写操作合并的时间窗口
+WRITE_QUEUE_MAX_BATCH: int = int(os.environ.get("WRITE_QUEUE_MAX_BATCH", 64))  # 一个事务最多合并的写操作数
+
+# LLM 结果缓存
+LLM_CACHE_ENABLED: bool = os.environ.get("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_TTL: int = int(os.environ.get("LLM_CACHE_TTL", 30 * 24 * 3600))  # 秒
+LLM_CACHE_MEMORY_SIZE: int = int(os.environ.get("LLM_CACHE_MEMORY_SIZE", 2048))  # 进程内 LRU 条目上限
+LLM_CACHE_DB_SIZE: int = int(os.environ.get("LLM_CACHE_DB_SIZE", 200000))  # SQLite 中的条目上限
+
+# LLM 调用明细账：每次上游调用记一行，在内存中缓冲后由后台任务批量写入 USAGE_DATABASE_URL
+LLM_USAGE_ENABLED: bool = os.environ.get("LLM_USAGE_ENABLED", "true").lower() == "true"
+LLM_USAGE_FLUSH_SECONDS: float = float(os.environ.get("LLM_USAGE_FLUSH_SECONDS", 2))  # 两次批量写入的最长间隔
+LLM_USAGE_BATCH_SIZE: int = int(os.environ.get("LLM_USAGE_BATCH_SIZE", 200))  # 缓冲达到该条数时立即写入
+LLM_USAGE_BUFFER_SIZE: int = int(os.environ.get("LLM_USAGE_BUFFER_SIZE", 10000))  # 缓冲上限，写入跟不上时丢弃新的记录
+LLM_USAGE_RETENTION_DAYS: int = int(os.environ.get("LLM_USAGE_RETENTION_DAYS", 90))  # 启动时删除更早的记录，0 表示永久保留
+# 按会话和按天查询明细账的接口会列出所有用户的会话及其花费，只在内部部署中开启，开启后仍需登录
+LLM_USAGE_ENDPOINTS_ENABLED: bool = os.environ.get("LLM_USAGE_ENDPOINTS_ENABLED", "false").lower() == "true"
+
+# LLM 调用调度
+LLM_MAX_CONCURRENCY: int = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))  # 同时进行的 LLM 调用上限
+LLM_SINGLE_FLIGHT_ENABLED: bool = os.environ.get("LLM_SINGLE_FLIGHT_ENABLED", "true").lower() == "true"  # 合并相同的进行中调用
+LLM_QUEUE_WARN_SECONDS: float = float(os.environ.get("LLM_QUEUE_WARN_SECONDS", 5))  # 排队超过该时间时记录警告
+
+# 多上游路由：JSON 数组，每项包含 name、base_url、api_key、model、models、weight、timeout，缺省的字段取上面的 BASE_URL/API_KEY/MODEL
+# 未配置时只使用 BASE_URL 一个上游
+LLM_ENDPOINTS: list[dict] = json.loads(os.environ.get("LLM_ENDPOINTS") or "[]")
+LLM_EWMA_ALPHA: float = float(os.environ.get("LLM_EWMA_ALPHA", 0.2))  # 延迟和错误率 EWMA 的平滑系数
+LLM_BREAKER_FAILURES: int = int(os.environ.get("LLM_BREAKER_FAILURES", 5))  # 连续失败多少次后熔断
+LLM_BREAKER_COOLDOWN: float = float(os.environ.get("LLM_BREAKER_COOLDOWN", 30))  # 秒，熔断后多久放行探测请求
+LLM_RAMP_SECONDS: float = float(os.environ.get("LLM_RAMP_SECONDS", 60))  # 秒，恢复后逐步恢复到完整权重的时间
+LLM_ENDPOINT_MAX_CONNECTIONS: int = int(os.environ.get("LLM_ENDPOINT_MAX_CONNECTIONS", 32))  # 每个上游的连接池大小
+LLM_ENDPOINT_TIMEOUT: float = float(os.environ.get("LLM_ENDPOINT_TIMEOUT", 300))  # 秒，单次调用超时
+LLM_STREAM_INCLUDE_USAGE: bool = os.environ.get("LLM_STREAM_INCLUDE_USAGE", "true").lower() == "true"  # 流式调用要求上游在最后返回 usage
+
+# 每个 /api 请求的端到端时间预算，数据库操作、LLM 调用和重试等待都不会超过剩余预算，用完时返回 504
+REQUEST_DEADLINE_SECONDS: float = float(os.environ.get("REQUEST_DEADLINE_SECONDS", 90))  # 秒，默认预算，0 表示不限；SSE 接口默认不限
+REQUEST_DEADLINE_MAX_SECONDS: float = float(os.environ.get("REQUEST_DEADLINE_MAX_SECONDS", 300))  # 秒，客户端通过请求头指定预算时的上限
+REQUEST_DEADLINE_HEADER: str = os.environ.get("REQUEST_DEADLINE_HEADER", "X-Request-Timeout")  # 客户端指定预算（秒）的请求头
+
+# /metrics 暴露 Prometheus 文本格式的指标；关闭后中间件和各处的指标都不再记录
+METRICS_ENABLED: bool = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_TOKEN: str = os.environ.get("METRICS_TOKEN", "")  # 抓取时需要带上 Authorization: Bearer <token>，留空时不提供 /metrics
+
+# 请求追踪：每个 /api 请求一棵 span 树，请求结束后做尾部采样
+TRACING_ENABLED: bool = os.environ.get("TRACING_ENABLED", "true").lower() == "true"
+TRACE_SLOW_MS: float = float(os.environ.get("TRACE_SLOW_MS", 1000))  # 毫秒，慢于该值或出错的 trace 全部保留
+TRACE_SAMPLE_RATE: float = float(os.environ.get("TRACE_SAMPLE_RATE", 0.01))  # 其余 trace 随机保留的比例
+TRACE_BUFFER_SIZE: int = int(os.environ.get("TRACE_BUFFER_SIZE", 200))  # 内存中保留的最近 trace 数
+TRACE_EXPORT_PATH: str = os.environ.get("TRACE_EXPORT_PATH", "")  # 保留的 trace 追加写入的 JSON Lines 文件，留空不写文件
+TRACE_MAX_SPANS: int = int(os.environ.get("TRACE_MAX_SPANS", 500))  # 单个 trace 最多记录的 span 数
+# /api/options/traces 返回其他用户请求的会话 ID、路径和错误信息，只在内部部署中开启，开启后仍需登录
+TRACING_ENDPOINTS_ENABLED: bool = os.environ.get("TRACING_ENDPOINTS_ENABLED", "false").lower() == "true"
+
+# common.retry 的退避与全局重试预算
+RETRY_MAX_DELAY: float = float(os.environ.get("RETRY_MAX_DELAY", 20))  # 秒，单次退避等待的上限
+RETRY_AFTER_MAX: float = float(os.environ.get("RETRY_AFTER_MAX", 30))  # 秒，服务端要求等待更久时不再重试
+RETRY_BUDGET_RATIO: float = float(os.environ.get("RETRY_BUDGET_RATIO", 0.2))  # 每次首次调用存入的重试令牌数
+RETRY_BUDGET_PER_SECOND: float = float(os.environ.get("RETRY_BUDGET_PER_SECOND", 1.0))  # 每秒固定补充的重试令牌数，保证低流量时也能重试
+RETRY_BUDGET_CAPACITY: float = float(os.environ.get("RETRY_BUDGET_CAPACITY", 20))  # 令牌桶容量，即可以连续重试的次数
+
+# 按任务分层选择模型：专业揭示用小而快的模型，智者报告用大模型，留空时使用 MODEL
+# 多上游时可在 LLM_ENDPOINTS 的每一项中用 models: {"fast": ..., "large": ...} 覆盖该上游的模型名
+FAST_MODEL: str = os.environ.get("FAST_MODEL") or None
+LARGE_MODEL: str = os.environ.get("LARGE_MODEL") or None
+FAST_MODEL_TIMEOUT: float = float(os.environ.get("FAST_MODEL_TIMEOUT", 15))  # 秒，快模型超时后改用另一层模型，0 表示不限
+LARGE_MODEL_TIMEOUT: float = float(os.environ.get("LARGE_MODEL_TIMEOUT", 120))  # 秒，大模型超时后改用另一层模型，0 表示不限
+MODEL_FALLBACK_MIN_CONFIDENCE: float = float(os.environ.get("MODEL_FALLBACK_MIN_CONFIDENCE", 0.7))  # 解析置信度低于该值时用另一层模型重新生成
+# 每百万 token 的价格，格式为 "输入,输出"，用于统计各层的花费，留空时只统计 token
+FAST_MODEL_PRICE: str = os.environ.get("FAST_MODEL_PRICE", "")
+LARGE_MODEL_PRICE: str = os.environ.get("LARGE_MODEL_PRICE", "")
+
+# 专业揭示的对冲请求
+HEDGE_ENABLED: bool = os.environ.get("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_QUANTILE: float = float(os.environ.get("HEDGE_QUANTILE", 0.9))  # 超过最近调用耗时的该分位数时发出对冲请求
+HEDGE_MIN_DELAY: float = float(os.environ.get("HEDGE_MIN_DELAY", 2.0))  # 秒，对冲阈值的下限
+HEDGE_MIN_SAMPLES: int = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))  # 样本数不足时不对冲
+HEDGE_BUDGET_PER_MINUTE: int = int(os.environ.get("HEDGE_BUDGET_PER_MINUTE", 30))  # 每分钟最多发出的对冲请求数
+
+# 整轮批量生成揭示
+ROUND_BATCH_ENABLED: bool = os.environ.get("ROUND_BATCH_ENABLED", "true").lower() == "true"
+ROUND_BATCH_CHUNK_SIZE: int = int(os.environ.get("ROUND_BATCH_CHUNK_SIZE", 4))  # 每次 LLM 调用揭示的分组数
+
+# 下一对专业揭示的预取
+PREFETCH_ENABLED: bool = os.environ.get("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_MAX_CONCURRENCY: int = int(os.environ.get("PREFETCH_MAX_CONCURRENCY", 32))  # 同时进行的预取上限
+PREFETCH_TTL: int = int(os.environ.get("PREFETCH_TTL", 900))  # 秒，超过该时间未被使用的预取会被丢弃
+
+# 会话列表分页
+SESSIONS_PAGE_SIZE: int = int(os.environ.get("SESSIONS_PAGE_SIZE", 20))
+SESSIONS_PAGE_MAX_SIZE: int = int(os.environ.get("SESSIONS_PAGE_MAX_SIZE", 100))
+
+# 会话详情快照缓存
+SESSION_SNAPSHOT_CACHE_SIZE: int = int(os.environ.get("SESSION_SNAPSHOT_CACHE_SIZE", 1024))  # 进行中的会话
+SESSION_SNAPSHOT_FINISHED_CACHE_SIZE: int = int(os.environ.get("SESSION_SNAPSHOT_FINISHED_CACHE_SIZE", 10000))  # 已结束的会话
+
+# 配对策略：knockout（逐层淘汰赛）或 top3（锦标赛树选出有序前三名），只影响新创建的会话
+PAIRING_STRATEGY: str = os.environ.get("PAIRING_STRATEGY") or "knockout"
+# 每个画面同时比较的专业数，取值 2 到 4；大于 2 时一次 LLM 调用揭示一组专业，轮数和调用次数都更少
+# 前端画面和出场记录的水位线查询都按一组最多 4 个专业设计，上限不随环境变量改变；超出范围的配置在启动时告警
+MAX_COMPARISON_SIZE: int = 4
+COMPARISON_SIZE_CONFIGURED: int = int(os.environ.get("COMPARISON_SIZE") or 2)
+COMPARISON_SIZE: int = min(max(COMPARISON_SIZE_CONFIGURED, 2), MAX_COMPARISON_SIZE)
+
 MAJOR_TREE: dict[str, list[str]] = json.load(open(Path.cwd() / "majors.json"))
\ No newline at end of file
@@ -1,16 +1,91 @@
+import time
+from pathlib import Path
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
+from loguru import logger
+
+from metrics import db_pool_wait
+
+from config import DATABASE_URL, CACHE_DATABASE_URL, USAGE_DATABASE_URL, DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_BUSY_TIMEOUT_MS, \
+    DB_MMAP_SIZE, DB_CACHE_SIZE, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT
+
+SQLITE_PRAGMAS = {
+    "journal_mode": DB_JOURNAL_MODE,
+    "synchronous": DB_SYNCHRONOUS,
+    "busy_timeout": DB_BUSY_TIMEOUT_MS,
+    "mmap_size": DB_MMAP_SIZE,
+    "cache_size": DB_CACHE_SIZE,
+}
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """记录每次取得连接的等待时间，按连接池的 logging_name 区分"""
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait.labels(self.logging_name or "default").observe(time.perf_counter() - start)
+
+def create_sqlite_engine(url: str, pool_size: int = DB_POOL_SIZE, max_overflow: int = 0, begin_statement: str | None = None,
+                         name: str | None = None) -> AsyncEngine:
+    """
+    创建 SQLite 引擎：每个新连接都设置 WAL 等 pragma
+
+    文件数据库默认使用固定大小、不溢出的连接池：WAL 下读连接可以并发，写入仍然只有一个，
+    多开连接只会让更多写事务排队等锁。会话库的请求事务会在等待 LLM 时占着连接，
+    所以它另外允许 DB_MAX_OVERFLOW 个溢出连接；内存数据库只能共用同一个连接。
+
+    指定 begin_statement 时由 SQLAlchemy 显式开启事务（而不是交给 sqlite3 驱动隐式开启），
+    这样 SAVEPOINT 才能正常工作。
 
-DATABASE_URL = "sqlite+aiosqlite:///./sessions.db"
+    name 用作连接池等待时间指标的标签，缺省为数据库文件名。
+    """
+    if make_url(url).database in (None, "", ":memory:"):
+        sqlite_engine = create_async_engine(url, echo=False, poolclass=StaticPool)
+    else:
+        sqlite_engine = create_async_engine(
+            url,
+            echo=False,
+            poolclass=TimedQueuePool,
+            pool_logging_name=name or Path(make_url(url).database).stem,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=DB_POOL_TIMEOUT,
+            connect_args={"timeout": DB_BUSY_TIMEOUT_MS / 1000},
+            )
 
-engine = create_async_engine(
-    DATABASE_URL, 
-    echo=False, 
-    pool_size=5,
-    max_overflow=10,
-    pool_timeout=30,
-    )
+    @event.listens_for(sqlite_engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+        if begin_statement:
+            dbapi_connection.isolation_level = None
+
+    if begin_statement:
+        @event.listens_for(sqlite_engine.sync_engine, "begin")
+        def do_begin(conn):
+            conn.exec_driver_sql(begin_statement)
+
+    return sqlite_engine
+
+async def log_sqlite_pragmas(sqlite_engine: AsyncEngine):
+    """启动时打印实际生效的 pragma，便于确认配置"""
+    async with sqlite_engine.connect() as conn:
+        effective = {}
+        for name in SQLITE_PRAGMAS:
+            effective[name] = (await conn.execute(text(f"PRAGMA {name}"))).scalar()
+    logger.info(f"SQLite {sqlite_engine.url.database} 生效的 pragma: {effective}")
+    if str(effective["journal_mode"]).lower() != DB_JOURNAL_MODE.lower():
+        logger.warning(f"SQLite journal_mode 为 {effective['journal_mode']}，与配置的 {DB_JOURNAL_MODE} 不一致")
+
+engine = create_sqlite_engine(DATABASE_URL, max_overflow=DB_MAX_OVERFLOW)
 
 AsyncSessionLocal = sessionmaker(
     autocommit=False,
@@ -20,11 +95,93 @@ AsyncSessionLocal = sessionmaker(
 )
 
 Base = declarative_base()
+
+# 组提交写队列专用的单连接引擎：BEGIN IMMEDIATE 一开始就拿到写锁，每个写操作在各自的 SAVEPOINT 中执行
+writer_engine = create_sqlite_engine(DATABASE_URL, pool_size=1, begin_statement="BEGIN IMMEDIATE", name="writer")
+
+WriterSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+    bind=writer_engine,
+    class_=AsyncSession,
+)
+
+# LLM 结果缓存使用独立的数据库文件，避免与会话写事务争抢 SQLite 的写锁
+cache_engine = create_sqlite_engine(CACHE_DATABASE_URL)
+
+CacheSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+    bind=cache_engine,
+    class_=AsyncSession,
+)
+
+CacheBase = declarative_base()
+
+# LLM 调用明细账同样使用独立的数据库文件，只有后台任务批量追加写入
+usage_engine = create_sqlite_engine(USAGE_DATABASE_URL, pool_size=2)
+
+UsageSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+    bind=usage_engine,
+    class_=AsyncSession,
+)
+
+UsageBase = declarative_base()
 ### 创建数据库
 
+def add_missing_columns(conn):
+    """create_all 不会修改已有的表，这里为旧数据库补上新增的可空列"""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+
+def add_missing_indexes(conn):
+    """同理，create_all 也不会给已有的表补建索引"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+# 早于该时间戳（2001 年）的 created_at 是之前直接用 rowid 回填的，需要重新回填
+LEGACY_CREATED_AT_BEFORE = 1_000_000_000
+
+async def backfill_session_created_at(conn):
+    """
+    补列前创建的会话没有 created_at，回填为一个真实的时间戳并保留它们原本的插入顺序
+
+    这些会话都早于已有 created_at 的会话，按 rowid 依次排在最早的已知时间（没有时取当前时间）之前，每个相隔一秒
+    """
+    legacy = f"created_at IS NULL OR created_at < {LEGACY_CREATED_AT_BEFORE}"
+    last_rowid = (await conn.execute(text(f"SELECT MAX(rowid) FROM sessions WHERE {legacy}"))).scalar()
+    if last_rowid is None:
+        return
+    earliest = (await conn.execute(text(f"SELECT MIN(created_at) FROM sessions WHERE NOT ({legacy})"))).scalar()
+    base = (earliest if earliest is not None else time.time()) - last_rowid - 1
+    result = await conn.execute(text(f"UPDATE sessions SET created_at = :base + rowid WHERE {legacy}"), {"base": base})
+    logger.info(f"回填了 {result.rowcount} 个旧会话的 created_at")
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+        await conn.run_sync(add_missing_indexes)
+        await backfill_session_created_at(conn)
+    async with cache_engine.begin() as conn:
+        await conn.run_sync(CacheBase.metadata.create_all)
+    async with usage_engine.begin() as conn:
+        await conn.run_sync(UsageBase.metadata.create_all)
+    await log_sqlite_pragmas(engine)
+    await log_sqlite_pragmas(cache_engine)
 
 async def get_db():
     async with AsyncSessionLocal() as db:
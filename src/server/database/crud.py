@@ -1,21 +1,31 @@
-from typing import List, Set, Tuple
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
+from typing import Dict, List, Sequence, Set, Tuple
+from sqlalchemy import select, inspect, tuple_, and_, or_
+from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import SQLAlchemyError
 from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 import uuid
+import random
+import base64
+import json
 
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 
 from loguru import logger
 from database.models import ChoiceAppearance, Session, Round, RoundStatus, SessionStatus
-from schemas import BaseInformation, Report
+from schemas import BaseInformation, ChoiceResponse, Report, RoundResponse, SessionDelta, SessionPage, SessionSummary, SessionWatermark
 from common import timeout
+from metrics import crud_duration, timed
+from database.write_queue import group_commit
+from database.unit_of_work import get_loaded_session, remember_loaded_session
+from snapshots import mark_session_changed
+from pairing import split_into_groups
+from config import COMPARISON_SIZE, MAX_COMPARISON_SIZE
 
 class CreateSession(BaseModel):
     user_id: str
     base_information: BaseInformation
+    pairing_strategy: str | None = None
     
 class UpdateSession(BaseModel):
     session_id: str
@@ -28,6 +38,17 @@ class CreateRound(BaseModel):
     session_id: str
     round_number: int
     current_round_majors: Set[str]
+    schedule: List[List[str]] = []
+    reveals: Dict[str, str] | None = None
+    group_size: int = COMPARISON_SIZE  # 每个画面同时比较的专业数
+    
+    @model_validator(mode="after")
+    def fix_schedule(self) -> "CreateRound":
+        """创建轮次时一次性排好整轮的分组，每组 group_size 个专业，最后只剩一个专业时轮空"""
+        if not self.schedule:
+            majors = random.sample(sorted(self.current_round_majors), len(self.current_round_majors))
+            self.schedule, _ = split_into_groups(majors, self.group_size)
+        return self
     
 class UpdateRound(BaseModel):
     round_id: str
@@ -51,40 +72,65 @@ class CreateReport(BaseModel):
     
 ### CRUD
 
+@timed(crud_duration)
 @timeout()
-async def create_session(db: AsyncSession, session: CreateSession) -> Session:
+@group_commit
+async def create_session(db: AsyncSession, session: CreateSession, transaction=None) -> Session:
     try:
         new_session = Session(
             uuid=str(uuid.uuid4()),  # 手动设置UUID
             user_id=session.user_id, 
             base_information=session.base_information.model_dump_json(),
-            final_major_name=None
+            final_major_name=None,
+            pairing_strategy=session.pairing_strategy
             )
         db.add(new_session)
-        await db.commit()
-        await db.refresh(new_session)
+        
+        # 只有在没有外部事务的情况下才提交
+        if transaction is None:
+            await db.commit()
+            await db.refresh(new_session)
+        else:
+            await db.flush()
         return new_session
     except SQLAlchemyError as e:
-        await db.rollback()
+        # 只有在没有外部事务的情况下才回滚
+        if transaction is None:
+            await db.rollback()
         logger.error(f"数据库错误:{str(e)}")
         raise HTTPException(status_code=500, detail=f"数据库错误: {str(e)}")
     finally:
-        await db.close()
+        # 只有在没有外部事务的情况下才关闭连接
+        if transaction is None:
+            await db.close()
 
+def _attach_loaded(parent, attribute: str, child):
+    """父对象的集合已加载时，把新建的子对象放进集合，使事务内已加载的会话树保持最新"""
+    if attribute not in inspect(parent).unloaded:
+        collection = getattr(parent, attribute)
+        if child not in collection:
+            collection.append(child)
+
+@timed(crud_duration)
 @timeout()
 async def get_session(db: AsyncSession, session_id: str, user_id: str, transaction=None) -> Session:
     try:
-        query = (
-            select(Session).
-            where(Session.uuid == session_id).
-            options(joinedload(Session.rounds).joinedload(Round.appearances))
-            )
-        
-        result = await db.execute(query)
-        session = result.scalar()
+        # 外部事务中复用已加载的会话树，写操作已直接修改过它
+        session = get_loaded_session(db, session_id) if transaction is not None else None
+        if session is None:
+            query = (
+                select(Session).
+                where(Session.uuid == session_id).
+                options(selectinload(Session.rounds).selectinload(Round.appearances))
+                )
+            
+            result = await db.execute(query)
+            session = result.scalar()
         if not session or session.user_id != user_id:
             logger.error(f"未找到指定的会话: {session_id}, user_id: {user_id}")
             raise HTTPException(status_code=404, detail="未找到指定的会话")
+        if transaction is not None:
+            remember_loaded_session(db, session)
         return session
     except SQLAlchemyError as e:
         logger.error(f"数据库错误:{str(e)}")
@@ -96,13 +142,18 @@ async def get_session(db: AsyncSession, session_id: str, user_id: str, transacti
         if transaction is None:
             await db.close()
 
+@timed(crud_duration)
 @timeout()
 async def get_sessions(db: AsyncSession, user_id: str) -> List[str]:
     try:
-        query = select(Session).where(Session.user_id == user_id)
+        # 只查询 uuid 列，不加载 base_information / report 等 JSON 大字段
+        query = (
+            select(Session.uuid).
+            where(Session.user_id == user_id).
+            order_by(Session.created_at, Session.uuid)
+            )
         result = await db.execute(query)
-        sessions = result.scalars().all()
-        session_id = [session.uuid for session in sessions]
+        session_id = list(result.scalars().all())
         
         return session_id
     except SQLAlchemyError as e:
@@ -112,12 +163,151 @@ async def get_sessions(db: AsyncSession, user_id: str) -> List[str]:
     finally:
         await db.close()
         
+@timed(crud_duration)
 @timeout()
-async def update_session(db: AsyncSession, session_update: UpdateSession, transaction=None) -> Session:
+async def get_session_delta(db: AsyncSession, session_id: str, user_id: str, watermark: SessionWatermark) -> SessionDelta:
+    """
+    返回水位线 (round_number, appearance_index) 之后新增或变化的轮次和出场记录，以及新的水位线
+
+    水位线所在的那一组出场记录会重新返回，因为用户做出选择后它们的胜负会被更新，
+    一组最多 MAX_COMPARISON_SIZE 个专业，所以水位线之前的 MAX_COMPARISON_SIZE - 1 条也一并返回；
+    水位线所在轮次的状态也可能变化，所以这一轮的元信息同样返回。
+    每一步的返回内容只和这一步的变化有关，与会话已经进行了多少轮无关
+    """
+    try:
+        query = select(
+            Session.user_id,
+            Session.status,
+            Session.current_round_number,
+            Session.final_major_name,
+            Session.report,
+        ).where(Session.uuid == session_id)
+        session = (await db.execute(query)).first()
+        if not session or session.user_id != user_id:
+            logger.error(f"未找到指定的会话: {session_id}, user_id: {user_id}")
+            raise HTTPException(status_code=404, detail="未找到指定的会话")
+        
+        rounds_query = (
+            select(Round.uuid, Round.round_number, Round.status, Round.current_round_majors).
+            where(Round.session_id == session_id, Round.round_number >= watermark.round_number).
+            order_by(Round.round_number)
+            )
+        rounds = {
+            row.uuid: RoundResponse(
+                round_number=row.round_number,
+                status=row.status,
+                current_round_majors=row.current_round_majors,
+                appearances=[]
+            )
+            for row in (await db.execute(rounds_query)).all()
+        }
+        
+        appearances_query = (
+            select(ChoiceAppearance).
+            join(Round, ChoiceAppearance.round_id == Round.uuid).
+            where(
+                ChoiceAppearance.session_id == session_id,
+                or_(
+                    Round.round_number > watermark.round_number,
+                    and_(Round.round_number == watermark.round_number,
+                         ChoiceAppearance.appearance_index >= watermark.appearance_index - (MAX_COMPARISON_SIZE - 1)),
+                ),
+            ).
+            order_by(Round.round_number, ChoiceAppearance.appearance_index)
+            )
+        new_watermark = watermark
+        for appearance in (await db.execute(appearances_query)).scalars().all():
+            round = rounds.get(appearance.round_id)
+            if round is None:
+                continue
+            round.appearances.append(
+                ChoiceResponse(
+                    major_id=appearance.uuid,
+                    major_name=appearance.major_name,
+                    description=appearance.description,
+                    appearance_index=appearance.appearance_index,
+                    is_winner_in_comparison=appearance.is_winner_in_comparison
+                )
+            )
+            if (round.round_number, appearance.appearance_index) > (new_watermark.round_number, new_watermark.appearance_index):
+                new_watermark = SessionWatermark(round_number=round.round_number, appearance_index=appearance.appearance_index)
+        
+        return SessionDelta(
+            status=session.status,
+            current_round_number=session.current_round_number,
+            final_major_name=session.final_major_name,
+            rounds=list(rounds.values()),
+            report=session.report if session.status == SessionStatus.FINISHED else None,
+            watermark=new_watermark
+        )
+    except SQLAlchemyError as e:
+        await db.rollback()
+        logger.error(f"数据库错误:{str(e)}")
+        raise HTTPException(status_code=500, detail=f"数据库错误: {str(e)}")
+    finally:
+        await db.close()
+
+def encode_session_cursor(created_at: float, session_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at, session_id]).encode()).decode()
+
+def decode_session_cursor(cursor: str) -> Tuple[float, str]:
     try:
-        query = select(Session).where(Session.uuid == session_update.session_id)
+        created_at, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(created_at), str(session_id)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"无效的分页游标: {cursor}") from e
+
+@timed(crud_duration)
+@timeout()
+async def list_session_summaries(db: AsyncSession, user_id: str | None, limit: int, cursor: str | None = None) -> SessionPage:
+    """
+    按创建时间倒序分页列出会话摘要，user_id 为 None 时列出所有用户的会话
+
+    使用 (created_at, uuid) 游标而不是 OFFSET，并且只查询摘要需要的列，
+    翻到多深、用户有多少会话，每页都只是沿索引扫描 limit + 1 行
+    """
+    try:
+        query = select(
+            Session.uuid,
+            Session.status,
+            Session.current_round_number,
+            Session.final_major_name,
+            Session.created_at,
+        )
+        if user_id is not None:
+            query = query.where(Session.user_id == user_id)
+        if cursor:
+            query = query.where(tuple_(Session.created_at, Session.uuid) < decode_session_cursor(cursor))
+        query = query.order_by(Session.created_at.desc(), Session.uuid.desc()).limit(limit + 1)
+        
         result = await db.execute(query)
-        session = result.scalar()
+        rows = result.all()
+        items = [
+            SessionSummary(
+                session_id=row.uuid,
+                status=row.status,
+                current_round_number=row.current_round_number,
+                final_major_name=row.final_major_name,
+                created_at=row.created_at,
+            )
+            for row in rows[:limit]
+        ]
+        next_cursor = encode_session_cursor(rows[limit - 1].created_at, rows[limit - 1].uuid) if len(rows) > limit else None
+        return SessionPage(items=items, next_cursor=next_cursor)
+    except SQLAlchemyError as e:
+        await db.rollback()
+        logger.error(f"数据库错误:{str(e)}")
+        raise HTTPException(status_code=500, detail=f"数据库错误: {str(e)}")
+    finally:
+        await db.close()
+
+@timed(crud_duration)
+@timeout()
+@group_commit
+async def update_session(db: AsyncSession, session_update: UpdateSession, transaction=None) -> Session:
+    try:
+        # db.get 优先从身份映射中取对象，事务内已加载过时不再查询
+        session = await db.get(Session, session_update.session_id)
         if not session:
             raise HTTPException(status_code=404, detail="未找到指定的会话")
         
@@ -127,6 +317,7 @@ async def update_session(db: AsyncSession, session_update: UpdateSession, transa
         if session_update.report:
             session.report = session_update.report.model_dump()
         db.add(session)
+        mark_session_changed(db, session.uuid)
         
         # 只有在没有外部事务的情况下才提交
         if transaction is None:
@@ -144,7 +335,9 @@ async def update_session(db: AsyncSession, session_update: UpdateSession, transa
         if transaction is None:
             await db.close()
 
+@timed(crud_duration)
 @timeout()
+@group_commit
 async def create_round(db: AsyncSession, round: CreateRound, transaction=None) -> Round:
     try:
         current_round_majors_list = list(round.current_round_majors)
@@ -153,14 +346,25 @@ async def create_round(db: AsyncSession, round: CreateRound, transaction=None) -
             uuid=str(uuid.uuid4()),  # 手动设置UUID
             session_id=round.session_id,
             round_number=round.round_number,
-            current_round_majors=current_round_majors_list
+            current_round_majors=current_round_majors_list,
+            schedule=[list(group) for group in round.schedule],
+            reveals=round.reveals,
+            appearances=[]
         )
         db.add(new_round)
+        mark_session_changed(db, round.session_id)
+        if transaction is not None:
+            session = await db.get(Session, round.session_id)
+            if session:
+                _attach_loaded(session, "rounds", new_round)
         
         # 只有在没有外部事务的情况下才提交
         if transaction is None:
             await db.commit()
             await db.refresh(new_round)
+        else:
+            # 写入身份映射，后续 create_choices 通过 db.get 取到它时不必查询
+            await db.flush()
         
         return new_round
     except Exception as e:
@@ -174,17 +378,18 @@ async def create_round(db: AsyncSession, round: CreateRound, transaction=None) -
         if transaction is None:
             await db.close()
 
+@timed(crud_duration)
 @timeout()
+@group_commit
 async def update_round(db: AsyncSession, round_update: UpdateRound, transaction=None) -> Round:
     try:
-        query = select(Round).where(Round.uuid == round_update.round_id)
-        result = await db.execute(query)
-        round = result.scalar()
+        round = await db.get(Round, round_update.round_id)
         if not round:
             raise HTTPException(status_code=404, detail="未找到指定的轮次")
         
         round.status = round_update.status
         db.add(round)
+        mark_session_changed(db, round.session_id)
         
         # 只有在没有外部事务的情况下才提交
         if transaction is None:
@@ -202,14 +407,14 @@ async def update_round(db: AsyncSession, round_update: UpdateRound, transaction=
         if transaction is None:
             await db.close()
 
+@timed(crud_duration)
 @timeout()
-async def create_choices(db: AsyncSession, choices: Tuple[CreateChoice, CreateChoice], user_id: str, transaction=None) -> Tuple[ChoiceAppearance, ChoiceAppearance]:
+@group_commit
+async def create_choices(db: AsyncSession, choices: Sequence[CreateChoice], user_id: str, transaction=None) -> List[ChoiceAppearance]:
     new_choices = []
     try:
         for choice in choices:
-            query = select(Session).where(Session.uuid == choice.session_id)
-            result = await db.execute(query)
-            session = result.scalar()
+            session = await db.get(Session, choice.session_id)
             if not session or session.user_id != user_id:
                 raise HTTPException(status_code=404, detail="未找到指定的会话")
             
@@ -223,6 +428,11 @@ async def create_choices(db: AsyncSession, choices: Tuple[CreateChoice, CreateCh
             )
             new_choices.append(new_choice)
             db.add(new_choice)
+            mark_session_changed(db, choice.session_id)
+            if transaction is not None:
+                round = await db.get(Round, choice.round_id)
+                if round:
+                    _attach_loaded(round, "appearances", new_choice)
         
         # flush to DB if in external transaction so update_choices can find new records
         if transaction is not None:
@@ -232,7 +442,7 @@ async def create_choices(db: AsyncSession, choices: Tuple[CreateChoice, CreateCh
             await db.commit()
             for choice in new_choices:
                 await db.refresh(choice)
-        return new_choices[:2]
+        return new_choices
     except SQLAlchemyError as e:
         # 只有在没有外部事务的情况下才回滚
         if transaction is None:
@@ -244,20 +454,21 @@ async def create_choices(db: AsyncSession, choices: Tuple[CreateChoice, CreateCh
         if transaction is None:
             await db.close()
 
+@timed(crud_duration)
 @timeout()
-async def update_choices(db: AsyncSession, new_choices: Tuple[UpdateChoice, UpdateChoice], transaction=None) -> Tuple[ChoiceAppearance, ChoiceAppearance]:
+@group_commit
+async def update_choices(db: AsyncSession, new_choices: Sequence[UpdateChoice], transaction=None) -> List[ChoiceAppearance]:
     updated_choices = []
     try:
         for new_choice in new_choices:
-            query = select(ChoiceAppearance).where(ChoiceAppearance.uuid == new_choice.uuid)
-            result = await db.execute(query)
-            choice = result.scalar()
+            choice = await db.get(ChoiceAppearance, new_choice.uuid)
             if not choice:
                 raise HTTPException(status_code=404, detail="未找到指定的选择记录")
             
             choice.is_winner_in_comparison = new_choice.is_winner_in_comparison
             updated_choices.append(choice)
             db.add(choice)
+            mark_session_changed(db, choice.session_id)
         
         # 只有在没有外部事务的情况下才提交
         if transaction is None:
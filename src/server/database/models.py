@@ -1,14 +1,15 @@
 import uuid
 import enum
+import time
 from typing import List
 from sqlalchemy import (
     Integer, String, Boolean, Enum as SqlEnum,
-    ForeignKey, Text
+    ForeignKey, Text, Float, Index
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.dialects.sqlite import JSON
 
-from .base import Base
+from .base import Base, CacheBase, UsageBase
 from schemas import BaseInformation, Report
 
 class SessionStatus(str, enum.Enum):
@@ -51,6 +52,8 @@ class Round(Base):
     status: Mapped[RoundStatus] = mapped_column(SqlEnum(RoundStatus, name="round_status_enum"),
                                                 default=RoundStatus.ACTIVE, nullable=False, index=True)
     current_round_majors: Mapped[dict] = mapped_column(JSON, nullable=False)
+    schedule: Mapped[list | None] = mapped_column(JSON, nullable=True, default=None)  # 本轮预排的对阵 [[专业A, 专业B], ...]
+    reveals: Mapped[dict | None] = mapped_column(JSON, nullable=True, default=None)  # 批量生成的揭示 {专业名: 描述}
 
     session: Mapped["Session"] = relationship("Session", back_populates="rounds")
     appearances: Mapped[List["ChoiceAppearance"]] = relationship(
@@ -74,6 +77,15 @@ class Session(Base):
     current_round_number: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
     final_major_name: Mapped[str | None] = mapped_column(String, nullable=True, default=None)
     report: Mapped[Report | None] = mapped_column(JSON, nullable=True, default=None)
+    # 旧数据库补列后由 init_db 按 rowid 回填，排在所有新会话之前
+    created_at: Mapped[float | None] = mapped_column(Float, nullable=True, default=time.time)
+    pairing_strategy: Mapped[str | None] = mapped_column(String, nullable=True, default=None)  # 为空的旧会话按 knockout 处理
+
+    # 会话列表按 (created_at, uuid) 做游标分页：单个用户的列表和跨用户的列表各用一个索引
+    __table_args__ = (
+        Index("ix_sessions_user_id_created_at", "user_id", "created_at", "uuid"),
+        Index("ix_sessions_created_at", "created_at", "uuid"),
+    )
 
     rounds: Mapped[List["Round"]] = relationship(
         "Round",
@@ -84,3 +96,46 @@ class Session(Base):
 
     def __repr__(self):
         return f"<Session(uuid={self.uuid}, user_id={self.user_id}, status={self.status})>"
+
+class LLMCacheEntry(CacheBase):
+    __tablename__ = "llm_cache"
+
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    kind: Mapped[str] = mapped_column(String, nullable=False, index=True)
+    value: Mapped[dict] = mapped_column(JSON, nullable=False)
+    created_at: Mapped[float] = mapped_column(Float, nullable=False)
+    last_accessed_at: Mapped[float] = mapped_column(Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<LLMCacheEntry(key={self.key}, kind={self.kind})>"
+
+class LLMUsageEntry(UsageBase):
+    """一次上游 LLM 调用，session_id 等字段只是标注，不与会话表关联（两者在不同的数据库文件里）"""
+    __tablename__ = "llm_usage"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    created_at: Mapped[float] = mapped_column(Float, nullable=False, index=True)
+    session_id: Mapped[str | None] = mapped_column(String, nullable=True)  # 没有会话的调用（如压测脚本）为空
+    round_number: Mapped[int | None] = mapped_column(Integer, nullable=True)  # 最终报告为空
+    function: Mapped[str] = mapped_column(String, nullable=False)  # majors_reveal / round_reveals / wisdom_report
+    stream: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    hedge: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    tier: Mapped[str] = mapped_column(String, nullable=False)
+    model: Mapped[str | None] = mapped_column(String, nullable=True)
+    endpoint: Mapped[str | None] = mapped_column(String, nullable=True)
+    attempt: Mapped[int] = mapped_column(Integer, nullable=False, default=1)  # common.retry 的第几次尝试
+    prompt_tokens: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    completion_tokens: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    cached_tokens: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    cost: Mapped[float | None] = mapped_column(Float, nullable=True)  # 按调用时该层的价格计算，没有配置价格时为空
+    ttft_ms: Mapped[float | None] = mapped_column(Float, nullable=True)  # 只有流式调用有首 token 延迟
+    latency_ms: Mapped[float] = mapped_column(Float, nullable=False)
+    outcome: Mapped[str] = mapped_column(String, nullable=False)  # ok / repaired / parse_error / upstream_error
+    parse_confidence: Mapped[float | None] = mapped_column(Float, nullable=True)
+
+    __table_args__ = (
+        Index("ix_llm_usage_session_id_round_number", "session_id", "round_number"),
+    )
+
+    def __repr__(self):
+        return f"<LLMUsageEntry(id={self.id}, session_id={self.session_id}, function={self.function}, outcome={self.outcome})>"
@@ -1,6 +1,22 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
 
+from database.models import Session
+from tracing import span
+
+# 事务内已加载的会话树，存放在 AsyncSession.info 中，随请求的数据库会话一起存在
+LOADED_SESSIONS_KEY = "loaded_sessions"
+
+def get_loaded_session(db: AsyncSession, session_id: str) -> Session | None:
+    return db.info.get(LOADED_SESSIONS_KEY, {}).get(session_id)
+
+def remember_loaded_session(db: AsyncSession, session: Session):
+    db.info.setdefault(LOADED_SESSIONS_KEY, {})[session.uuid] = session
+
+def forget_loaded_sessions(db: AsyncSession):
+    """事务结束后对象会过期（或回滚到旧值），已加载的会话树不能再复用"""
+    db.info.pop(LOADED_SESSIONS_KEY, None)
+
 class UnitOfWork:
     """
     工作单元模式实现，用于管理数据库事务
@@ -14,6 +30,9 @@ class UnitOfWork:
     
     如果在with块中发生异常，事务会自动回滚
     否则，事务会自动提交
+    
+    事务内 get_session 只查询一次会话树（会话、轮次、出场记录），之后的 CRUD 写操作
+    直接修改这棵已加载的对象图，后续读取复用它而不再查询数据库；事务结束时清除
     """
     def __init__(self, db: AsyncSession):
         self.db = db
@@ -26,15 +45,18 @@ class UnitOfWork:
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """结束事务，如果有异常则回滚，否则提交"""
+        forget_loaded_sessions(self.db)
         if exc_type:
             logger.warning(f"事务回滚，异常: {exc_type.__name__}: {exc_val}")
             try:
-                await self.transaction.rollback()
+                with span("uow.rollback", error_type=exc_type.__name__):
+                    await self.transaction.rollback()
             except Exception as e:
                 logger.warning(f"回滚事务时发生错误: {str(e)}")
         else:
             try:
-                await self.transaction.commit()
+                with span("uow.commit"):
+                    await self.transaction.commit()
             except Exception as e:
                 logger.warning(f"提交事务时发生错误: {str(e)}")
                 # 如果是ResourceClosedError，我们可以忽略它，因为事务可能已经被提交或回滚
@@ -44,12 +66,15 @@ class UnitOfWork:
     async def commit(self):
         """手动提交事务"""
         if self.transaction:
-            await self.transaction.commit()
+            forget_loaded_sessions(self.db)
+            with span("uow.commit"):
+                await self.transaction.commit()
             self.transaction = None
     
     async def rollback(self):
         """手动回滚事务"""
         if self.transaction:
+            forget_loaded_sessions(self.db)
             await self.transaction.rollback()
             self.transaction = None
     
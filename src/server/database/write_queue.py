@@ -0,0 +1,133 @@
+import asyncio
+import time
+from functools import wraps
+from typing import Any, Awaitable, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from loguru import logger
+
+from config import WRITE_QUEUE_WINDOW_MS, WRITE_QUEUE_MAX_BATCH
+from .base import WriterSessionLocal
+
+# 传给 CRUD 函数的 transaction 占位：表示处于写队列的批量事务中，由写队列负责提交
+GROUP_COMMIT = object()
+
+WriteOperation = Callable[[AsyncSession], Awaitable[Any]]
+
+class WriteQueue:
+    """
+    单写者组提交队列
+
+    各请求的写操作被放入队列，由唯一的写任务取出：在时间窗口内凑够一批后，
+    在同一个事务中依次执行（每个操作一个 SAVEPOINT），一次提交后把各自的结果或异常交还给调用方。
+    单个操作失败只回滚它自己的 SAVEPOINT；提交失败时整批的调用方都会收到异常。
+    """
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue[tuple[WriteOperation, asyncio.Future]] = asyncio.Queue()
+        self._writer: Optional[asyncio.Task] = None
+        self.counters = {
+            "operations": 0,
+            "batches": 0,
+            "failed_operations": 0,
+            "failed_commits": 0,
+            "commit_seconds": 0.0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._writer is not None and not self._writer.done()
+
+    def start(self):
+        if not self.running:
+            self._writer = asyncio.create_task(self._run())
+            logger.info(f"组提交写队列已启动，时间窗口 {self.window * 1000:.1f}ms，批量上限 {self.max_batch}")
+
+    async def stop(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+
+    async def submit(self, operation: WriteOperation) -> Any:
+        """提交一个写操作并等待它所在的批次提交"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((operation, future))
+        return await future
+
+    async def _collect(self) -> list[tuple[WriteOperation, asyncio.Future]]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._execute(batch)
+            except Exception as e:
+                logger.error(f"组提交写队列执行批次失败: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _execute(self, batch: list[tuple[WriteOperation, asyncio.Future]]):
+        results: list[tuple[asyncio.Future, Any]] = []
+        async with WriterSessionLocal() as db:
+            async with db.begin():
+                for operation, future in batch:
+                    if future.cancelled():
+                        continue
+                    try:
+                        async with db.begin_nested():
+                            result = await operation(db)
+                        results.append((future, result))
+                    except Exception as e:
+                        self.counters["failed_operations"] += 1
+                        # 调用方可能在操作执行期间被 @timeout 或请求预算取消，不能让它中断整批事务
+                        if not future.done():
+                            future.set_exception(e)
+                start = time.perf_counter()
+            self.counters["commit_seconds"] += time.perf_counter() - start
+
+        self.counters["batches"] += 1
+        self.counters["operations"] += len(batch)
+        for future, result in results:
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        batches = self.counters["batches"]
+        return {
+            **self.counters,
+            "queue_depth": self._queue.qsize(),
+            "average_batch_size": self.counters["operations"] / batches if batches else 0.0,
+        }
+
+write_queue = WriteQueue(window_ms=WRITE_QUEUE_WINDOW_MS, max_batch=WRITE_QUEUE_MAX_BATCH)
+
+def group_commit(func):
+    """
+    写队列运行时（WRITE_QUEUE_ENABLED 开启后由 main.lifespan 启动），把没有外部事务的 CRUD 写操作交给写队列执行
+
+    被装饰的函数需要接受 transaction 参数；交给写队列时传入 GROUP_COMMIT，
+    函数按“处于外部事务中”的分支执行，不自行提交、回滚或关闭连接。
+    """
+    @wraps(func)
+    async def wrapper(db: AsyncSession, *args, transaction=None, **kwargs):
+        if transaction is not None or not write_queue.running:
+            return await func(db, *args, transaction=transaction, **kwargs)
+        return await write_queue.submit(lambda writer_db: func(writer_db, *args, transaction=GROUP_COMMIT, **kwargs))
+    return wrapper
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Optional, TypeVar
+
+from fastapi import HTTPException
+from loguru import logger
+
+from config import REQUEST_DEADLINE_SECONDS, REQUEST_DEADLINE_MAX_SECONDS, REQUEST_DEADLINE_HEADER
+
+T = TypeVar("T")
+
+# 当前请求的截止时间（time.monotonic()），None 表示不限；后台任务需要自行清除
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+class DeadlineExceeded(HTTPException):
+    """请求的时间预算已经用完，剩下的工作没有人在等，直接返回 504"""
+    def __init__(self, what: str = "请求"):
+        super().__init__(status_code=504, detail=f"{what}超出请求的时间预算")
+        logger.warning(f"{what}超出请求的时间预算，放弃剩余的工作")
+
+def remaining() -> Optional[float]:
+    """距离截止时间还剩多少秒，没有截止时间时为 None"""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def check_deadline(what: str = "请求"):
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(what)
+
+def clip_timeout(timeout: Optional[float], what: str = "请求") -> Optional[float]:
+    """把一次操作自己的超时裁剪到剩余预算以内，预算已用完时抛出 DeadlineExceeded"""
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded(what)
+    return left if timeout is None else min(timeout, left)
+
+async def within_deadline(awaitable: Awaitable[T], timeout: Optional[float] = None, what: str = "请求") -> T:
+    """
+    在 min(timeout, 剩余预算) 内等待 awaitable
+
+    因剩余预算不足而超时时抛出 DeadlineExceeded；因 timeout 本身超时时抛出 asyncio.TimeoutError，
+    调用方可以据此回退或重试
+    """
+    try:
+        limit = clip_timeout(timeout, what)
+    except DeadlineExceeded:
+        # 没有被等待的协程需要关闭，避免 "never awaited" 警告
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise
+    if limit is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout=limit)
+    except asyncio.TimeoutError:
+        left = remaining()
+        if left is not None and left <= 0:
+            raise DeadlineExceeded(what)
+        raise
+
+def _header_budget(scope) -> Optional[float]:
+    name = REQUEST_DEADLINE_HEADER.lower().encode()
+    for key, value in scope.get("headers", []):
+        if key == name:
+            try:
+                budget = float(value.decode())
+            except ValueError:
+                return None
+            return budget if budget > 0 else None
+    return None
+
+class DeadlineMiddleware:
+    """
+    为每个 /api 请求设置截止时间
+
+    预算取请求头 REQUEST_DEADLINE_HEADER（秒，不超过 REQUEST_DEADLINE_MAX_SECONDS），缺省为 REQUEST_DEADLINE_SECONDS。
+    SSE 接口一边生成一边推送，客户端断开时工作随之取消，只在客户端显式给出预算时才设置截止时间
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/"):
+            return await self.app(scope, receive, send)
+
+        budget = _header_budget(scope)
+        if budget is not None:
+            budget = min(budget, REQUEST_DEADLINE_MAX_SECONDS)
+        elif "_stream/" not in scope["path"] and REQUEST_DEADLINE_SECONDS > 0:
+            budget = REQUEST_DEADLINE_SECONDS
+        if budget is None:
+            return await self.app(scope, receive, send)
+
+        token = request_deadline.set(time.monotonic() + budget)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_deadline.reset(token)
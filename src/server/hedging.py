@@ -0,0 +1,116 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from loguru import logger
+
+from config import HEDGE_ENABLED, HEDGE_QUANTILE, HEDGE_MIN_DELAY, HEDGE_MIN_SAMPLES, HEDGE_BUDGET_PER_MINUTE
+from llm_scheduler import llm_scheduler
+
+T = TypeVar("T")
+
+class Hedger:
+    """
+    对冲请求：第一次调用超过自适应阈值仍未返回时，再发出一次同样的调用，先成功的结果胜出，另一个被取消
+
+    - 阈值取最近调用耗时的 quantile 分位数，不低于 min_delay；样本不足 min_samples 时不对冲
+    - 成功的调用按耗时计入样本；被取消的调用按取消时已耗费的时间计入，避免慢调用总被取消导致阈值越来越低
+    - 每分钟最多对冲 budget_per_minute 次，限制额外的调用开销；调度器已经在排队时也不对冲，避免放大拥塞
+    - 某一次调用失败时继续等待另一次，两次都失败才抛出异常，交给外层的 retry 处理
+    """
+    SAMPLES = 200  # 计算阈值时保留的最近样本数
+
+    def __init__(self, enabled: bool, quantile: float, min_delay: float, min_samples: int, budget_per_minute: int):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.budget_per_minute = budget_per_minute
+        self._latencies: deque[float] = deque(maxlen=self.SAMPLES)
+        self._hedged_at: deque[float] = deque()
+        self.counters = {
+            "calls": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "budget_exhausted": 0,
+            "skipped_busy": 0,
+        }
+
+    def threshold(self) -> Optional[float]:
+        """当前的对冲阈值（秒），样本不足时为 None"""
+        if len(self._latencies) < self.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * self.quantile), len(latencies) - 1)
+        return max(latencies[index], self.min_delay)
+
+    def _take_budget(self) -> bool:
+        now = time.monotonic()
+        while self._hedged_at and now - self._hedged_at[0] > 60:
+            self._hedged_at.popleft()
+        if len(self._hedged_at) >= self.budget_per_minute:
+            self.counters["budget_exhausted"] += 1
+            return False
+        self._hedged_at.append(now)
+        return True
+
+    async def _timed(self, attempt: Callable[[bool], Awaitable[T]], hedge: bool) -> T:
+        start = time.monotonic()
+        try:
+            result = await attempt(hedge)
+        except asyncio.CancelledError:
+            self._latencies.append(time.monotonic() - start)
+            raise
+        self._latencies.append(time.monotonic() - start)
+        return result
+
+    async def run(self, attempt: Callable[[bool], Awaitable[T]]) -> T:
+        """执行 attempt(hedge=False)，超过阈值时并发执行 attempt(hedge=True)，返回先成功的结果"""
+        self.counters["calls"] += 1
+        threshold = self.threshold() if self.enabled else None
+        if threshold is None:
+            return await self._timed(attempt, False)
+
+        primary = asyncio.create_task(self._timed(attempt, False))
+        hedge: Optional[asyncio.Task] = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=threshold)
+            if done:
+                return primary.result()
+            if llm_scheduler.saturated():
+                self.counters["skipped_busy"] += 1
+                return await primary
+            if not self._take_budget():
+                return await primary
+
+            self.counters["hedged"] += 1
+            logger.debug(f"[hedge] 调用超过 {threshold:.2f}s 未返回，发出对冲请求")
+            hedge = asyncio.create_task(self._timed(attempt, True))
+            pending = {primary, hedge}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "enabled": self.enabled,
+            "threshold_seconds": self.threshold(),
+            "hedges_last_minute": len(self._hedged_at),
+            "budget_per_minute": self.budget_per_minute,
+        }
+
+reveal_hedger = Hedger(enabled=HEDGE_ENABLED, quantile=HEDGE_QUANTILE, min_delay=HEDGE_MIN_DELAY,
+                       min_samples=HEDGE_MIN_SAMPLES, budget_per_minute=HEDGE_BUDGET_PER_MINUTE)
@@ -0,0 +1,69 @@
+import time
+from typing import Optional
+
+import httpx
+from loguru import logger
+
+from config import CASDOOR_HTTP_MAX_CONNECTIONS, CASDOOR_HTTP_MAX_KEEPALIVE, CASDOOR_HTTP_KEEPALIVE_EXPIRY, \
+    CASDOOR_HTTP_TIMEOUT, CASDOOR_HTTP_CONNECT_TIMEOUT, CASDOOR_HTTP_POOL_TIMEOUT
+
+# 由 main.lifespan 创建和关闭，所有 Casdoor 请求共用这一个连接池
+casdoor_client: Optional[httpx.AsyncClient] = None
+
+http_counters = {
+    "requests": 0,
+    "errors": 0,
+    "in_flight": 0,
+    "total_seconds": 0.0,
+}
+
+async def open_casdoor_client():
+    global casdoor_client
+    casdoor_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=CASDOOR_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=CASDOOR_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=CASDOOR_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            CASDOOR_HTTP_TIMEOUT,
+            connect=CASDOOR_HTTP_CONNECT_TIMEOUT,
+            pool=CASDOOR_HTTP_POOL_TIMEOUT,
+        ),
+    )
+    logger.info(f"Casdoor HTTP 连接池已创建，最大连接数 {CASDOOR_HTTP_MAX_CONNECTIONS}，保活连接数 {CASDOOR_HTTP_MAX_KEEPALIVE}")
+
+async def close_casdoor_client():
+    global casdoor_client
+    if casdoor_client is not None:
+        await casdoor_client.aclose()
+        casdoor_client = None
+
+async def casdoor_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """通过共享连接池请求 Casdoor，并记录请求数、错误数和耗时"""
+    if casdoor_client is None:
+        raise RuntimeError("Casdoor HTTP 客户端尚未初始化")
+    http_counters["requests"] += 1
+    http_counters["in_flight"] += 1
+    start = time.perf_counter()
+    try:
+        response = await casdoor_client.request(method, url, **kwargs)
+        if response.is_error:
+            http_counters["errors"] += 1
+        return response
+    except httpx.HTTPError:
+        http_counters["errors"] += 1
+        raise
+    finally:
+        http_counters["in_flight"] -= 1
+        http_counters["total_seconds"] += time.perf_counter() - start
+
+def pool_stats() -> dict:
+    """连接池使用情况；连接明细依赖 httpcore 的连接池对象，取不到时只返回计数"""
+    stats = dict(http_counters)
+    pool = getattr(getattr(casdoor_client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is not None:
+        stats["connections"] = len(connections)
+        stats["idle_connections"] = sum(1 for connection in connections if connection.is_idle())
+    return stats
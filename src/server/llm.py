@@ -1,35 +1,261 @@
 import xml.etree.ElementTree as ET
+import asyncio
 import re
+import json
+import time
+import hashlib
+import difflib
+import unicodedata
+from collections import OrderedDict
 from pydantic import BaseModel
-from typing import List
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, TypeVar
 
 from loguru import logger
-from openai import AsyncOpenAI
+from sqlalchemy import select, delete, func
+from sqlalchemy.exc import SQLAlchemyError
 
-from config import BASE_URL, API_KEY, MODEL
+from config import LLM_CACHE_ENABLED, LLM_CACHE_TTL, LLM_CACHE_MEMORY_SIZE, LLM_CACHE_DB_SIZE, \
+    ROUND_BATCH_CHUNK_SIZE
 from common import retry
+from llm_scheduler import llm_scheduler, make_request_key
+from llm_router import llm_router
+from hedging import reveal_hedger
+from model_tiers import ModelTier, TASK_TIERS, model_tiers
+from deadline import check_deadline, within_deadline
+from tracing import set_attributes, span
+from metrics import llm_call_duration, llm_tokens, llm_upstream_duration, timed
+from prompt_usage import cached_tokens, prompt_usage
+from usage_ledger import LLMCallRecord, usage_ledger
+from database.base import CacheSessionLocal
+from database.models import LLMCacheEntry
+from schemas import BaseInformation
+
+T = TypeVar("T")
+
+# 修改下面的 prompt 时需要同步修改版本号，使旧的缓存失效；prompt_usage 按版本分开统计 token
+PROMPT_VERSION = "v2"
 
 class MajorsReveal(BaseModel):
-    major_1_description: str
-    major_2_description: str
+    descriptions: List[str]  # 与请求的专业按顺序一一对应
+    parse_confidence: float = 1.0
+    repairs: List[str] = []
 
 class WisdomReport(BaseModel):
     final_three_majors: List[str]
     final_three_majors_report: List[str]
     final_recommendation: str
+    parse_confidence: float = 1.0
+    repairs: List[str] = []
 
-async_client = AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL)
+def _usage_attributes(usage: Any) -> Dict[str, int]:
+    if usage is None:
+        return {}
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens, "cached_tokens": cached_tokens(usage)}
 
-prompt = """<Role>
-你需要面向正在进行志愿填报的高中生，向他们**一针见血**的揭示一个专业背后的**正常收益**和对应的**严重代价**。
-</Role>
+def _record_usage(kind: str, tier: ModelTier, usage: Any, latency: float, stream: bool = False):
+    prompt_usage.record(kind, PROMPT_VERSION, usage, latency, stream=stream)
+    if usage is not None:
+        llm_tokens.labels(tier.value, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+        llm_tokens.labels(tier.value, "cached").inc(cached_tokens(usage))
+        llm_tokens.labels(tier.value, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
 
-<Instruction>
-以下是这个高中生的部分信息：
-{infos}
-</Instruction>
+def _parse_and_record(record: LLMCallRecord, parse: Callable[[str], T], content: str) -> T:
+    """解析上游的输出，连同解析结果把这次调用记入明细账"""
+    try:
+        result = parse(content)
+    except Exception:
+        record.outcome = "parse_error"
+        raise
+    else:
+        record.set_parsed(getattr(result, "parse_confidence", 1.0))
+    finally:
+        usage_ledger.record(record)
+    return result
+
+async def _create_completion(messages: List[Dict[str, str]], tier: ModelTier, kind: str, parse: Callable[[str], T], hedge: bool = False) -> T:
+    """
+    经过 llm_scheduler 用 tier 层模型发出非流式调用并解析输出，相同的进行中调用会被合并；对冲请求不参与合并
+
+    合并到别人的调用上时共用同一个解析结果，明细账里也只记一次，归属发起调用的会话
+    """
+    async def create() -> T:
+        record = LLMCallRecord(function=kind, tier=tier.value, hedge=hedge)
+        route: Dict[str, str] = {}
+        start = time.monotonic()
+        try:
+            with span("llm.upstream", tier=tier.value):
+                response = await llm_router.create(messages, tier=tier.value, route=route)
+                usage = getattr(response, "usage", None)
+                set_attributes(**_usage_attributes(usage))
+        except BaseException as e:
+            record.set_route(route)
+            record.latency_ms = (time.monotonic() - start) * 1000
+            # 对冲输掉或超时回退时调用被取消，同样记录下来
+            record.outcome = "cancelled" if isinstance(e, asyncio.CancelledError) else "upstream_error"
+            usage_ledger.record(record)
+            if isinstance(e, Exception):
+                model_tiers.record_error(tier)
+                llm_upstream_duration.labels(tier.value, "error").observe(time.monotonic() - start)
+            raise
+        latency = time.monotonic() - start
+        model_tiers.record_call(tier, latency, usage)
+        llm_upstream_duration.labels(tier.value, "ok").observe(latency)
+        _record_usage(kind, tier, usage, latency)
+        record.set_route(route)
+        record.set_usage(usage)
+        record.latency_ms = latency * 1000
+        content = response.choices[0].message.content
+        logger.debug(f"[{kind}] Response: {content}")
+        return _parse_and_record(record, parse, content)
+
+    # 排队和调用都计入请求的时间预算；合并到别人的调用上时，llm.upstream 记在发起者的 trace 里
+    with span("llm.completion", tier=tier.value, model=model_tiers.model(tier), single_flight=not hedge):
+        return await within_deadline(llm_scheduler.submit(
+            None if hedge else make_request_key(model_tiers.model(tier), messages),
+            create,
+        ), what="LLM 调用")
+
+class LLMCache:
+    """
+    LLM 结果缓存：进程内 LRU 在前，SQLite 持久化存储在后
+
+    - 读取时先查内存，未命中再查数据库，数据库命中会回填内存
+    - 超过 ttl 的条目视为未命中并删除
+    - 内存和数据库分别按条目数上限淘汰最久未访问的条目
+    - 数据库异常只记录日志，不影响正常的生成流程
+    """
+    TRIM_INTERVAL = 64  # 每写入多少次检查一次数据库条目数
+
+    def __init__(self, memory_size: int, db_size: int, ttl: int):
+        self.memory_size = memory_size
+        self.db_size = db_size
+        self.ttl = ttl
+        self._memory: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._writes = 0
+        self.counters = {
+            "memory_hits": 0,
+            "db_hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "memory_evictions": 0,
+            "db_evictions": 0,
+            "db_errors": 0,
+        }
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl > 0 and now - created_at > self.ttl
+
+    def _remember(self, key: str, created_at: float, value: dict):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+            self.counters["memory_evictions"] += 1
+
+    async def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        cached = self._memory.get(key)
+        if cached is not None:
+            created_at, value = cached
+            if not self._expired(created_at, now):
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return value
+            del self._memory[key]
+
+        try:
+            async with CacheSessionLocal() as db:
+                entry = await db.get(LLMCacheEntry, key)
+                if entry is not None:
+                    if self._expired(entry.created_at, now):
+                        await db.delete(entry)
+                        await db.commit()
+                        self.counters["expired"] += 1
+                    else:
+                        entry.last_accessed_at = now
+                        await db.commit()
+                        self._remember(key, entry.created_at, entry.value)
+                        self.counters["db_hits"] += 1
+                        return entry.value
+        except SQLAlchemyError as e:
+            self.counters["db_errors"] += 1
+            logger.warning(f"读取LLM缓存失败: {e}")
+
+        self.counters["misses"] += 1
+        return None
 
-<Rules>
+    async def set(self, key: str, kind: str, value: dict):
+        now = time.time()
+        self._remember(key, now, value)
+        try:
+            async with CacheSessionLocal() as db:
+                await db.merge(LLMCacheEntry(key=key, kind=kind, value=value, created_at=now, last_accessed_at=now))
+                await db.commit()
+                self._writes += 1
+                if self._writes % self.TRIM_INTERVAL == 0:
+                    await self._trim(db, now)
+        except SQLAlchemyError as e:
+            self.counters["db_errors"] += 1
+            logger.warning(f"写入LLM缓存失败: {e}")
+
+    async def _trim(self, db, now: float):
+        """删除过期条目，并按最久未访问淘汰超出上限的条目"""
+        if self.ttl > 0:
+            result = await db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.created_at < now - self.ttl))
+            self.counters["expired"] += result.rowcount or 0
+        total = (await db.execute(select(func.count()).select_from(LLMCacheEntry))).scalar()
+        overflow = total - self.db_size
+        if overflow > 0:
+            oldest = select(LLMCacheEntry.key).order_by(LLMCacheEntry.last_accessed_at).limit(overflow)
+            result = await db.execute(delete(LLMCacheEntry).where(LLMCacheEntry.key.in_(oldest)))
+            self.counters["db_evictions"] += result.rowcount or 0
+        await db.commit()
+
+    def stats(self) -> dict:
+        hits = self.counters["memory_hits"] + self.counters["db_hits"]
+        lookups = hits + self.counters["misses"]
+        return {
+            **self.counters,
+            "memory_entries": len(self._memory),
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+llm_cache = LLMCache(memory_size=LLM_CACHE_MEMORY_SIZE, db_size=LLM_CACHE_DB_SIZE, ttl=LLM_CACHE_TTL)
+
+def _normalize_text(text: str) -> str:
+    """统一全半角、大小写和空白，去掉末尾标点"""
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("。.!！?？,，;；").strip()
+
+def canonical_profile(infos: str) -> str:
+    """将学生信息规范化，使填写几乎一致的学生得到同一个缓存键"""
+    try:
+        data = json.loads(infos)
+    except (TypeError, ValueError):
+        data = None
+    if isinstance(data, dict):
+        fields = {field: _normalize_text(data.get(field, "")) for field in BaseInformation.model_fields}
+        return json.dumps(fields, ensure_ascii=False, sort_keys=True)
+    return "\n".join(_normalize_text(line) for line in str(infos).splitlines() if line.strip())
+
+def make_cache_key(kind: str, infos: str, majors: List[str]) -> str:
+    model = model_tiers.model(TASK_TIERS[kind])
+    raw = json.dumps([kind, PROMPT_VERSION, model, canonical_profile(infos), majors], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+### Prompt
+#
+# 每次调用的消息分三段，按变化频率从低到高排列，使 OpenAI 兼容接口的前缀缓存尽量多地命中：
+# 1. 静态前缀（system）：角色、规则、示例，所有学生、所有调用都相同
+# 2. 会话块（user 开头）：学生信息，同一个会话内的调用都相同
+# 3. 调用后缀（user 结尾）：本次要揭示的专业或最终的三个专业
+
+REVEAL_ROLE = """<Role>
+你需要面向正在进行志愿填报的高中生，向他们**一针见血**的揭示一个专业背后的**正常收益**和对应的**严重代价**。
+</Role>"""
+
+REVEAL_RULES = """<Rules>
 1. 正常收益需要是一个普通人通过**大量努力**可以获取到的：
 - 不是「设计获奖」而是「中建录用」
 - 不是「报道轰动」而是「报社转正」
@@ -40,13 +266,13 @@ prompt = """<Role>
 - 「1000份命题作文」替代「工作重复性」
 - 「喝水超时扣绩效」替代「职场压迫」
 3. 假设这个高中生在大学四年中，在特性上没有任何改变。
-4. 输出内容参考`FewShots`标签中的，我们会给出两个专业，**以xml格式最终输出两个专业的揭示**，**不要使用```代码块来包裹你的输出**。
-</Rules>
+4. 输出内容参考`FewShots`标签中的，学生信息和要揭示的专业在最后给出，**以xml格式输出每一个专业的揭示**，每个专业一个`<Major>`，`<Name>`必须与给出的专业名完全一致，**不要使用```代码块来包裹你的输出**。
+</Rules>"""
 
-<Examples>
+REVEAL_EXAMPLES = """<Examples>
   <FewShots>（仅供参考，**请勿直接挪用例句中的代价或收益**）：
   ```
-  {{
+  {
       "计算机类": "当获得大厂实习月薪8000时，能否接受体检报告显示颈椎变形+视力骤降300度？",
       "土木工程": "当手握中建X局录用通知时，能否接受未来三年睡工棚、全年无休的生存模式？",
       "师范专业": "当通过教师编考试时，能否接受月薪3800且被家长凌晨三点打电话骂不会教？",
@@ -57,7 +283,7 @@ prompt = """<Role>
       "生物技术": "当进入知名药企质检部时，能否接受每天重复12小时显微镜观测菌落的机械劳动？",
       "环境工程": "当通过环保局事业单位考试时，能否接受每月16次凌晨突击检查排污口的「奉献精神」？",
       "汉语言文学": "当成为中学语文老师时，能否接受批改1000份「双减后我的快乐生活」命题作文？"
-  }}
+  }
   ```
   </FewShots>
 
@@ -73,29 +299,51 @@ prompt = """<Role>
       </Major>
     </Majors>
   </ExampleOutput>
-</Examples>
+</Examples>"""
 
-以下是两个你要揭示的专业：
-{major_a}, {major_b}
+REVEAL_QUOTE = "「平静的表象掩盖了极端事件的可能性，而我们却对此视而不见。」 ——纳西姆·尼古拉斯·塔勒布《黑天鹅》"
 
----
+REVEAL_SYSTEM_PROMPT = "\n\n".join([REVEAL_ROLE, REVEAL_RULES, REVEAL_EXAMPLES, REVEAL_QUOTE])
 
-「平静的表象掩盖了极端事件的可能性，而我们却对此视而不见。」 ——纳西姆·尼古拉斯·塔勒布《黑天鹅》"""
+REVEAL_SESSION_BLOCK = """<Student>
+以下是这个高中生的部分信息：
+{infos}
+</Student>"""
 
-wisdom_report_prompt = """<Role>
-你是一位深邃的智者，如同黑客帝国中的先知，你能洞察人的命运和本质。现在你将为一位正在进行高考志愿填报的学生提供一份"智者的预言"风格的报告。
-</Role>
+REVEAL_CALL_SUFFIX = """以下是{count}个你要揭示的专业：
+{majors}"""
 
-<Instruction>
-以下是该学生的基本信息：
-{infos}
+# 整轮批量揭示与单组揭示共用静态前缀和会话块，只有调用后缀不同
+BATCH_REVEAL_CALL_SUFFIX = """以下是你要揭示的专业：
+{majors}"""
+
+COUNT_WORDS = {2: "两", 3: "三", 4: "四"}
 
-以下是该学生在专业选择过程中，最终保留下的三个专业（按照学生偏好排序，从最喜爱到最厌恶）：
-{final_majors}
+def _layered_messages(system: str, session_block: str, call_suffix: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": f"{session_block}\n\n{call_suffix}"},
+    ]
 
-</Instruction>
+def reveal_messages(infos: str, majors: List[str]) -> List[Dict[str, str]]:
+    return _layered_messages(
+        REVEAL_SYSTEM_PROMPT,
+        REVEAL_SESSION_BLOCK.format(infos=infos),
+        REVEAL_CALL_SUFFIX.format(count=COUNT_WORDS.get(len(majors), str(len(majors))), majors=", ".join(majors)),
+    )
 
-<Tasks>
+def batch_reveal_messages(infos: str, majors: List[str]) -> List[Dict[str, str]]:
+    return _layered_messages(
+        REVEAL_SYSTEM_PROMPT,
+        REVEAL_SESSION_BLOCK.format(infos=infos),
+        BATCH_REVEAL_CALL_SUFFIX.format(majors=", ".join(majors)),
+    )
+
+REPORT_ROLE = """<Role>
+你是一位深邃的智者，如同黑客帝国中的先知，你能洞察人的命运和本质。现在你将为一位正在进行高考志愿填报的学生提供一份"智者的预言"风格的报告。
+</Role>"""
+
+REPORT_BODY = """<Tasks>
 你的任务是创建一份智者预言报告，包含三个部分：
 
 1. **命运的路标**：分析这三个专业如何反映了学生内心真正的追求和价值观。用哲理性的语言揭示每个专业的本质和它们反映的人生选择。每个专业的分析以"当你选择了[专业名]..."开头。
@@ -147,109 +395,602 @@ wisdom_report_prompt = """<Role>
 </Report>
 </Examples>"""
 
+REPORT_SYSTEM_PROMPT = "\n\n".join([REPORT_ROLE, REPORT_BODY])
+
+REPORT_SESSION_BLOCK = """<Student>
+以下是该学生的基本信息：
+{infos}
+</Student>"""
+
+REPORT_CALL_SUFFIX = """以下是该学生在专业选择过程中，最终保留下的三个专业（按照学生偏好排序，从最喜爱到最厌恶）：
+{final_majors}"""
+
+def wisdom_report_messages(infos: str, final_majors: List[str]) -> List[Dict[str, str]]:
+    majors_str = ", ".join([f"{i+1}. {major}" for i, major in enumerate(final_majors)])
+    return _layered_messages(
+        REPORT_SYSTEM_PROMPT,
+        REPORT_SESSION_BLOCK.format(infos=infos),
+        REPORT_CALL_SUFFIX.format(final_majors=majors_str),
+    )
+
+def prompt_layout() -> Dict[str, Any]:
+    """当前 prompt 版本和各任务可被上游前缀缓存复用的静态前缀长度（字符数）"""
+    return {
+        "prompt_version": PROMPT_VERSION,
+        "static_prefix_chars": {
+            "majors_reveal": len(REVEAL_SYSTEM_PROMPT),
+            "round_reveals": len(REVEAL_SYSTEM_PROMPT),
+            "wisdom_report": len(REPORT_SYSTEM_PROMPT),
+        },
+    }
+
+@timed(llm_call_duration)
+async def gen_majors_reveal(infos: str, majors: List[str]) -> MajorsReveal:
+    """一次调用生成一组专业（2 到 4 个）的揭示，同一画像下的同一组专业（不分先后）会命中缓存"""
+    if not LLM_CACHE_ENABLED:
+        return await _gen_majors_reveal(infos, majors)
+
+    cached = await _get_cached_majors_reveal(infos, majors)
+    if cached:
+        return cached
+
+    majors_reveal = await _gen_majors_reveal(infos, majors)
+    await _set_cached_majors_reveal(infos, majors, majors_reveal)
+    return majors_reveal
+
+async def _get_cached_majors_reveal(infos: str, majors: List[str]) -> Optional[MajorsReveal]:
+    key = make_cache_key("majors_reveal", infos, sorted(majors))
+    cached = await llm_cache.get(key)
+    if cached and all(major in cached for major in majors):
+        logger.debug(f"Majors reveal cache hit for {majors}")
+        return MajorsReveal(descriptions=[cached[major] for major in majors])
+    return None
+
+async def _set_cached_majors_reveal(infos: str, majors: List[str], majors_reveal: MajorsReveal):
+    key = make_cache_key("majors_reveal", infos, sorted(majors))
+    await llm_cache.set(key, "majors_reveal", dict(zip(majors, majors_reveal.descriptions)))
+
 @retry(logger=logger.error)
-async def gen_majors_reveal(infos: str, major_a: str, major_b: str) -> MajorsReveal:
-    logger.debug(f"Generating majors reveal for {major_a} and {major_b}")
+async def _gen_majors_reveal(infos: str, majors: List[str]) -> MajorsReveal:
+    logger.debug(f"Generating majors reveal for {majors}")
+    messages = reveal_messages(infos, majors)
+
+    async def call(tier: ModelTier, hedge: bool = False) -> MajorsReveal:
+        # 解析成功才算这次调用完成，对冲时先解析成功的一方胜出
+        return await _create_completion(messages, tier, "majors_reveal", lambda content: parse_majors_reveal(content, majors), hedge=hedge)
+
+    async def attempt(tier: ModelTier, fallback: bool) -> MajorsReveal:
+        # 对冲阈值按快模型的延迟计算，回退到另一层模型时不对冲
+        if fallback:
+            return await call(tier)
+        return await reveal_hedger.run(lambda hedge: call(tier, hedge))
+
     try: 
-        response = await async_client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "user", "content": prompt.format(infos=infos, major_a=major_a, major_b=major_b)}
-            ],
-            stream=False
-        )
-        logger.debug(f"Response: {response}")
-        xml_content = await extract_outer_xml(response.choices[0].message.content)
-        
-        # 解析XML
-        root = ET.fromstring(xml_content)
-        majors = root.findall("Major")
-        
-        # 确保返回了两个专业
-        if len(majors) != 2:
-            raise ValueError(f"Expected 2 majors in XML, but got {len(majors)}")
-        
-        # 提取描述
-        major_1_desc = None
-        major_2_desc = None
-        for major in majors:
-            name = major.find("Name").text
-            desc = major.find("Description").text
-            if name == major_a:
-                major_1_desc = desc
-            elif name == major_b:
-                major_2_desc = desc
-        
-        if not major_1_desc or not major_2_desc:
-            raise ValueError("Failed to match both majors in XML output")
-        
-        majors_reveal = MajorsReveal(
-            major_1_description=major_1_desc,
-            major_2_description=major_2_desc
-        )
-        
-        return majors_reveal
+        return await model_tiers.run("majors_reveal", attempt)
     except Exception as e:
         logger.error(f"Error: {e}")
         raise e
 
-@retry(logger=logger.error)
+@timed(llm_call_duration)
+async def gen_round_reveals(infos: str, groups: List[List[str]]) -> Dict[str, str]:
+    """
+    为一整轮预排好的分组批量生成揭示，返回 {专业名: 描述}
+
+    已缓存的分组直接复用；其余分组按 ROUND_BATCH_CHUNK_SIZE 分块并发生成，每块一次 LLM 调用。
+    某一块失败时只记录日志，缺失的专业由调用方在出场时单独生成。
+    """
+    reveals: Dict[str, str] = {}
+    uncached: List[List[str]] = []
+    for group in groups:
+        cached = await _get_cached_majors_reveal(infos, group) if LLM_CACHE_ENABLED else None
+        if cached:
+            reveals.update(zip(group, cached.descriptions))
+        else:
+            uncached.append(group)
+
+    chunks = [uncached[i:i + ROUND_BATCH_CHUNK_SIZE] for i in range(0, len(uncached), ROUND_BATCH_CHUNK_SIZE)]
+    logger.debug(f"Generating round reveals for {len(groups)} groups, {len(uncached)} uncached, {len(chunks)} calls")
+    results = await asyncio.gather(*[_gen_batch_reveals(infos, chunk) for chunk in chunks], return_exceptions=True)
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            logger.error(f"批量生成揭示失败，涉及分组: {chunk}, 错误: {result}")
+            continue
+        for group in chunk:
+            if all(major in result for major in group):
+                descriptions = [result[major] for major in group]
+                reveals.update(zip(group, descriptions))
+                if LLM_CACHE_ENABLED:
+                    await _set_cached_majors_reveal(infos, group, MajorsReveal(descriptions=descriptions))
+    return reveals
+
+@retry(logger=logger.error, max_retries=1)
+async def _gen_batch_reveals(infos: str, groups: List[List[str]]) -> Dict[str, str]:
+    majors = [major for group in groups for major in group]
+    messages = batch_reveal_messages(infos, majors)
+
+    def parse(content: str) -> Dict[str, str]:
+        reveals = parse_batch_reveals(content, majors)
+        if not reveals:
+            raise ValueError(f"No requested majors found in batch XML output: {majors}")
+        return reveals
+
+    async def attempt(tier: ModelTier, fallback: bool) -> Dict[str, str]:
+        return await _create_completion(messages, tier, "round_reveals", parse)
+
+    # 批量结果没有整体的解析置信度，只在超时时回退
+    return await model_tiers.run("round_reveals", attempt, confidence=lambda reveals: 1.0)
+
+@timed(llm_call_duration)
 async def gen_wisdom_report(infos: str, final_majors: List[str]) -> WisdomReport:
+    """生成智者预言风格的报告，同一画像下相同顺序的三个专业会命中缓存"""
+    if not LLM_CACHE_ENABLED:
+        return await _gen_wisdom_report(infos, final_majors)
+
+    key = make_cache_key("wisdom_report", infos, list(final_majors))
+    cached = await llm_cache.get(key)
+    if cached:
+        logger.debug(f"Wisdom report cache hit for {final_majors}")
+        return WisdomReport(**cached)
+
+    report = await _gen_wisdom_report(infos, final_majors)
+    await llm_cache.set(key, "wisdom_report", report.model_dump())
+    return report
+
+@retry(logger=logger.error)
+async def _gen_wisdom_report(infos: str, final_majors: List[str]) -> WisdomReport:
     """生成智者预言风格的报告，包含三个专业的深度分析和最终推荐。"""
     logger.debug(f"Generating wisdom report for final majors: {final_majors}")
     try:
         if len(final_majors) != 3:
             raise ValueError(f"Expected 3 final majors, but got {len(final_majors)}")
         
-        majors_str = ", ".join([f"{i+1}. {major}" for i, major in enumerate(final_majors)])
-        
-        response = await async_client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "user", "content": wisdom_report_prompt.format(infos=infos, final_majors=majors_str)}
-            ],
-            stream=False
-        )
-        
-        logger.debug(f"Response received for wisdom report: {response.choices[0].message.content}")
-        xml_content = await extract_outer_xml(response.choices[0].message.content)
-        logger.debug(f"XML content: {xml_content}")
-        
-        # 解析XML
-        root = ET.fromstring(xml_content)
-        
-        # 提取 FinalThreeMajors
-        final_three_majors_text = root.find("FinalThreeMajors").text.strip()
-        final_three_majors = [major.strip() for major in final_three_majors_text.split(",")]
-        
-        # 提取 ThreeMajorsReport 中的 Description
-        report_majors = root.find("ThreeMajorsReport").findall("Major")
-        if len(report_majors) != 3:
-            raise ValueError(f"Expected 3 majors in ThreeMajorsReport, but got {len(report_majors)}")
-        
-        final_three_majors_report = [major.find("Description").text for major in report_majors]
-        
-        # 提取 FinalRecommendation
-        final_recommendation = root.find("FinalRecommendation").text
-        
-        report = WisdomReport(
-            final_three_majors=final_three_majors,
-            final_three_majors_report=final_three_majors_report,
-            final_recommendation=final_recommendation
-        )
-        
-        return report
+        messages = wisdom_report_messages(infos, final_majors)
+
+        async def attempt(tier: ModelTier, fallback: bool) -> WisdomReport:
+            return await _create_completion(messages, tier, "wisdom_report", lambda content: parse_wisdom_report(content, final_majors))
+
+        return await model_tiers.run("wisdom_report", attempt)
     except Exception as e:
         logger.error(f"Error generating wisdom report: {e}")
         raise e
 
-async def extract_outer_xml(text: str) -> str:
-    """提取最外层的XML内容，移除可能的代码块标记"""
-    # 移除可能的```标记
-    xml_pattern = re.compile(r'^```\s*xml\s*\n?(.*)\n?\s*```$', re.DOTALL)
-    match = xml_pattern.match(text.strip())
-    if match:
-        return match.group(1).strip()
+### 容错解析
+
+XML_TAGS = ("Majors", "Major", "Name", "Description", "Report", "FinalThreeMajors", "ThreeMajorsReport", "FinalRecommendation")
+XML_TAG_PATTERN = re.compile(r"<(/?)(" + "|".join(XML_TAGS) + r")\b[^>]*>")
+NAME_MATCH_THRESHOLD = 0.6
+
+# 每种修复对解析置信度的扣分
+REPAIR_PENALTIES = {
+    "stripped_code_fence": 0.0,
+    "stripped_prose": 0.05,
+    "escaped_text": 0.1,
+    "balanced_tags": 0.2,
+    "regex_extraction": 0.4,
+    "fuzzy_name": 0.1,
+    "positional_name": 0.3,
+    "names_from_report": 0.1,
+    "truncated_report": 0.2,
+}
+
+class XMLSalvageError(ValueError):
+    """模型输出中没有任何可以挽救的内容，只能重新调用模型"""
+
+def parse_confidence(repairs: List[str]) -> float:
+    return round(max(0.0, 1.0 - sum(REPAIR_PENALTIES.get(repair, 0.1) for repair in repairs)), 2)
+
+def _balance_tags(fragment: str) -> str:
+    """补全未闭合的标签，丢弃多余的闭合标签"""
+    parts = []
+    stack: List[str] = []
+    last = 0
+    for match in XML_TAG_PATTERN.finditer(fragment):
+        parts.append(fragment[last:match.start()])
+        last = match.end()
+        closing, tag = match.group(1), match.group(2)
+        if not closing:
+            # <Name>/<Description> 不能嵌套，上一个没闭合就开始下一个时先闭合
+            while stack and stack[-1] in ("Name", "Description") and tag in ("Name", "Description", "Major"):
+                parts.append(f"</{stack.pop()}>")
+            if tag == "Major" and stack and stack[-1] == "Major":
+                parts.append(f"</{stack.pop()}>")
+            stack.append(tag)
+            parts.append(f"<{tag}>")
+        elif tag in stack:
+            while stack[-1] != tag:
+                parts.append(f"</{stack.pop()}>")
+            parts.append(f"</{stack.pop()}>")
+    parts.append(fragment[last:])
+    while stack:
+        parts.append(f"</{stack.pop()}>")
+    return "".join(parts)
+
+def _escape_text(fragment: str) -> str:
+    """转义正文中未转义的 & 和不属于已知标签的 <"""
+    fragment = re.sub(r"&(?!(?:amp|lt|gt|quot|apos|#\d+|#x[0-9a-fA-F]+);)", "&amp;", fragment)
+    return re.sub(r"<(?!/?(?:" + "|".join(XML_TAGS) + r")\b)", "&lt;", fragment)
+
+def _extract_by_regex(fragment: str, root_tag: str) -> ET.Element:
+    """XML 彻底无法解析时，直接用正则抽取各个标签的内容重建元素树"""
+    root = ET.Element(root_tag)
+    def text_of(tag: str, source: str) -> Optional[str]:
+        match = re.search(rf"<{tag}\b[^>]*>(.*?)(?:</{tag}>|(?=<(?:/|{'|'.join(XML_TAGS)}))|$)", source, re.DOTALL)
+        return match.group(1).strip() if match else None
+    for block in re.split(r"<Major\b[^>]*>", fragment)[1:]:
+        name, description = text_of("Name", block), text_of("Description", block)
+        if description:
+            major = ET.SubElement(root, "Major")
+            ET.SubElement(major, "Name").text = name or ""
+            ET.SubElement(major, "Description").text = description
+    if root_tag == "Report":
+        report = ET.Element("ThreeMajorsReport")
+        report.extend(list(root))
+        root = ET.Element(root_tag)
+        for tag in ("FinalThreeMajors", "FinalRecommendation"):
+            value = text_of(tag, fragment)
+            if value is not None:
+                ET.SubElement(root, tag).text = value
+        root.append(report)
+    return root
+
+def salvage_xml(text: str, root_tag: str) -> tuple[ET.Element, List[str]]:
+    """
+    在模型输出的任意位置找到最外层的 <root_tag> 并尽力解析，返回 (根元素, 应用过的修复)
+
+    依次尝试：直接解析 -> 转义正文 -> 补全标签 -> 正则抽取；连根标签都找不到时抛出 XMLSalvageError。
+    """
+    repairs: List[str] = []
+    start_match = re.search(rf"<{root_tag}\b[^>]*>", text)
+    if start_match is None:
+        if "<Major" not in text:
+            raise XMLSalvageError(f"No <{root_tag}> element found in model output")
+        # 只缺根标签时，从第一个 <Major> 开始补一个根标签
+        start_match = re.search(r"<Major\b", text)
+        text = text[:start_match.start()] + f"<{root_tag}>" + text[start_match.start():]
+        start_match = re.search(rf"<{root_tag}\b[^>]*>", text)
+        repairs.append("balanced_tags")
+    end = text.rfind(f"</{root_tag}>")
+    fragment = text[start_match.start():end + len(root_tag) + 3] if end > start_match.start() else text[start_match.start():]
+    outside = (text[:start_match.start()] + (text[end + len(root_tag) + 3:] if end > start_match.start() else "")).strip()
+    if outside:
+        repairs.append("stripped_code_fence" if not outside.replace("`", "").replace("xml", "").strip() else "stripped_prose")
+
+    attempts = [
+        ([], lambda f: f),
+        (["balanced_tags"], _balance_tags),
+        (["escaped_text"], _escape_text),
+        (["escaped_text", "balanced_tags"], lambda f: _balance_tags(_escape_text(f))),
+    ]
+    for attempt_repairs, repair in attempts:
+        try:
+            root = ET.fromstring(repair(fragment))
+            return root, repairs + [r for r in attempt_repairs if r not in repairs]
+        except ET.ParseError:
+            continue
+
+    root = _extract_by_regex(fragment, root_tag)
+    if not root.findall(".//Major"):
+        raise XMLSalvageError(f"Unable to salvage any <Major> from <{root_tag}> output")
+    return root, repairs + ["regex_extraction"]
+
+def _name_similarity(name: str, candidate: str) -> float:
+    name, candidate = _normalize_text(name), _normalize_text(candidate)
+    if not name or not candidate:
+        return 0.0
+    if name == candidate:
+        return 1.0
+    if name in candidate or candidate in name:
+        return 0.9
+    return difflib.SequenceMatcher(None, name, candidate).ratio()
+
+def match_majors(parsed: List[tuple[str, str]], requested: List[str]) -> tuple[Dict[str, str], List[str]]:
+    """
+    把解析出的 (名称, 描述) 对应到请求的专业上，返回 ({请求的专业名: 描述}, 应用过的修复)
+
+    先精确匹配，再按相似度模糊匹配；数量一致但仍有专业没对上时，
+    剩下的专业按出现顺序对应到没有用上的条目，已经匹配上的保持不变。
+    """
+    matched: Dict[str, str] = {}
+    repairs: List[str] = []
+    leftovers: List[tuple[str, str]] = []
+    for name, description in parsed:
+        if name in requested and name not in matched:
+            matched[name] = description
+        else:
+            leftovers.append((name, description))
+
+    unused: List[tuple[str, str]] = []
+    for name, description in leftovers:
+        candidates = [major for major in requested if major not in matched]
+        if not candidates:
+            break
+        best = max(candidates, key=lambda major: _name_similarity(name, major))
+        if _name_similarity(name, best) >= NAME_MATCH_THRESHOLD:
+            matched[best] = description
+            repairs.append("fuzzy_name")
+            logger.info(f"专业名模糊匹配: {name!r} -> {best!r}")
+        else:
+            unused.append((name, description))
+
+    if len(matched) < len(requested) and len(parsed) == len(requested):
+        missing = [major for major in requested if major not in matched]
+        logger.info(f"专业名无法匹配，按出现顺序对应: {[name for name, _ in unused]} -> {missing}")
+        for major, (_, description) in zip(missing, unused):
+            matched[major] = description
+        repairs.append("positional_name")
+    return matched, repairs
+
+def _log_repairs(kind: str, repairs: List[str]):
+    if parse_confidence(repairs) < 1.0:
+        logger.warning(f"{kind} 输出经过修复后解析: {repairs}, 置信度 {parse_confidence(repairs):.2f}")
+
+def parse_majors_reveal(content: str, majors: List[str]) -> MajorsReveal:
+    """将模型输出的 XML 解析为 MajorsReveal，尽量修复而不是重新调用模型"""
+    root, repairs = salvage_xml(content, "Majors")
+    parsed = [((major.findtext("Name") or "").strip(), (major.findtext("Description") or "").strip())
+              for major in root.findall("Major")]
+    parsed = [(name, description) for name, description in parsed if description]
+    
+    matched, match_repairs = match_majors(parsed, majors)
+    repairs += match_repairs
+    if any(major not in matched for major in majors):
+        raise XMLSalvageError(f"Failed to match all majors {majors} in XML output: {[name for name, _ in parsed]}")
+    
+    _log_repairs("专业揭示", repairs)
+    return MajorsReveal(
+        descriptions=[matched[major] for major in majors],
+        parse_confidence=parse_confidence(repairs),
+        repairs=repairs
+    )
+
+def parse_batch_reveals(content: str, majors: List[str]) -> Dict[str, str]:
+    """解析整轮批量揭示，只返回能对应上的专业"""
+    root, repairs = salvage_xml(content, "Majors")
+    parsed = [((major.findtext("Name") or "").strip(), (major.findtext("Description") or "").strip())
+              for major in root.findall("Major")]
+    matched, match_repairs = match_majors([item for item in parsed if item[1]], majors)
+    _log_repairs("批量揭示", repairs + match_repairs)
+    return matched
+
+def parse_wisdom_report(content: str, final_majors: Optional[List[str]] = None) -> WisdomReport:
+    """将模型输出的 XML 解析为 WisdomReport，尽量修复而不是重新调用模型"""
+    root, repairs = salvage_xml(content, "Report")
+    
+    report_element = root.find("ThreeMajorsReport")
+    report_majors = (report_element if report_element is not None else root).findall("Major")
+    report_majors = [major for major in report_majors if (major.findtext("Description") or "").strip()]
+    if len(report_majors) < 3:
+        raise XMLSalvageError(f"Expected 3 majors in ThreeMajorsReport, but got {len(report_majors)}")
+    if len(report_majors) > 3:
+        report_majors = report_majors[:3]
+        repairs.append("truncated_report")
+    final_three_majors_report = [major.findtext("Description").strip() for major in report_majors]
+    
+    # 提取 FinalThreeMajors，缺失时依次用报告中的专业名、请求的专业名代替
+    final_three_majors_text = (root.findtext("FinalThreeMajors") or "").strip()
+    final_three_majors = [major.strip() for major in re.split(r"[,，、]", final_three_majors_text) if major.strip()]
+    if len(final_three_majors) != 3:
+        final_three_majors = [(major.findtext("Name") or "").strip() for major in report_majors]
+        if not all(final_three_majors) and final_majors:
+            final_three_majors = list(final_majors)
+        repairs.append("names_from_report")
     
-    # 如果没有```标记，直接返回原始文本（假设已经是纯XML）
-    return text.strip()
\ No newline at end of file
+    final_recommendation = (root.findtext("FinalRecommendation") or "").strip()
+    if not final_recommendation:
+        raise XMLSalvageError("Missing <FinalRecommendation> in report output")
+    
+    _log_repairs("智者报告", repairs)
+    return WisdomReport(
+        final_three_majors=final_three_majors,
+        final_three_majors_report=final_three_majors_report,
+        final_recommendation=final_recommendation,
+        parse_confidence=parse_confidence(repairs),
+        repairs=repairs
+    )
+
+### 流式生成
+
+class IncrementalXMLParser:
+    """
+    在 token 流上增量解析 XML
+
+    跳过根标签之前的内容（如说明文字或代码块标记），每次 feed 返回新闭合的元素；
+    根元素闭合后忽略后续内容。遇到非法 XML 时停止增量解析，由调用方在流结束后整体解析。
+    """
+    def __init__(self, root_tag: str):
+        self.root_tag = root_tag
+        self.text = ""
+        self.broken = False
+        self.finished = False
+        self._started = False
+        self._pending = ""
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._path: List[str] = []
+
+    @property
+    def document(self) -> str:
+        """根元素对应的完整文本，根元素尚未出现或闭合时返回全部文本"""
+        start = self.text.find(f"<{self.root_tag}")
+        end = self.text.rfind(f"</{self.root_tag}>")
+        if start < 0 or end < start:
+            return self.text
+        return self.text[start:end + len(self.root_tag) + 3]
+
+    def feed(self, chunk: str) -> List[tuple[List[str], ET.Element]]:
+        """喂入一段文本，返回 [(父元素路径, 元素)]"""
+        self.text += chunk
+        if self.broken or self.finished:
+            return []
+        if not self._started:
+            self._pending += chunk
+            start = self._pending.find(f"<{self.root_tag}")
+            if start < 0:
+                return []
+            self._started = True
+            chunk = self._pending[start:]
+            self._pending = ""
+
+        completed = []
+        try:
+            self._parser.feed(chunk)
+            for event, elem in self._parser.read_events():
+                if event == "start":
+                    self._path.append(elem.tag)
+                    continue
+                self._path.pop()
+                completed.append((list(self._path), elem))
+                if not self._path:
+                    self.finished = True
+                    break
+        except ET.ParseError as e:
+            # 根元素闭合后的多余内容也会触发 ParseError，此时已拿到全部元素
+            if not self.finished:
+                logger.warning(f"增量解析XML失败，改为在流结束后整体解析: {e}")
+                self.broken = True
+        return completed
+
+async def _stream_completion(messages: List[Dict[str, str]], tier: ModelTier, kind: str, record: LLMCallRecord) -> AsyncIterator[str]:
+    """
+    流式调用，把首 token 延迟、usage 和总耗时填入 record
+
+    流中途失败或被放弃时在这里记入明细账，正常结束时由调用方解析完整输出后再记录
+    """
+    # 流式调用在整个流结束前一直占用调度器的并发名额
+    check_deadline("LLM 调用")
+    async with llm_scheduler.slot():
+        start = time.monotonic()
+        usage = None
+        route: Dict[str, str] = {}
+        try:
+            with span("llm.stream", activate=False, tier=tier.value, model=model_tiers.model(tier)) as stream_span:
+                stream = await llm_router.create(messages, stream=True, tier=tier.value, route=route)
+                async for chunk in stream:
+                    # 开启 include_usage 时最后一个 chunk 没有 choices，只带 usage
+                    usage = getattr(chunk, "usage", None) or usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if record.ttft_ms is None:
+                            record.ttft_ms = (time.monotonic() - start) * 1000
+                            if stream_span is not None:
+                                stream_span.set(first_token_ms=round(record.ttft_ms, 1))
+                        yield chunk.choices[0].delta.content
+                if stream_span is not None:
+                    stream_span.set(**_usage_attributes(usage))
+        except BaseException as e:
+            record.set_route(route)
+            record.latency_ms = (time.monotonic() - start) * 1000
+            # 客户端断开时生成器被关闭（GeneratorExit）或任务被取消
+            record.outcome = "upstream_error" if isinstance(e, Exception) else "cancelled"
+            usage_ledger.record(record)
+            if isinstance(e, Exception):
+                model_tiers.record_error(tier)
+                llm_upstream_duration.labels(tier.value, "error").observe(time.monotonic() - start)
+            raise
+        latency = time.monotonic() - start
+        model_tiers.record_call(tier, latency, usage)
+        llm_upstream_duration.labels(tier.value, "ok").observe(latency)
+        _record_usage(kind, tier, usage, latency, stream=True)
+        record.set_route(route)
+        record.set_usage(usage)
+        record.latency_ms = latency * 1000
+
+async def stream_majors_reveal(infos: str, majors: List[str]) -> AsyncIterator[tuple[str, Any]]:
+    """
+    流式生成一组专业的揭示
+
+    每当一个 <Major> 闭合且名称能对应到请求的专业时产出 ("major", {"name", "description"})，name 是请求的专业名；
+    最后补齐还没有推送的专业，产出 ("done", MajorsReveal)。流式结果无法整体解析时，回退到带重试的非流式生成。
+    已推送的描述与最终结果不一致时（回退重新生成或整体解析时修正了对应关系），按最终结果重新推送这个专业；
+    同名的 major 事件以最后一次为准，客户端按 name 覆盖即可与 done 一致。
+    """
+    if LLM_CACHE_ENABLED:
+        cached = await _get_cached_majors_reveal(infos, majors)
+        if cached:
+            for major, description in zip(majors, cached.descriptions):
+                yield "major", {"name": major, "description": description}
+            yield "done", cached
+            return
+
+    logger.debug(f"Streaming majors reveal for {majors}")
+    parser = IncrementalXMLParser("Majors")
+    tier = TASK_TIERS["majors_reveal"]
+    record = LLMCallRecord(function="majors_reveal", tier=tier.value, stream=True)
+    sent: Dict[str, str] = {}  # 已推送的 {请求的专业名: 描述}
+    try:
+        async for token in _stream_completion(reveal_messages(infos, majors), tier, "majors_reveal", record):
+            for path, elem in parser.feed(token):
+                if elem.tag != "Major" or path != ["Majors"]:
+                    continue
+                name, description = (elem.findtext("Name") or "").strip(), (elem.findtext("Description") or "").strip()
+                if not description:
+                    continue
+                # 流式阶段只推送精确或模糊匹配上的专业，按位置对应留到整体解析时决定
+                matched, repairs = match_majors([(name, description)], [major for major in majors if major not in sent])
+                if matched and "positional_name" not in repairs:
+                    major = next(iter(matched))
+                    sent[major] = description
+                    yield "major", {"name": major, "description": description}
+        majors_reveal = _parse_and_record(record, lambda content: parse_majors_reveal(content, majors), parser.document)
+    except Exception as e:
+        logger.error(f"流式生成专业揭示失败，回退到非流式生成: {e}")
+        majors_reveal = await _gen_majors_reveal(infos, majors)
+
+    final = dict(zip(majors, majors_reveal.descriptions))
+    for major in majors:
+        if sent.get(major) != final[major]:
+            yield "major", {"name": major, "description": final[major]}
+
+    if LLM_CACHE_ENABLED:
+        await _set_cached_majors_reveal(infos, majors, majors_reveal)
+    yield "done", majors_reveal
+
+async def stream_wisdom_report(infos: str, final_majors: List[str]) -> AsyncIterator[tuple[str, Any]]:
+    """
+    流式生成智者预言报告
+
+    依次产出 ("final_three_majors", [...])、每个专业的 ("major_report", {"name", "description"})、
+    ("final_recommendation", str)，最后产出 ("done", WisdomReport)。
+    """
+    if len(final_majors) != 3:
+        raise ValueError(f"Expected 3 final majors, but got {len(final_majors)}")
+
+    key = make_cache_key("wisdom_report", infos, list(final_majors))
+    cached = await llm_cache.get(key) if LLM_CACHE_ENABLED else None
+    if cached:
+        report = WisdomReport(**cached)
+        for event in _wisdom_report_events(report):
+            yield event
+        yield "done", report
+        return
+
+    logger.debug(f"Streaming wisdom report for final majors: {final_majors}")
+    parser = IncrementalXMLParser("Report")
+    tier = TASK_TIERS["wisdom_report"]
+    record = LLMCallRecord(function="wisdom_report", tier=tier.value, stream=True)
+    try:
+        async for token in _stream_completion(wisdom_report_messages(infos, final_majors), tier, "wisdom_report", record):
+            for path, elem in parser.feed(token):
+                if path != ["Report"] and path != ["Report", "ThreeMajorsReport"]:
+                    continue
+                if elem.tag == "FinalThreeMajors":
+                    yield "final_three_majors", [major.strip() for major in (elem.text or "").strip().split(",")]
+                elif elem.tag == "Major":
+                    yield "major_report", {"name": (elem.findtext("Name") or "").strip(), "description": elem.findtext("Description") or ""}
+                elif elem.tag == "FinalRecommendation":
+                    yield "final_recommendation", elem.text or ""
+        report = _parse_and_record(record, lambda content: parse_wisdom_report(content, final_majors), parser.document)
+    except Exception as e:
+        logger.error(f"流式生成报告失败，回退到非流式生成: {e}")
+        report = await _gen_wisdom_report(infos, final_majors)
+        for event in _wisdom_report_events(report):
+            yield event
+
+    if LLM_CACHE_ENABLED:
+        await llm_cache.set(key, "wisdom_report", report.model_dump())
+    yield "done", report
+
+def _wisdom_report_events(report: WisdomReport) -> List[tuple[str, Any]]:
+    events: List[tuple[str, Any]] = [("final_three_majors", report.final_three_majors)]
+    for name, description in zip(report.final_three_majors, report.final_three_majors_report):
+        events.append(("major_report", {"name": name, "description": description}))
+    events.append(("final_recommendation", report.final_recommendation))
+    return events
@@ -0,0 +1,232 @@
+import asyncio
+import enum
+import random
+import time
+from typing import Any, Optional
+
+import httpx
+from loguru import logger
+from openai import AsyncOpenAI
+
+from tracing import set_attributes
+from common import classify_error, retry_budget
+
+from config import BASE_URL, API_KEY, MODEL, FAST_MODEL, LARGE_MODEL, LLM_ENDPOINTS, LLM_EWMA_ALPHA, LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN, \
+    LLM_RAMP_SECONDS, LLM_ENDPOINT_MAX_CONNECTIONS, LLM_ENDPOINT_TIMEOUT, LLM_STREAM_INCLUDE_USAGE
+
+class BreakerState(str, enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+class Endpoint:
+    """
+    一个 OpenAI 兼容的上游，拥有独立的连接池、延迟/错误率 EWMA 和熔断器
+
+    熔断器：连续失败 breaker_failures 次后打开，打开期间不接收请求；
+    冷却 breaker_cooldown 秒后进入半开，只放行一个探测请求，成功则关闭，失败则重新打开。
+    关闭后的 ramp_seconds 秒内权重从 RAMP_START 线性恢复到 1，避免刚恢复的上游立刻承接全部流量
+    """
+    RAMP_START = 0.1
+
+    def __init__(self, name: str, base_url: str, api_key: str, model: str, weight: float = 1.0,
+                 timeout: float = LLM_ENDPOINT_TIMEOUT, max_connections: int = LLM_ENDPOINT_MAX_CONNECTIONS,
+                 models: Optional[dict[str, str]] = None):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.models = models or {}
+        self.weight = weight
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            # 重试统一由 common.retry 负责，受全局重试预算约束；SDK 自带的重试会让重试次数成倍叠加
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                timeout=timeout,
+            ),
+        )
+        self.ewma_latency: Optional[float] = None
+        self.ewma_error = 0.0
+        self.state = BreakerState.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.closed_at: Optional[float] = None
+        self.probing = False
+        self.in_flight = 0
+        self.counters = {"requests": 0, "errors": 0, "opened": 0}
+
+    def model_for(self, tier: Optional[str]) -> str:
+        """该上游上某一层模型的名字：上游单独配置的 > FAST_MODEL/LARGE_MODEL > 上游的默认模型"""
+        if tier is None:
+            return self.model
+        return self.models.get(tier) or {"fast": FAST_MODEL, "large": LARGE_MODEL}.get(tier) or self.model
+
+    def available(self, now: float) -> bool:
+        if self.state == BreakerState.CLOSED:
+            return True
+        if self.state == BreakerState.OPEN:
+            return now - self.opened_at >= LLM_BREAKER_COOLDOWN
+        return not self.probing
+
+    def ramp(self, now: float) -> float:
+        if self.closed_at is None or LLM_RAMP_SECONDS <= 0:
+            return 1.0
+        progress = (now - self.closed_at) / LLM_RAMP_SECONDS
+        return min(1.0, self.RAMP_START + (1 - self.RAMP_START) * progress)
+
+    def score(self, now: float, default_latency: float) -> float:
+        """路由权重：配置的权重 × 恢复进度 × 成功率 ÷ 延迟"""
+        latency = self.ewma_latency if self.ewma_latency is not None else default_latency
+        return self.weight * self.ramp(now) * max(1 - self.ewma_error, 0.01) / max(latency, 0.05)
+
+    def acquire(self, now: float):
+        if self.state != BreakerState.CLOSED:
+            # 冷却结束后的第一个请求作为半开探测
+            self.state = BreakerState.HALF_OPEN
+            self.probing = True
+        self.in_flight += 1
+        self.counters["requests"] += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.probing = False
+
+    def record(self, latency: float, ok: bool, now: float):
+        self.ewma_latency = latency if self.ewma_latency is None else \
+            LLM_EWMA_ALPHA * latency + (1 - LLM_EWMA_ALPHA) * self.ewma_latency
+        self.ewma_error = LLM_EWMA_ALPHA * (0.0 if ok else 1.0) + (1 - LLM_EWMA_ALPHA) * self.ewma_error
+        if ok:
+            self.consecutive_failures = 0
+            if self.state != BreakerState.CLOSED:
+                logger.info(f"[llm_router] 上游 {self.name} 已恢复，{LLM_RAMP_SECONDS}s 内逐步恢复流量")
+                self.state = BreakerState.CLOSED
+                self.closed_at = now
+            return
+        self.counters["errors"] += 1
+        self.consecutive_failures += 1
+        if self.state == BreakerState.HALF_OPEN or self.consecutive_failures >= LLM_BREAKER_FAILURES:
+            if self.state != BreakerState.OPEN:
+                logger.warning(f"[llm_router] 上游 {self.name} 连续失败 {self.consecutive_failures} 次，熔断 {LLM_BREAKER_COOLDOWN}s")
+                self.counters["opened"] += 1
+            self.state = BreakerState.OPEN
+            self.opened_at = now
+
+    def stats(self, now: float) -> dict:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "model": self.model,
+            "models": {tier: self.model_for(tier) for tier in ("fast", "large")},
+            "weight": self.weight,
+            "state": self.state.value,
+            "ramp": round(self.ramp(now), 3),
+            "ewma_latency_seconds": self.ewma_latency,
+            "ewma_error_rate": round(self.ewma_error, 4),
+            "consecutive_failures": self.consecutive_failures,
+            "in_flight": self.in_flight,
+            **self.counters,
+        }
+
+class EndpointRouter:
+    """
+    在多个上游之间按延迟和错误率路由 LLM 调用
+
+    - 按 Endpoint.score 加权随机选择可用的上游，慢的、出错多的、刚恢复的上游分到的流量更少
+    - 调用失败时立即换一个上游重试一次，两次都失败才抛出异常，交给外层的 retry 处理
+    - 所有上游都熔断时，选择最早可以探测的上游，不让服务完全不可用
+    - 取消的调用（如对冲请求的败者）不计入延迟和错误率
+    """
+    def __init__(self, endpoints: list[Endpoint]):
+        self.endpoints = endpoints
+        self.counters = {"failovers": 0, "failovers_suppressed": 0, "all_open": 0}
+
+    def pick(self, exclude: tuple[Endpoint, ...] = ()) -> Optional[Endpoint]:
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        if not candidates:
+            return None
+        available = [endpoint for endpoint in candidates if endpoint.available(now)]
+        if not available:
+            self.counters["all_open"] += 1
+            return min(candidates, key=lambda endpoint: endpoint.opened_at)
+        latencies = [endpoint.ewma_latency for endpoint in available if endpoint.ewma_latency is not None]
+        default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+        scores = [endpoint.score(now, default_latency) for endpoint in available]
+        return random.choices(available, weights=scores)[0]
+
+    async def _create(self, endpoint: Endpoint, messages: list[dict], stream: bool, tier: Optional[str], route: Optional[dict]) -> Any:
+        endpoint.acquire(time.monotonic())
+        set_attributes(endpoint=endpoint.name, model=endpoint.model_for(tier))
+        if route is not None:
+            route.update(endpoint=endpoint.name, model=endpoint.model_for(tier))
+        start = time.monotonic()
+        try:
+            # 流式调用要求上游在最后一个 chunk 中返回 usage，用于统计 token 和前缀缓存命中
+            extra = {"stream_options": {"include_usage": True}} if stream and LLM_STREAM_INCLUDE_USAGE else {}
+            response = await endpoint.client.chat.completions.create(model=endpoint.model_for(tier), messages=messages, stream=stream, **extra)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            endpoint.record(time.monotonic() - start, ok=False, now=time.monotonic())
+            raise
+        finally:
+            endpoint.release()
+        # 流式调用只统计到响应开始返回为止
+        endpoint.record(time.monotonic() - start, ok=True, now=time.monotonic())
+        return response
+
+    async def create(self, messages: list[dict], stream: bool = False, tier: Optional[str] = None, route: Optional[dict] = None) -> Any:
+        """
+        tier 为 "fast"/"large" 时使用所选上游上对应层的模型
+
+        传入 route 时填入最后一次尝试的上游名和模型名（endpoint、model），用于记录调用明细。
+        只有可重试的错误才切换到另一个上游，切换本身也是一次重试，先从共享的重试预算中取出一个令牌
+        """
+        endpoint = self.pick()
+        try:
+            return await self._create(endpoint, messages, stream, tier, route)
+        except Exception as e:
+            if classify_error(e) is None:
+                raise
+            fallback = self.pick(exclude=(endpoint,))
+            if fallback is None:
+                raise
+            if not retry_budget.withdraw():
+                self.counters["failovers_suppressed"] += 1
+                raise
+            self.counters["failovers"] += 1
+            set_attributes(failover_from=endpoint.name)
+            logger.warning(f"[llm_router] 上游 {endpoint.name} 调用失败，切换到 {fallback.name}: {e}")
+            return await self._create(fallback, messages, stream, tier, route)
+
+    async def close(self):
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            **self.counters,
+            "endpoints": [endpoint.stats(now) for endpoint in self.endpoints],
+        }
+
+def load_endpoints() -> list[Endpoint]:
+    """LLM_ENDPOINTS 未配置时，使用 BASE_URL/API_KEY/MODEL 作为唯一的上游"""
+    specs = LLM_ENDPOINTS or [{"name": "default", "base_url": BASE_URL, "api_key": API_KEY, "model": MODEL}]
+    return [
+        Endpoint(
+            name=spec.get("name") or f"endpoint-{index}",
+            base_url=spec.get("base_url") or BASE_URL,
+            api_key=spec.get("api_key") or API_KEY,
+            model=spec.get("model") or MODEL,
+            weight=float(spec.get("weight", 1.0)),
+            timeout=float(spec.get("timeout", LLM_ENDPOINT_TIMEOUT)),
+            models=spec.get("models"),
+        )
+        for index, spec in enumerate(specs)
+    ]
+
+llm_router = EndpointRouter(load_endpoints())
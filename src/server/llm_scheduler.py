@@ -0,0 +1,237 @@
+import asyncio
+import enum
+import hashlib
+import json
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+from loguru import logger
+
+from metrics import CallbackGauge
+from config import LLM_MAX_CONCURRENCY, LLM_SINGLE_FLIGHT_ENABLED, LLM_QUEUE_WARN_SECONDS
+
+class LLMPriority(enum.IntEnum):
+    INTERACTIVE = 0  # get_choices / get_round，学生正在等待
+    REPORT = 1       # 生成报告
+    BACKGROUND = 2   # 预取等后台任务
+
+# 当前请求的调度信息，由路由设置；后台任务创建时会复制一份，再单独改为 BACKGROUND
+llm_priority: ContextVar[LLMPriority] = ContextVar("llm_priority", default=LLMPriority.INTERACTIVE)
+llm_user: ContextVar[str] = ContextVar("llm_user", default="anonymous")
+
+def set_llm_context(user_id: Optional[str] = None, priority: Optional[LLMPriority] = None):
+    """设置当前请求（或后台任务）之后发出的 LLM 调用所属的用户和优先级"""
+    if user_id is not None:
+        llm_user.set(user_id)
+    if priority is not None:
+        llm_priority.set(priority)
+
+def make_request_key(model: str, messages: list[dict]) -> str:
+    payload = json.dumps({"model": model, "messages": messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+@dataclass
+class _Waiter:
+    future: asyncio.Future
+    priority: LLMPriority
+    user_id: str
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+@dataclass
+class _Flight:
+    task: Optional[asyncio.Task]
+    priority: LLMPriority  # 所有合并进来的调用中最高的优先级，调用开始排队前合并进来的也算
+    waiters: int = 0
+    waiter: Optional[_Waiter] = None  # 调用仍在排队时的排队项，用于提升优先级
+
+class LLMScheduler:
+    """
+    所有 LLM 调用的统一入口
+
+    - 同时进行的调用不超过 max_concurrency，其余调用排队
+    - 排队按优先级出队：交互请求先于报告，报告先于后台预取
+    - 同一优先级内按用户轮转出队，一个用户的大量调用不会挡住其他用户
+    - submit 对完全相同的非流式请求做合并：已有相同请求在进行时直接等待它的结果，
+      所有等待者都取消后才取消这次调用；合并进来的调用优先级更高且原调用还在排队时，原调用随之提升
+    - 流式调用不合并，只通过 slot 占用并发名额直到流结束
+    """
+    WAIT_SAMPLES = 1000  # 计算等待时间分位数时保留的最近样本数
+
+    def __init__(self, max_concurrency: int, single_flight: bool = True):
+        self.max_concurrency = max_concurrency
+        self.single_flight = single_flight
+        self._in_flight = 0
+        self._queues: dict[LLMPriority, OrderedDict[str, deque[_Waiter]]] = {
+            priority: OrderedDict() for priority in LLMPriority
+        }
+        self._flights: dict[str, _Flight] = {}
+        self._waits: deque[float] = deque(maxlen=self.WAIT_SAMPLES)
+        self.counters = {
+            "submitted": 0,
+            "deduplicated": 0,
+            "queued": 0,
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "promoted": 0,
+        }
+
+    def saturated(self) -> bool:
+        """并发名额已满且有调用在排队"""
+        return self._in_flight >= self.max_concurrency and self._queued() > 0
+
+    def _queued(self) -> int:
+        return sum(len(waiters) for queue in self._queues.values() for waiters in queue.values())
+
+    def _enqueue(self, priority: LLMPriority, user_id: str) -> _Waiter:
+        waiter = _Waiter(future=asyncio.get_running_loop().create_future(), priority=priority, user_id=user_id)
+        self._queues[priority].setdefault(user_id, deque()).append(waiter)
+        self.counters["queued"] += 1
+        return waiter
+
+    def _promote(self, flight: _Flight, priority: LLMPriority):
+        if priority >= flight.priority:
+            return
+        flight.priority = priority
+        self.counters["promoted"] += 1
+        # 调用还没开始排队时，排队时直接使用提升后的优先级；已经在排队的移到新优先级的队列
+        waiter = flight.waiter
+        if waiter is None or waiter.future.done():
+            return
+        self._remove(waiter)
+        waiter.priority = priority
+        self._queues[priority].setdefault(waiter.user_id, deque()).append(waiter)
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues[waiter.priority]
+        waiters = queue.get(waiter.user_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del queue[waiter.user_id]
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for queue in self._queues.values():
+            if queue:
+                # 取出排在最前的用户的第一个调用，该用户还有调用时排到队尾，实现按用户轮转
+                user_id, waiters = queue.popitem(last=False)
+                waiter = waiters.popleft()
+                if waiters:
+                    queue[user_id] = waiters
+                return waiter
+        return None
+
+    def _dispatch(self):
+        while self._in_flight < self.max_concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            if waiter.future.done():
+                continue
+            self._in_flight += 1
+            wait = time.monotonic() - waiter.enqueued_at
+            self._waits.append(wait)
+            if wait > LLM_QUEUE_WARN_SECONDS:
+                logger.warning(f"[llm_scheduler] {waiter.priority.name} 调用排队 {wait:.1f}s，当前排队 {self._queued()} 个")
+            waiter.future.set_result(None)
+
+    def _release(self):
+        self._in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, flight: Optional[_Flight] = None):
+        """占用一个并发名额直到退出，名额不足时按优先级和用户轮转排队"""
+        priority = flight.priority if flight is not None else llm_priority.get()
+        user_id = llm_user.get()
+        if self._in_flight < self.max_concurrency and not self._queued():
+            self._in_flight += 1
+            self._waits.append(0.0)
+        else:
+            waiter = self._enqueue(priority, user_id)
+            if flight is not None:
+                flight.waiter = waiter
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # 名额已经分配但调用方被取消，归还名额
+                    self._release()
+                else:
+                    self._remove(waiter)
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _run(self, factory: Callable[[], Awaitable[Any]], flight: Optional[_Flight] = None) -> Any:
+        async with self.slot(flight):
+            try:
+                result = await factory()
+            except asyncio.CancelledError:
+                self.counters["cancelled"] += 1
+                raise
+            except Exception:
+                self.counters["failed"] += 1
+                raise
+            self.counters["completed"] += 1
+            return result
+
+    async def submit(self, key: Optional[str], factory: Callable[[], Awaitable[Any]]) -> Any:
+        """执行一次非流式调用；key 相同的调用正在进行时直接共享它的结果，key 为 None 时不合并"""
+        self.counters["submitted"] += 1
+        if key is None or not self.single_flight:
+            return await self._run(factory)
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(task=None, priority=llm_priority.get())
+            flight.task = asyncio.create_task(self._run(factory, flight))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._flights.pop(key, None) if self._flights.get(key) is flight else None)
+        else:
+            self.counters["deduplicated"] += 1
+            self._promote(flight, llm_priority.get())
+            logger.debug(f"[llm_scheduler] 合并相同的进行中调用 {key[:12]}")
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            **self.counters,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self._in_flight,
+            "queue_depth": {
+                priority.name.lower(): sum(len(waiters) for waiters in self._queues[priority].values())
+                for priority in LLMPriority
+            },
+            "queued_users": len({user_id for queue in self._queues.values() for user_id in queue}),
+            "single_flights": len(self._flights),
+            "wait_seconds": {
+                "avg": sum(waits) / len(waits) if waits else 0.0,
+                "p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "max": waits[-1] if waits else 0.0,
+            },
+        }
+
+llm_scheduler = LLMScheduler(max_concurrency=LLM_MAX_CONCURRENCY, single_flight=LLM_SINGLE_FLIGHT_ENABLED)
+
+CallbackGauge("llm_in_flight", "正在进行的 LLM 调用数", (), lambda: {(): llm_scheduler._in_flight})
+CallbackGauge("llm_queue_depth", "各优先级排队中的 LLM 调用数", ("priority",), lambda: {
+    (priority.name.lower(),): sum(len(waiters) for waiters in llm_scheduler._queues[priority].values())
+    for priority in LLMPriority
+})
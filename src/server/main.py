@@ -1,25 +1,48 @@
 import asyncio
-from fastapi import FastAPI
+import secrets
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.concurrency import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse
 from starlette.middleware.sessions import SessionMiddleware
 from loguru import logger
 
 from database.base import init_db
-from routes.jwt_utils import cleanup_expired_states
-from config import SECRET_KEY, ALLOW_ORIGINS
+from database.write_queue import write_queue
+from http_client import open_casdoor_client, close_casdoor_client
+from routes.jwt_utils import cleanup_expired_states, refresh_signing_keys_periodically
+from config import SECRET_KEY, ALLOW_ORIGINS, WRITE_QUEUE_ENABLED, METRICS_ENABLED, METRICS_TOKEN, COMPARISON_SIZE, COMPARISON_SIZE_CONFIGURED
+from pairing import default_strategy
+from llm_router import llm_router
+from usage_ledger import usage_ledger
+from deadline import DeadlineMiddleware
+from metrics import MetricsMiddleware, registry
+from tracing import TracingMiddleware
 from routes import sessions_router, jwt_router, options_router
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("SelfKnowing启动中...")
+    await open_casdoor_client()
     asyncio.create_task(cleanup_expired_states())
+    asyncio.create_task(refresh_signing_keys_periodically())
     await init_db()
+    if WRITE_QUEUE_ENABLED:
+        write_queue.start()
+    usage_ledger.start()
+    if METRICS_ENABLED and not METRICS_TOKEN:
+        logger.warning("未配置 METRICS_TOKEN，指标照常记录，但不提供 /metrics")
+    if COMPARISON_SIZE != COMPARISON_SIZE_CONFIGURED:
+        logger.warning(f"COMPARISON_SIZE={COMPARISON_SIZE_CONFIGURED} 超出 2 到 4 的范围，按 {COMPARISON_SIZE} 处理")
+    logger.info(f"配对策略: {default_strategy.name}，预计每个会话比较 {default_strategy.expected_comparisons():.1f} 次")
     logger.info("SelfKnowing已启动")
     yield
     logger.info("SelfKnowing关闭中...")
+    await write_queue.stop()
+    await usage_ledger.stop()
+    await llm_router.close()
+    await close_casdoor_client()
     
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(
@@ -30,10 +53,21 @@ app.add_middleware(
     allow_headers=["*"],  
 )
 app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(TracingMiddleware)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
 app.include_router(jwt_router, prefix="/api/auth")
 app.include_router(sessions_router, prefix="/api")
 app.include_router(options_router, prefix="/api/options")
 
+if METRICS_ENABLED and METRICS_TOKEN:
+    @app.get("/metrics", include_in_schema=False)
+    async def prometheus_metrics(authorization: str = Header("")) -> PlainTextResponse:
+        if not secrets.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            raise HTTPException(status_code=401, detail="需要有效的 METRICS_TOKEN")
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/{path}")
 async def index(path: str):
     return FileResponse(path='dist/index.html')
@@ -0,0 +1,234 @@
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Iterable, Optional
+
+from tracing import span
+from config import METRICS_ENABLED
+
+# 秒，覆盖数据库操作的毫秒级到 LLM 调用的分钟级
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class _Disabled:
+    """METRICS_ENABLED 关闭时 labels(...) 返回的子指标，所有更新都不做任何事"""
+    def inc(self, amount: float = 1.0):
+        pass
+
+    def dec(self, amount: float = 1.0):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+_DISABLED = _Disabled()
+
+class _Metric(ABC):
+    """
+    Prometheus 文本格式的指标，labels(...) 返回对应标签值的子指标
+
+    只在进程内累加，没有锁：所有更新都发生在事件循环线程里。
+    METRICS_ENABLED 关闭时不记录任何值，@timed 只保留 trace 中的 span
+    """
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], object] = {}
+        registry.register(self)
+
+    def labels(self, *values: str):
+        if not METRICS_ENABLED:
+            return _DISABLED
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} 需要标签 {self.labelnames}，实际为 {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """创建一组标签值对应的子指标"""
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        """按 Prometheus 文本格式输出所有子指标的样本行"""
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}", *self.samples()]
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+                for values, child in self._children.items()]
+
+class Gauge(Counter):
+    type = "gauge"
+
+class CallbackGauge(_Metric):
+    """抓取时才调用 collect 取值的 gauge，collect 返回 {标签值元组: 数值}"""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...], collect: Callable[[], dict]):
+        self.collect = collect
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        raise TypeError(f"{self.name} 的值在抓取时由 collect 提供，不能通过 labels 更新")
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}"
+                for values, value in self.collect().items()]
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                le_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le_label)} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"指标 {metric.name} 已注册")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def timed(histogram: Histogram):
+    """记录协程函数的耗时，标签为 (函数名, ok/error)；每次调用同时记为当前 trace 中的一个 span"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                with span(func.__name__):
+                    result = await func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                histogram.labels(func.__name__, outcome).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+### 指标
+
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP 请求耗时，SSE 请求为整个流的耗时", ("method", "route", "status"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "正在处理的 HTTP 请求数")
+crud_duration = Histogram("crud_duration_seconds", "crud.py 中各函数的耗时", ("function", "outcome"))
+db_pool_wait = Histogram("db_pool_wait_seconds", "从连接池取得数据库连接的等待时间", ("pool",),
+                         buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+llm_call_duration = Histogram("llm_call_duration_seconds", "LLM 生成函数的耗时，包括缓存命中、排队、回退和重试", ("function", "outcome"))
+llm_upstream_duration = Histogram("llm_upstream_duration_seconds", "单次上游模型调用的耗时", ("tier", "outcome"))
+llm_tokens = Counter("llm_tokens_total", "上游返回的 usage 中的 token 数，kind 为 prompt/cached/completion，cached 是 prompt 中命中前缀缓存的部分", ("tier", "kind"))
+retries = Counter("retries_total", "common.retry 发起的重试次数", ("function", "reason"))
+retries_suppressed = Counter("retries_suppressed_total", "common.retry 放弃重试的次数", ("function", "cause"))
+
+class MetricsMiddleware:
+    """记录每个 HTTP 请求的耗时和正在处理的请求数，路由标签取路由模板而不是实际路径，避免标签基数失控"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status: Optional[int] = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        http_requests_in_flight.labels().inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.labels().dec()
+            route = scope.get("route")
+            http_request_duration.labels(
+                scope["method"],
+                getattr(route, "path", None) or "unmatched",
+                str(status or 500),
+            ).observe(time.perf_counter() - start)
@@ -0,0 +1,193 @@
+import asyncio
+import enum
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from loguru import logger
+
+from deadline import remaining, within_deadline
+from config import MODEL, FAST_MODEL, LARGE_MODEL, FAST_MODEL_TIMEOUT, LARGE_MODEL_TIMEOUT, MODEL_FALLBACK_MIN_CONFIDENCE, \
+    FAST_MODEL_PRICE, LARGE_MODEL_PRICE
+
+T = TypeVar("T")
+
+class ModelTier(str, enum.Enum):
+    FAST = "fast"    # 小而快的模型，用于学生正在等待的专业揭示
+    LARGE = "large"  # 大模型，用于最终的智者报告
+
+    @property
+    def other(self) -> "ModelTier":
+        return ModelTier.LARGE if self is ModelTier.FAST else ModelTier.FAST
+
+# 每种任务默认使用的模型层
+TASK_TIERS: dict[str, ModelTier] = {
+    "majors_reveal": ModelTier.FAST,
+    "round_reveals": ModelTier.FAST,
+    "wisdom_report": ModelTier.LARGE,
+}
+
+def _parse_price(value: str) -> Optional[tuple[float, float]]:
+    if not value:
+        return None
+    prompt_price, completion_price = (float(part) for part in value.split(","))
+    return prompt_price, completion_price
+
+class _LatencyStats:
+    SAMPLES = 500  # 计算分位数时保留的最近样本数
+
+    def __init__(self):
+        self._latencies: deque[float] = deque(maxlen=self.SAMPLES)
+
+    def add(self, latency: float):
+        self._latencies.append(latency)
+
+    def summary(self) -> dict:
+        latencies = sorted(self._latencies)
+        if not latencies:
+            return {"avg": 0.0, "p50": 0.0, "p95": 0.0}
+        return {
+            "avg": sum(latencies) / len(latencies),
+            "p50": latencies[len(latencies) // 2],
+            "p95": latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+        }
+
+class ModelTiers:
+    """
+    按任务选择模型层，并在超时或解析置信度过低时改用另一层
+
+    - run 先用任务对应的模型层生成，超过该层的超时时间后取消，改用另一层生成
+    - 结果的解析置信度低于 min_confidence 时，再用另一层生成一次，取置信度更高的结果
+    - 两层是同一个模型时不做回退，超时直接抛出交给外层的 retry
+    - 请求有截止时间时，首选层的超时会裁剪到剩余预算减去另一层的超时，保证超时回退在预算内仍来得及
+    - 按层统计调用次数、延迟、token 和花费，按任务统计端到端延迟、回退次数和平均解析置信度，
+      用来确认揭示换成快模型后变快了，而报告的质量没有下降
+    """
+    def __init__(self, models: dict[ModelTier, str], timeouts: dict[ModelTier, float],
+                 prices: dict[ModelTier, Optional[tuple[float, float]]], min_confidence: float):
+        self.models = models
+        self.timeouts = timeouts
+        self.prices = prices
+        self.min_confidence = min_confidence
+        self._tier_latency = {tier: _LatencyStats() for tier in ModelTier}
+        self._task_latency = {task: _LatencyStats() for task in TASK_TIERS}
+        self.tier_counters = {
+            tier: {"calls": 0, "errors": 0, "timeouts": 0, "prompt_tokens": 0, "completion_tokens": 0}
+            for tier in ModelTier
+        }
+        self.task_counters = {
+            task: {"calls": 0, "completed": 0, "timeout_fallbacks": 0, "low_confidence_fallbacks": 0, "fallback_wins": 0, "confidence_sum": 0.0}
+            for task in TASK_TIERS
+        }
+
+    def model(self, tier: ModelTier) -> str:
+        return self.models[tier]
+
+    @property
+    def fallback_enabled(self) -> bool:
+        return self.models[ModelTier.FAST] != self.models[ModelTier.LARGE]
+
+    def record_call(self, tier: ModelTier, latency: float, usage: Any = None):
+        """记录一次成功的模型调用，流式调用没有 usage，只记延迟"""
+        counters = self.tier_counters[tier]
+        counters["calls"] += 1
+        self._tier_latency[tier].add(latency)
+        if usage is not None:
+            counters["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+            counters["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+    def record_error(self, tier: ModelTier):
+        self.tier_counters[tier]["errors"] += 1
+
+    def _timeout(self, tier: ModelTier) -> Optional[float]:
+        """首选层的超时，None 表示不限；剩余预算不足时给回退的另一层留出它的超时，至少留一半预算给首选层"""
+        timeout = self.timeouts[tier] or None
+        left = remaining()
+        if left is None or left <= 0:
+            return timeout
+        budget = max(left - (self.timeouts[tier.other] or left / 2), left / 2)
+        return budget if timeout is None else min(timeout, budget)
+
+    async def _attempt(self, tier: ModelTier, attempt: Callable[[ModelTier, bool], Awaitable[T]], timeout: Optional[float]) -> T:
+        try:
+            # 请求的时间预算先用完时抛出 DeadlineExceeded，不再回退
+            return await within_deadline(attempt(tier, False), timeout=timeout, what="LLM 调用")
+        except asyncio.TimeoutError:
+            self.tier_counters[tier]["timeouts"] += 1
+            raise
+
+    async def run(self, task: str, attempt: Callable[[ModelTier, bool], Awaitable[T]],
+                  confidence: Callable[[T], float] = lambda result: result.parse_confidence) -> T:
+        """执行 attempt(tier, fallback)，必要时改用另一层模型，返回最终采用的结果"""
+        tier = TASK_TIERS[task]
+        counters = self.task_counters[task]
+        counters["calls"] += 1
+        start = time.monotonic()
+        timeout = self._timeout(tier) if self.fallback_enabled else None
+        try:
+            result = await self._attempt(tier, attempt, timeout)
+        except asyncio.TimeoutError:
+            counters["timeout_fallbacks"] += 1
+            logger.warning(f"[model_tiers] {task} 的 {tier.value} 模型 {timeout:.1f}s 未返回，改用 {tier.other.value} 模型")
+            result = await attempt(tier.other, True)
+            counters["fallback_wins"] += 1
+        else:
+            score = confidence(result)
+            if self.fallback_enabled and score < self.min_confidence:
+                counters["low_confidence_fallbacks"] += 1
+                logger.warning(f"[model_tiers] {task} 的解析置信度 {score:.2f} 过低，改用 {tier.other.value} 模型重新生成")
+                try:
+                    retried = await attempt(tier.other, True)
+                except Exception as e:
+                    logger.error(f"[model_tiers] {task} 改用 {tier.other.value} 模型失败，保留原结果: {e}")
+                else:
+                    if confidence(retried) > score:
+                        counters["fallback_wins"] += 1
+                        result = retried
+        counters["completed"] += 1
+        counters["confidence_sum"] += confidence(result)
+        self._task_latency[task].add(time.monotonic() - start)
+        return result
+
+    def cost(self, tier: ModelTier, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+        """按该层配置的价格计算花费，没有配置价格时为 None"""
+        price = self.prices[tier]
+        if price is None:
+            return None
+        return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+    def _cost(self, tier: ModelTier) -> Optional[float]:
+        counters = self.tier_counters[tier]
+        return self.cost(tier, counters["prompt_tokens"], counters["completion_tokens"])
+
+    def stats(self) -> dict:
+        return {
+            "fallback_enabled": self.fallback_enabled,
+            "min_confidence": self.min_confidence,
+            "tiers": {
+                tier.value: {
+                    **self.tier_counters[tier],
+                    "model": self.models[tier],
+                    "timeout_seconds": self.timeouts[tier],
+                    "latency_seconds": self._tier_latency[tier].summary(),
+                    "cost": self._cost(tier),
+                }
+                for tier in ModelTier
+            },
+            "tasks": {
+                task: {
+                    "tier": TASK_TIERS[task].value,
+                    **{key: value for key, value in counters.items() if key != "confidence_sum"},
+                    "avg_parse_confidence": counters["confidence_sum"] / counters["completed"] if counters["completed"] else None,
+                    "latency_seconds": self._task_latency[task].summary(),
+                }
+                for task, counters in self.task_counters.items()
+            },
+        }
+
+model_tiers = ModelTiers(
+    models={ModelTier.FAST: FAST_MODEL or MODEL, ModelTier.LARGE: LARGE_MODEL or MODEL},
+    timeouts={ModelTier.FAST: FAST_MODEL_TIMEOUT, ModelTier.LARGE: LARGE_MODEL_TIMEOUT},
+    prices={ModelTier.FAST: _parse_price(FAST_MODEL_PRICE), ModelTier.LARGE: _parse_price(LARGE_MODEL_PRICE)},
+    min_confidence=MODEL_FALLBACK_MIN_CONFIDENCE,
+)
@@ -0,0 +1,330 @@
+"""
+配对策略：决定每一轮由哪些专业参与比较、何时结束，以及报告使用哪三个专业
+
+- knockout（默认）: 每一层淘汰赛直到剩下唯一胜者，再进入它的子专业，报告取最后几轮的胜者
+- top3: 类别层只需要冠军，仍是淘汰赛；专业层在冠军产生后，只让直接输给冠军的专业重赛决出亚军，
+  再让直接输给亚军的专业重赛决出季军，得到有序的前三名
+
+top3 并不比 knockout 省比较：淘汰赛每层只决出冠军（n - 1 次），报告的另外两个专业只是最后几轮的胜者；
+而有序前三名至少需要 n - 3 + ⌈log2 n(n-1)⌉ 次，总比 n - 1 多。top3 省下的是与反复淘汰赛取前三名
+（(n-1) + (n-2) + (n-3) 次）相比的比较，用几次额外的比较换来真实的前三名顺序
+
+策略由 PAIRING_STRATEGY 按部署选择，会话创建时记录下来，同一个会话始终使用同一个策略
+
+每个画面同时比较 COMPARISON_SIZE 个专业（2 到 4），学生从中选出一个胜者，其余都算输给这个胜者。
+两种策略都只依赖“谁输给了谁”，所以多选一的画面同样适用
+"""
+import math
+import random
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from functools import lru_cache
+from statistics import mean
+from typing import Optional, Sequence
+
+from loguru import logger
+
+from config import COMPARISON_SIZE, MAJOR_TREE, PAIRING_STRATEGY
+from database.models import Round, Session
+
+def get_next_majors(major_name: str) -> list[str]:
+    """返回给定专业的子专业列表，如果没有则返回空列表"""
+    return MAJOR_TREE.get(major_name, [])
+
+def get_winners_and_next_majors(round: Round) -> tuple[list[str], list[str]]:
+    """
+    根据当前轮次确定胜出者和下一轮专业
+
+    Args:
+        round: 当前轮次对象
+
+    Returns:
+        tuple: (胜出者列表, 下一轮专业列表)
+            - 如果有唯一胜出者且有子专业，返回 ([胜出者], [子专业列表])
+            - 如果有唯一胜出者但无子专业，返回 ([胜出者], [])
+            - 如果有多个胜出者，返回 ([胜出者列表], [胜出者列表])
+    """
+    winners = get_round_winners(round)
+
+    # 如果只有一个胜出者，检查是否有子专业
+    if len(winners) == 1:
+        winner = winners[0]
+        child_majors = get_next_majors(winner)
+        logger.debug(f"[get_winners_and_next_majors] 唯一胜出者 {winner} 的子专业: {child_majors}")
+
+        # 如果有子专业，下一轮使用子专业
+        if child_majors:
+            return winners, child_majors
+        # 如果没有子专业，返回空列表作为下一轮专业，表示应该结束会话
+        return winners, []
+
+    # 如果有多个胜出者，下一轮使用这些胜出者
+    logger.debug(f"[get_winners_and_next_majors] 多个胜出者: {winners}，下一轮将继续比较这些专业")
+    return winners, winners
+
+def split_into_groups(majors: Sequence[str], group_size: int) -> tuple[list[list[str]], list[str]]:
+    """
+    按顺序每 group_size 个专业分为一组，返回 (需要比较的分组, 轮空的专业)
+
+    最后只剩一个专业时轮空直接晋级；group_size 为 2 时与原来的两两配对、奇数时最后一个轮空完全一致
+    """
+    groups = [list(majors[i:i + group_size]) for i in range(0, len(majors), group_size)]
+    if groups and len(groups[-1]) == 1:
+        return groups[:-1], groups[-1]
+    return groups, []
+
+def get_round_winners(round: Round) -> list[str]:
+    """本轮的胜出者：明确标记为胜出的专业在前，轮空（未参与比较）的专业在后"""
+    # 1. 获取已明确标记为胜出的专业
+    explicit_winners = [choice.major_name for choice in round.appearances if choice.is_winner_in_comparison is True]
+
+    # 2. 获取所有已参与比较的专业
+    compared_majors = {choice.major_name for choice in round.appearances if choice.is_winner_in_comparison is not None}
+
+    # 3. 获取未参与比较的专业（轮空的）
+    uncompared_majors = set(round.current_round_majors) - compared_majors
+
+    # 4. 合并明确胜出的和轮空的专业作为最终胜出者
+    winners = explicit_winners + list(uncompared_majors)
+
+    logger.debug(f"[get_round_winners] 当前轮次明确胜出者: {explicit_winners}, 轮空专业: {uncompared_majors}, 最终胜出者: {winners}")
+    return winners
+
+@dataclass
+class RoundResult:
+    winners: list[str]
+    comparisons: list[tuple[str, str]] = field(default_factory=list)  # (胜者, 负者)，多选一的画面每个负者一条
+    screens: int = 0  # 学生做出选择的画面数
+
+def get_round_groups(round: Round) -> list[list]:
+    """
+    把本轮已完成比较的出场记录按画面分组，按出场顺序排列
+
+    有赛程的轮次按赛程中的分组归并；没有赛程的旧轮次每两条记录一个画面。
+    轮空晋级的记录不属于任何分组（旧数据中是两条同名记录），不算比较
+    """
+    appearances = sorted(
+        (choice for choice in round.appearances if choice.is_winner_in_comparison is not None),
+        key=lambda choice: choice.appearance_index,
+    )
+    if not round.schedule:
+        pairs = zip(appearances[::2], appearances[1::2])
+        return [list(pair) for pair in pairs if pair[0].major_name != pair[1].major_name]
+
+    group_of = {major: index for index, group in enumerate(round.schedule) for major in group}
+    groups: dict[int, list] = {}
+    for choice in appearances:
+        if choice.major_name in group_of:
+            groups.setdefault(group_of[choice.major_name], []).append(choice)
+    return [group for group in groups.values() if len(group) > 1]
+
+def get_round_result(round: Round) -> RoundResult:
+    """从出场记录中还原本轮的胜出者和每一场比较"""
+    comparisons = []
+    groups = get_round_groups(round)
+    for group in groups:
+        winners = [choice.major_name for choice in group if choice.is_winner_in_comparison]
+        losers = [choice.major_name for choice in group if not choice.is_winner_in_comparison]
+        for winner in winners:
+            comparisons.extend((winner, loser) for loser in losers)
+    return RoundResult(winners=get_round_winners(round), comparisons=comparisons, screens=len(groups))
+
+class Top3Selection:
+    """
+    按轮次结果重放 top-3 选择的进度
+
+    类别层淘汰赛只决出冠军类别，随后进入它的子专业：
+    1. 淘汰赛决出冠军 C，n - 1 次比较
+    2. 亚军只可能是直接输给 C 的专业，最多 ⌈log2 n⌉ 个，淘汰赛决出亚军 S
+    3. 季军只可能输给过 C 或 S：第 1、2 步中直接输给 S 的专业，淘汰赛决出季军 T
+    每个专业在每个阶段最多输一次，所以第 3 步的候选正是“除了 C、S 之外没有输给过别人”的专业，
+    [C, S, T] 就是真实的前三名顺序。候选不足 2 个的阶段不需要比较，直接确定名次
+    """
+    def __init__(self, major_tree: dict[str, list[str]]):
+        self.major_tree = major_tree
+        self.final_level = False
+        self.category: Optional[str] = None
+        self.category_runner_ups: list[str] = []  # 直接输给冠军类别的类别，越晚输的越靠前
+        self.podium: list[str] = []
+        self.candidates: list[str] = list(major_tree)
+        self.comparisons: list[tuple[str, str]] = []  # 当前层的比较，按时间顺序
+        self.finished = False
+        self._settle()
+
+    def feed(self, result: RoundResult):
+        self.comparisons.extend(result.comparisons)
+        if len(result.winners) > 1:
+            self.candidates = result.winners
+        elif result.winners:
+            self._resolve(result.winners[0])
+
+    def beaten_by(self, major: str) -> list[str]:
+        return list(dict.fromkeys(loser for winner, loser in reversed(self.comparisons) if winner == major))
+
+    def _resolve(self, winner: str):
+        if not self.final_level:
+            self.category = winner
+            self.category_runner_ups = self.beaten_by(winner)
+            self.final_level = True
+            self.comparisons = []
+            self.candidates = list(self.major_tree.get(winner, []))
+        else:
+            self.podium.append(winner)
+            self.candidates = self.beaten_by(winner)
+        self._settle()
+
+    def _settle(self):
+        if len(self.podium) >= 3 or not self.candidates:
+            self.finished = True
+            self.candidates = []
+        elif len(self.candidates) == 1:
+            self._resolve(self.candidates[0])
+
+class PairingStrategy(ABC):
+    name: str
+    description: str
+
+    @abstractmethod
+    def next_round_majors(self, rounds: Sequence[Round]) -> list[str]:
+        """上一轮结束后，下一轮参与比较的专业；没有轮次时返回第一轮的专业，返回空列表表示比较结束"""
+
+    @abstractmethod
+    def final_majors(self, rounds: Sequence[Round]) -> list[str]:
+        """生成报告使用的专业，按推荐程度排序，第一个即最终专业"""
+
+    @abstractmethod
+    def level_comparisons(self, n: int, final_level: bool, group_size: int = 2) -> float:
+        """在一层的 n 个候选专业中完成选择预计需要的比较（画面）次数"""
+
+    def expected_comparisons(self, major_tree: dict[str, list[str]] = MAJOR_TREE, group_size: int = COMPARISON_SIZE) -> float:
+        """一个会话预计需要的比较（画面）次数，假设每个类别成为冠军的概率相同"""
+        if not major_tree:
+            return 0.0
+        category_level = self.level_comparisons(len(major_tree), False, group_size)
+        return category_level + mean(self.level_comparisons(len(children), True, group_size) for children in major_tree.values())
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "description": self.description,
+            "comparison_size": COMPARISON_SIZE,
+            "expected_comparisons": round(self.expected_comparisons(), 2),
+        }
+
+class KnockoutStrategy(PairingStrategy):
+    name = "knockout"
+    description = "逐层淘汰赛，每层决出唯一胜者后进入它的子专业"
+
+    def next_round_majors(self, rounds: Sequence[Round]) -> list[str]:
+        if not rounds:
+            return list(MAJOR_TREE.keys())
+        _, next_majors = get_winners_and_next_majors(rounds[-1])
+        return next_majors
+
+    def final_majors(self, rounds: Sequence[Round]) -> list[str]:
+        final_majors = []
+        seen_majors = set()
+
+        for round in reversed(rounds):
+            if len(final_majors) >= 3:
+                break
+
+            for appearance in round.appearances:
+                if appearance.is_winner_in_comparison == True and appearance.major_name not in seen_majors:
+                    final_majors.append(appearance.major_name)
+                    seen_majors.add(appearance.major_name)
+
+                    if len(final_majors) >= 3:
+                        break
+        return final_majors
+
+    def level_comparisons(self, n: int, final_level: bool, group_size: int = 2) -> float:
+        return knockout_screens(n, group_size)
+
+class Top3SelectionStrategy(PairingStrategy):
+    name = "top3"
+    description = "类别层淘汰赛决出冠军类别，专业层用锦标赛树并只重赛输给冠军、亚军的专业，比淘汰赛多几次比较，得到有序的前三名"
+    SIMULATION_TRIALS = 200
+
+    def replay(self, rounds: Sequence[Round]) -> Top3Selection:
+        selection = Top3Selection(MAJOR_TREE)
+        for round in rounds:
+            selection.feed(get_round_result(round))
+        return selection
+
+    def next_round_majors(self, rounds: Sequence[Round]) -> list[str]:
+        return self.replay(rounds).candidates
+
+    def final_majors(self, rounds: Sequence[Round]) -> list[str]:
+        selection = self.replay(rounds)
+        # 冠军类别的专业不足三个时，用直接输给冠军类别的类别补足
+        final_majors = list(dict.fromkeys(selection.podium + selection.category_runner_ups))
+        return final_majors[:3]
+
+    def level_comparisons(self, n: int, final_level: bool, group_size: int = 2) -> float:
+        if not final_level:
+            return knockout_screens(n, group_size)
+        return simulated_level_comparisons(n, self.SIMULATION_TRIALS, group_size)
+
+def knockout_screens(n: int, group_size: int = 2) -> int:
+    """n 个专业按 group_size 分组反复淘汰直到剩下一个需要的画面数；两两比较时即 n - 1"""
+    screens = 0
+    while n > 1:
+        groups = -(-n // group_size)
+        screens += groups - (1 if n % group_size == 1 else 0)
+        n = groups
+    return screens
+
+def simulate_round(candidates: Sequence[str], rank: dict[str, int], rng: random.Random, group_size: int = 2) -> RoundResult:
+    """与 CreateRound 相同的排阵方式（随机打乱后按 group_size 分组，最后剩一个时轮空），按 rank 从小到大决定胜负"""
+    groups, byes = split_into_groups(rng.sample(list(candidates), len(candidates)), group_size)
+    result = RoundResult(winners=[], screens=len(groups))
+    for group in groups:
+        winner = min(group, key=rank.__getitem__)
+        result.winners.append(winner)
+        result.comparisons.extend((winner, loser) for loser in group if loser != winner)
+    result.winners.extend(byes)
+    return result
+
+def simulate_selection(major_tree: dict[str, list[str]], rank: dict[str, int], rng: random.Random,
+                       group_size: int = 2) -> tuple[int, Top3Selection]:
+    """用给定的偏好顺序走完一次 top-3 选择，返回比较（画面）次数和最终状态"""
+    selection = Top3Selection(major_tree)
+    screens = 0
+    while not selection.finished:
+        result = simulate_round(selection.candidates, rank, rng, group_size)
+        screens += result.screens
+        selection.feed(result)
+    return screens, selection
+
+@lru_cache(maxsize=None)
+def simulated_level_comparisons(n: int, trials: int, group_size: int = 2) -> float:
+    """n 个专业中选出有序前三名的平均画面数，偏好顺序和排阵都随机，固定随机种子保证结果可复现"""
+    if n < 2:
+        return 0.0
+    rng = random.Random(n)
+    majors = [f"major-{i}" for i in range(n)]
+    counts = []
+    for _ in range(trials):
+        rank = {major: position for position, major in enumerate(rng.sample(majors, n))}
+        screens, _ = simulate_selection({"category": majors}, rank, rng, group_size)
+        counts.append(screens)
+    return mean(counts)
+
+def top3_comparisons_lower_bound(n: int) -> int:
+    """最坏情况下选出有序前三名至少需要的比较次数（Kislitsyn 下界 n - 3 + ⌈log2 n(n-1)⌉）"""
+    if n < 3:
+        return max(n - 1, 0)
+    return n - 3 + math.ceil(math.log2(n * (n - 1)))
+
+PAIRING_STRATEGIES: dict[str, PairingStrategy] = {
+    strategy.name: strategy for strategy in (KnockoutStrategy(), Top3SelectionStrategy())
+}
+
+if PAIRING_STRATEGY not in PAIRING_STRATEGIES:
+    logger.warning(f"未知的配对策略 {PAIRING_STRATEGY}，使用 knockout")
+default_strategy = PAIRING_STRATEGIES.get(PAIRING_STRATEGY, PAIRING_STRATEGIES["knockout"])
+
+def get_strategy(session: Session) -> PairingStrategy:
+    """会话创建时记录的策略；旧会话没有记录，按原来的淘汰赛处理"""
+    return PAIRING_STRATEGIES.get(session.pairing_strategy or "knockout", default_strategy)
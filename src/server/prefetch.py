@@ -0,0 +1,131 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Set, Tuple
+
+from loguru import logger
+
+from config import PREFETCH_ENABLED, PREFETCH_MAX_CONCURRENCY, PREFETCH_TTL
+from llm import MajorsReveal, gen_majors_reveal
+from llm_scheduler import LLMPriority, set_llm_context
+from deadline import request_deadline
+from tracing import current_span
+
+@dataclass
+class PrefetchEntry:
+    round_id: str
+    infos: str
+    majors: List[str]
+    task: asyncio.Task
+    created_at: float = field(default_factory=time.time)
+
+class RevealPrefetcher:
+    """
+    在学生做选择的同时，预先生成本轮下一组专业的揭示
+
+    每个会话最多保留一个预取结果：
+    - schedule: 返回一组专业后，在后台生成本轮下一组专业的揭示
+    - take: 生成下一组专业时优先使用预取结果，只要预取的专业都仍未出场且轮次未变
+    - cancel: 会话进入新一轮或结束时取消尚未使用的预取
+
+    预取以 BACKGROUND 优先级排队；take 时预取还没完成就直接等待它，不再发出新的调用。
+    等待用 asyncio.shield 包住，请求被取消时预取继续运行并放回，客户端重试时仍可使用
+    """
+    def __init__(self, max_concurrency: int, ttl: int):
+        self.max_concurrency = max_concurrency
+        self.ttl = ttl
+        self._entries: dict[str, PrefetchEntry] = {}
+        self.counters = {
+            "scheduled": 0,
+            "used": 0,
+            "wasted": 0,
+            "failed": 0,
+            "skipped_busy": 0,
+        }
+
+    def _in_flight(self) -> int:
+        return sum(1 for entry in self._entries.values() if not entry.task.done())
+
+    def _discard(self, session_id: str, reason: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return
+        if not entry.task.done():
+            entry.task.cancel()
+        self.counters["wasted"] += 1
+        logger.debug(f"[prefetch] 丢弃会话 {session_id} 的预取 {entry.majors}，原因: {reason}")
+
+    def _prune(self):
+        now = time.time()
+        for session_id, entry in list(self._entries.items()):
+            if now - entry.created_at > self.ttl:
+                self._discard(session_id, "expired")
+
+    def schedule(self, session_id: str, round_id: str, infos: str, majors: List[str]):
+        """在后台生成本轮下一组专业的揭示"""
+        if not PREFETCH_ENABLED:
+            return
+        self._discard(session_id, "rescheduled")
+        self._prune()
+        if self._in_flight() >= self.max_concurrency:
+            self.counters["skipped_busy"] += 1
+            logger.debug(f"[prefetch] 并发预取已达上限 {self.max_concurrency}，跳过会话 {session_id}")
+            return
+
+        task = asyncio.create_task(self._generate(infos, majors))
+        task.add_done_callback(self._on_done)
+        self._entries[session_id] = PrefetchEntry(round_id=round_id, infos=infos, majors=majors, task=task)
+        self.counters["scheduled"] += 1
+        logger.debug(f"[prefetch] 会话 {session_id} 预取 {majors}")
+
+    async def _generate(self, infos: str, majors: List[str]) -> MajorsReveal:
+        set_llm_context(priority=LLMPriority.BACKGROUND)
+        # 预取比触发它的请求活得更久，不受该请求的时间预算约束，也不记入它的 trace
+        request_deadline.set(None)
+        current_span.set(None)
+        return await gen_majors_reveal(infos, majors)
+
+    def _on_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.counters["failed"] += 1
+            logger.warning(f"[prefetch] 预取失败: {task.exception()}")
+
+    async def take(self, session_id: str, round_id: str, unappear_majors: Set[str]) -> Optional[Tuple[List[str], MajorsReveal]]:
+        """取出可用的预取结果，返回 (专业列表, 揭示)，不可用时返回 None"""
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return None
+        if entry.round_id != round_id or not set(entry.majors) <= unappear_majors:
+            self._entries[session_id] = entry
+            self._discard(session_id, "stale")
+            return None
+        try:
+            reveal = await asyncio.shield(entry.task)
+        except asyncio.CancelledError:
+            if not entry.task.cancelled():
+                self._entries.setdefault(session_id, entry)
+                raise
+            self.counters["wasted"] += 1
+            return None
+        except Exception:
+            self.counters["wasted"] += 1
+            return None
+        self.counters["used"] += 1
+        logger.debug(f"[prefetch] 会话 {session_id} 使用预取 {entry.majors}")
+        return entry.majors, reveal
+
+    def cancel(self, session_id: str):
+        self._discard(session_id, "session moved on")
+
+    def stats(self) -> dict:
+        finished = self.counters["used"] + self.counters["wasted"]
+        return {
+            **self.counters,
+            "in_flight": self._in_flight(),
+            "pending": len(self._entries),
+            "use_rate": self.counters["used"] / finished if finished else 0.0,
+        }
+
+reveal_prefetcher = RevealPrefetcher(max_concurrency=PREFETCH_MAX_CONCURRENCY, ttl=PREFETCH_TTL)
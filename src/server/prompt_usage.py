@@ -0,0 +1,68 @@
+from typing import Any
+
+from loguru import logger
+
+def cached_tokens(usage: Any) -> int:
+    """
+    usage 中命中上游前缀缓存的 prompt token 数
+
+    OpenAI 兼容接口放在 prompt_tokens_details.cached_tokens，DeepSeek 放在 prompt_cache_hit_tokens，都没有时为 0
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        cached = details.get("cached_tokens")
+    else:
+        cached = getattr(details, "cached_tokens", None)
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+        if cached is None:
+            cached = (getattr(usage, "model_extra", None) or {}).get("prompt_cache_hit_tokens")
+    return int(cached or 0)
+
+class PromptUsage:
+    """
+    按任务统计每次调用的 prompt、命中前缀缓存的 prompt 和 completion token 数
+
+    prompt 按静态前缀、会话块、调用后缀排布后，同一会话的后续调用应当命中前缀缓存，
+    cache_hit_ratio 用来确认这一点；调用统计按 prompt 版本分开，切换版本前后可以直接对比
+    """
+    def __init__(self):
+        self.counters: dict[tuple[str, str], dict[str, float]] = {}
+
+    def record(self, kind: str, version: str, usage: Any, latency: float, stream: bool = False):
+        counters = self.counters.setdefault((kind, version), {
+            "calls": 0, "calls_without_usage": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "latency_sum": 0.0,
+        })
+        counters["calls"] += 1
+        counters["latency_sum"] += latency
+        if usage is None:
+            # 上游不支持在流式响应中返回 usage
+            counters["calls_without_usage"] += 1
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        cached = cached_tokens(usage)
+        counters["prompt_tokens"] += prompt_tokens
+        counters["cached_tokens"] += cached
+        counters["completion_tokens"] += completion_tokens
+        logger.debug(f"[prompt_usage] {kind} {version}{' stream' if stream else ''}: prompt={prompt_tokens} cached={cached} "
+                     f"completion={completion_tokens} latency={latency:.2f}s")
+
+    @staticmethod
+    def _summary(counters: dict[str, float]) -> dict:
+        with_usage = counters["calls"] - counters["calls_without_usage"]
+        return {
+            **{key: value for key, value in counters.items() if key != "latency_sum"},
+            "avg_prompt_tokens": counters["prompt_tokens"] / with_usage if with_usage else None,
+            "avg_completion_tokens": counters["completion_tokens"] / with_usage if with_usage else None,
+            "cache_hit_ratio": counters["cached_tokens"] / counters["prompt_tokens"] if counters["prompt_tokens"] else None,
+            "avg_latency_seconds": counters["latency_sum"] / counters["calls"] if counters["calls"] else None,
+        }
+
+    def stats(self) -> list[dict]:
+        return [
+            {"kind": kind, "prompt_version": version, **self._summary(counters)}
+            for (kind, version), counters in sorted(self.counters.items())
+        ]
+
+prompt_usage = PromptUsage()
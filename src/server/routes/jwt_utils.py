@@ -1,39 +1,171 @@
 import asyncio
+import hashlib
 import secrets
 import time
-import requests
+from collections import OrderedDict
+from typing import Any, Optional
+import jwt
+import httpx
+from cryptography.x509 import load_pem_x509_certificate
 
 from fastapi import Depends, HTTPException, status, APIRouter
 from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer
+from loguru import logger
 
 from config import CASDOOR_APP_NAME, CASDOOR_CLIENT_ID, CASDOOR_CLIENT_SECRET, CASDOOR_ENDPOINT, \
-    CASDOOR_ORGANIZATION_NAME, CASDOOR_REDIRECT_URI, CASDOOR_TOKEN_ENDPOINT
+    CASDOOR_ORGANIZATION_NAME, CASDOOR_REDIRECT_URI, CASDOOR_TOKEN_ENDPOINT, \
+    CASDOOR_JWKS_URL, CASDOOR_CERTIFICATE, JWKS_REFRESH_INTERVAL, USER_CACHE_TTL, USER_CACHE_SIZE
 from schemas import CallbackRequest, TokenResponse, UserInfo
+from http_client import casdoor_request
+from tracing import set_attributes, traced
 
 SESSION_STATE_EXPIRATION_TIME = 600
+JWKS_MIN_REFRESH_INTERVAL = 60  # 遇到未知 kid 时两次拉取 JWKS 的最小间隔（秒）
+JWT_ALGORITHMS = ["RS256", "RS384", "RS512", "ES256", "ES384", "ES512"]
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=CASDOOR_TOKEN_ENDPOINT)
 jwt_router = APIRouter()
 session_states = {} 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInfo:
+class UserCache:
+    """按 token 哈希缓存 UserInfo，带过期时间和容量上限"""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, UserInfo]] = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def get(self, token_hash: str) -> Optional[UserInfo]:
+        entry = self._entries.get(token_hash)
+        if entry is None or entry[0] < time.time():
+            self._entries.pop(token_hash, None)
+            self.counters["misses"] += 1
+            return None
+        self._entries.move_to_end(token_hash)
+        self.counters["hits"] += 1
+        return entry[1]
+
+    def set(self, token_hash: str, user: UserInfo, expires_at: float):
+        self._entries[token_hash] = (expires_at, user)
+        self._entries.move_to_end(token_hash)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+user_cache = UserCache(USER_CACHE_SIZE)
+user_lookups: dict[str, asyncio.Task] = {}  # 正在进行的用户查询，相同 token 的并发请求共用一个
+signing_keys: dict[Optional[str], Any] = {}  # kid -> 公钥，单独配置的证书没有 kid
+signing_keys_refreshed_at = 0.0
+
+async def refresh_signing_keys():
+    """加载 Casdoor 的签名公钥：优先使用配置的证书，否则拉取 JWKS"""
+    global signing_keys, signing_keys_refreshed_at
+    signing_keys_refreshed_at = time.time()
+    if CASDOOR_CERTIFICATE:
+        certificate = load_pem_x509_certificate(CASDOOR_CERTIFICATE.replace("\\n", "\n").encode())
+        signing_keys = {None: certificate.public_key()}
+        return
     try:
-        response = await asyncio.to_thread(requests.get, f"{CASDOOR_ENDPOINT}/api/user", 
-                                             headers={"Authorization": f"Bearer {token}"})
-        
+        response = await casdoor_request("GET", CASDOOR_JWKS_URL)
         response.raise_for_status()
-        # 将响应转换为 JSON，并创建 UserInfoResponse 对象
-        user_data = response.json()
-        return UserInfo(
-            id=user_data["id"],
-            name=user_data["name"],
-            email=user_data["email"],
-            email_verified_at=user_data["email_verified_at"],
-            created_at=user_data["created_at"],
-            updated_at=user_data["updated_at"]
-        )
-    except requests.exceptions.HTTPError as e:
+        keys = {}
+        for jwk in response.json().get("keys", []):
+            try:
+                keys[jwk.get("kid")] = jwt.PyJWK(jwk).key
+            except jwt.PyJWKError as e:
+                logger.warning(f"忽略无法解析的 JWK {jwk.get('kid')}: {e}")
+        signing_keys = keys
+        logger.info(f"已加载 {len(keys)} 个 Casdoor 签名公钥")
+    except Exception as e:
+        logger.warning(f"拉取 Casdoor JWKS 失败，将回退到远程校验: {e}")
+
+async def refresh_signing_keys_periodically():
+    # 定期刷新签名公钥，以便 Casdoor 轮换证书后仍能本地校验
+    while True:
+        await refresh_signing_keys()
+        await asyncio.sleep(JWKS_REFRESH_INTERVAL)
+
+async def verify_token_locally(token: str) -> Optional[dict]:
+    """
+    用缓存的公钥校验 JWT，返回其中的声明
+
+    token 不是 JWT（如 Casdoor 签发的不透明 access token）时返回 None；
+    kid 未知时（最多每 JWKS_MIN_REFRESH_INTERVAL 秒）重新拉取一次公钥，仍未知则返回 None，
+    由调用方回退到远程校验；签名错误或已过期时抛出 jwt.InvalidTokenError。
+    """
+    try:
+        kid = jwt.get_unverified_header(token).get("kid")
+    except jwt.DecodeError:
+        return None
+    key = signing_keys.get(kid) or signing_keys.get(None)
+    if key is None and time.time() - signing_keys_refreshed_at > JWKS_MIN_REFRESH_INTERVAL:
+        await refresh_signing_keys()
+        key = signing_keys.get(kid) or signing_keys.get(None)
+    if key is None:
+        return None
+    return jwt.decode(
+        token,
+        key=key,
+        algorithms=JWT_ALGORITHMS,
+        audience=CASDOOR_CLIENT_ID,
+        options={"verify_aud": bool(CASDOOR_CLIENT_ID)},
+    )
+
+def user_from_claims(claims: dict) -> UserInfo:
+    return UserInfo(
+        id=claims.get("id") or claims["sub"],
+        name=claims.get("name", ""),
+        email=claims.get("email", ""),
+        email_verified_at=str(claims.get("email_verified_at") or claims.get("emailVerified", "")),
+        created_at=claims.get("created_at") or claims.get("createdTime", ""),
+        updated_at=claims.get("updated_at") or claims.get("updatedTime", ""),
+    )
+
+async def fetch_remote_user(token: str) -> UserInfo:
+    response = await casdoor_request("GET", f"{CASDOOR_ENDPOINT}/api/user", 
+                                     headers={"Authorization": f"Bearer {token}"})
+    
+    response.raise_for_status()
+    # 将响应转换为 JSON，并创建 UserInfoResponse 对象
+    user_data = response.json()
+    return UserInfo(
+        id=user_data["id"],
+        name=user_data["name"],
+        email=user_data["email"],
+        email_verified_at=user_data["email_verified_at"],
+        created_at=user_data["created_at"],
+        updated_at=user_data["updated_at"]
+    )
+
+async def resolve_user(token: str) -> tuple[UserInfo, float]:
+    """校验 token 并返回 (用户信息, 缓存过期时间)，本地无法校验时才请求 Casdoor"""
+    expires_at = time.time() + USER_CACHE_TTL
+    claims = await verify_token_locally(token)
+    if claims is not None and (claims.get("id") or claims.get("sub")):
+        if "exp" in claims:
+            expires_at = min(expires_at, float(claims["exp"]))
+        return user_from_claims(claims), expires_at
+    logger.debug("本地无法校验 token，回退到 Casdoor 远程校验")
+    return await fetch_remote_user(token), expires_at
+
+@traced()
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInfo:
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    user = user_cache.get(token_hash)
+    if user is not None:
+        set_attributes(cache="hit")
+        return user
+    set_attributes(cache="miss", shared_lookup=token_hash in user_lookups)
+    
+    try:
+        lookup = user_lookups.get(token_hash)
+        if lookup is None:
+            lookup = asyncio.create_task(resolve_user(token))
+            user_lookups[token_hash] = lookup
+            lookup.add_done_callback(lambda _: user_lookups.pop(token_hash, None))
+        user, expires_at = await asyncio.shield(lookup)
+        user_cache.set(token_hash, user, expires_at)
+        return user
+    except (jwt.InvalidTokenError, httpx.HTTPStatusError) as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
@@ -45,15 +177,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserInfo:
             detail=f"Internal Server Error: {str(e)}",
         )
 
-def requests_get_token(token_endpoint, token_params, headers):
-    try:
-        response = requests.post(token_endpoint, data=token_params, headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.HTTPError as e:
-        raise e
-    except Exception as e:
-        raise e
+async def request_token(token_endpoint, token_params, headers):
+    response = await casdoor_request("POST", token_endpoint, data=token_params, headers=headers)
+    response.raise_for_status()
+    return response.json()
     
 @jwt_router.post("/login")
 async def login_with_casdoor() -> str:
@@ -110,10 +237,10 @@ async def casdoor_callback(callback: CallbackRequest) -> TokenResponse:
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
     try:
-        token_data = await asyncio.to_thread(requests_get_token, token_endpoint, token_params, headers)
+        token_data = await request_token(token_endpoint, token_params, headers)
         return token_data
 
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         return JSONResponse(content={"error": f"Failed to get token from Casdoor: {e}"}, status_code=400)
     except Exception as e:
         return JSONResponse(content={"error": f"Internal server error during token exchange: {e}"}, status_code=500)
@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
 import random
 import json
 
-from database.models import SessionStatus, RoundStatus, Round
+from database.models import ChoiceAppearance, SessionStatus, RoundStatus, Round
 from database.base import get_db
 from database.crud import (
     UpdateSession, CreateRound, UpdateRound, 
@@ -15,56 +16,72 @@ from database.crud import (
 from database.unit_of_work import UnitOfWork
 from .jwt_utils import get_current_user
 from schemas import UserInfo, Report, MajorChoiceRequest, PostChoicesResponse, GetChoicesResponse, GetRoundResponse, GenerrateType, ChoiceResponse
-from llm import gen_majors_reveal, gen_wisdom_report
-from config import MAJOR_TREE
+from llm import MajorsReveal, gen_round_reveals, llm_cache, prompt_layout
+from llm_scheduler import LLMPriority, llm_scheduler, set_llm_context
+from tracing import set_trace_attributes, trace_exporter
+from hedging import reveal_hedger
+from llm_router import llm_router
+from model_tiers import model_tiers
+from common import retry_budget
+from prompt_usage import prompt_usage
+from usage_ledger import set_usage_context, usage_ledger
+from prefetch import reveal_prefetcher
+from http_client import pool_stats
+from .streaming import emit_majors_reveal, reveal_majors, report_wisdom, sse_response
+from pairing import PAIRING_STRATEGIES, default_strategy, get_next_majors, get_strategy
+from config import COMPARISON_SIZE, ROUND_BATCH_ENABLED, LLM_USAGE_ENDPOINTS_ENABLED, TRACING_ENDPOINTS_ENABLED
 
-def get_next_majors(major_name: str) -> list[str]:
-    """返回给定专业的子专业列表，如果没有则返回空列表"""
-    return MAJOR_TREE.get(major_name, [])
+def get_unappear_majors(round: Round) -> set[str]:
+    """返回本轮尚未完成比较的专业"""
+    appeared_majors = {choice.major_name for choice in round.appearances if choice.is_winner_in_comparison is not None}
+    return set(round.current_round_majors) - appeared_majors
 
-def get_winners_and_next_majors(round: Round) -> tuple[list[str], list[str]]:
-    """
-    根据当前轮次确定胜出者和下一轮专业
-    
-    Args:
-        round: 当前轮次对象
-        
-    Returns:
-        tuple: (胜出者列表, 下一轮专业列表)
-            - 如果有唯一胜出者且有子专业，返回 ([胜出者], [子专业列表])
-            - 如果有唯一胜出者但无子专业，返回 ([胜出者], [])
-            - 如果有多个胜出者，返回 ([胜出者列表], [胜出者列表])
-    """
-    # 获取当前轮次的胜出者（包括明确标记为胜出的和轮空晋级的）
-    # 1. 获取已明确标记为胜出的专业
-    explicit_winners = [choice.major_name for choice in round.appearances if choice.is_winner_in_comparison is True]
-    
-    # 2. 获取所有已参与比较的专业
-    compared_majors = {choice.major_name for choice in round.appearances if choice.is_winner_in_comparison is not None}
-    
-    # 3. 获取未参与比较的专业（轮空的）
-    uncompared_majors = set(round.current_round_majors) - compared_majors
-    
-    # 4. 合并明确胜出的和轮空的专业作为最终胜出者
-    winners = explicit_winners + list(uncompared_majors)
-    
-    logger.debug(f"[get_winners_and_next_majors] 当前轮次明确胜出者: {explicit_winners}, 轮空专业: {uncompared_majors}, 最终胜出者: {winners}")
-    
-    # 如果只有一个胜出者，检查是否有子专业
-    if len(winners) == 1:
-        winner = winners[0]
-        child_majors = get_next_majors(winner)
-        logger.debug(f"[get_winners_and_next_majors] 唯一胜出者 {winner} 的子专业: {child_majors}")
-        
-        # 如果有子专业，下一轮使用子专业
-        if child_majors:
-            return winners, child_majors
-        # 如果没有子专业，返回空列表作为下一轮专业，表示应该结束会话
-        return winners, []
-    
-    # 如果有多个胜出者，下一轮使用这些胜出者
-    logger.debug(f"[get_winners_and_next_majors] 多个胜出者: {winners}，下一轮将继续比较这些专业")
-    return winners, winners
+def pick_next_group(round: Round, unappear_majors: set[str]) -> list[str]:
+    """按轮次预排的分组返回下一组专业；没有赛程的旧轮次随机抽取"""
+    for group in round.schedule or []:
+        if set(group) <= unappear_majors:
+            return list(group)
+    return random.sample(sorted(unappear_majors), min(COMPARISON_SIZE, len(unappear_majors)))
+
+def get_stored_reveal(round: Round, majors: list[str]) -> MajorsReveal | None:
+    """从轮次批量生成的揭示中取出这一组专业的描述"""
+    reveals = round.reveals or {}
+    if all(major in reveals for major in majors):
+        return MajorsReveal(descriptions=[reveals[major] for major in majors])
+    return None
+
+def prefetch_next_group(session_id: str, round: Round, infos: str, remaining_majors: set[str]):
+    """下一组专业没有批量生成的揭示时，在后台预取"""
+    if len(remaining_majors) < 2:
+        return
+    next_majors = pick_next_group(round, remaining_majors)
+    if get_stored_reveal(round, next_majors) is None:
+        reveal_prefetcher.schedule(session_id, round.uuid, infos, next_majors)
+
+def build_choices(round_id: str, session_id: str, majors: list[str], majors_reveal: MajorsReveal, appearance_index: int) -> list[CreateChoice]:
+    """一个画面中的每个专业各一条出场记录，出场序号连续"""
+    return [
+        CreateChoice(
+            round_id=round_id,
+            session_id=session_id,
+            major_name=major_name,
+            description=description,
+            appearance_index=appearance_index + offset
+        )
+        for offset, (major_name, description) in enumerate(zip(majors, majors_reveal.descriptions))
+    ]
+
+def to_choice_responses(choices: list[ChoiceAppearance]) -> list[ChoiceResponse]:
+    return [
+        ChoiceResponse(
+            major_id=choice.uuid,
+            major_name=choice.major_name,
+            description=choice.description,
+            appearance_index=choice.appearance_index,
+            is_winner_in_comparison=choice.is_winner_in_comparison
+        )
+        for choice in choices
+    ]
 
 options_router = APIRouter()
 
@@ -82,9 +99,13 @@ async def post_choices(session_id: str,
                 generate_type=GenerrateType.ROUND
             )
         
-        update_choice_1, update_choice_2 = (UpdateChoice(uuid=choices.choices[0].major_id, is_winner_in_comparison=choices.choices[0].is_winner_in_comparison), 
-                                            UpdateChoice(uuid=choices.choices[1].major_id, is_winner_in_comparison=choices.choices[1].is_winner_in_comparison))
-        await update_choices(db, (update_choice_1, update_choice_2))
+        pending_ids = {c.uuid for c in session.rounds[-1].appearances if c.is_winner_in_comparison is None} if session.rounds else set()
+        if not choices.choices or {c.major_id for c in choices.choices} != pending_ids:
+            raise HTTPException(status_code=400, detail="提交的选择必须恰好包含当前画面中的全部专业")
+        await update_choices(db, [
+            UpdateChoice(uuid=choice.major_id, is_winner_in_comparison=choice.is_winner_in_comparison)
+            for choice in choices.choices
+        ])
         
         updated_session = await get_session(db, session_id, user.id)
         last_round = updated_session.rounds[-1]
@@ -139,12 +160,15 @@ async def post_choices(session_id: str,
             generate_type=GenerrateType.CHOICES
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 @options_router.get("/get_choices/{session_id}", response_model=GetChoicesResponse)
 async def get_choices(session_id: str, db: AsyncSession = Depends(get_db), user: UserInfo = Depends(get_current_user), transaction=None) -> GetChoicesResponse:
+    set_llm_context(user_id=user.id, priority=LLMPriority.INTERACTIVE)
     try:
         session = await get_session(db, session_id, user.id, transaction=transaction)
         
@@ -152,78 +176,59 @@ async def get_choices(session_id: str, db: AsyncSession = Depends(get_db), user:
             raise HTTPException(status_code=400, detail="当前会话没有进行中的轮次")
             
         last_round = session.rounds[-1]
+        set_trace_attributes(round_number=last_round.round_number)
+        set_usage_context(session_id, last_round.round_number)
         
         if last_round.status != RoundStatus.ACTIVE:
             raise HTTPException(status_code=400, detail="当前轮次已完成")
         
-        appeared_majors = {choice.major_name for choice in last_round.appearances if choice.is_winner_in_comparison is not None}
-        unappear_majors = set(last_round.current_round_majors) - appeared_majors
+        unappear_majors = get_unappear_majors(last_round)
         
-        logger.debug(f"appeared_majors: {appeared_majors}, unappear_majors: {unappear_majors}")
+        logger.debug(f"unappear_majors: {unappear_majors}")
         
         if len(unappear_majors) < 2:
             raise HTTPException(status_code=400, detail="当前轮次没有足够的专业进行比较")
         
-        major_name_1, major_name_2 = random.sample(list(unappear_majors), 2)
-        
-        major_reveal = await gen_majors_reveal(session.base_information, major_name_1, major_name_2)
-        # major_reveal = MajorsReveal(major_1_description="", major_2_description="") # 测试
+        prefetched = await reveal_prefetcher.take(session_id, last_round.uuid, unappear_majors)
+        if prefetched:
+            majors, major_reveal = prefetched
+            await emit_majors_reveal(majors, major_reveal)
+        else:
+            majors = pick_next_group(last_round, unappear_majors)
+            major_reveal = get_stored_reveal(last_round, majors)
+            if major_reveal:
+                await emit_majors_reveal(majors, major_reveal)
+            else:
+                major_reveal = await reveal_majors(session.base_information, majors)
+        # major_reveal = MajorsReveal(descriptions=["" for _ in majors]) # 测试
         
-        appearance_index = len(last_round.appearances)
-        major_1, major_2 = (
-            CreateChoice(
-                round_id=last_round.uuid, 
-                session_id=session_id, 
-                major_name=major_name_1, 
-                description=major_reveal.major_1_description, 
-                appearance_index=appearance_index
-            ),
-            CreateChoice(
-                round_id=last_round.uuid, 
-                session_id=session_id, 
-                major_name=major_name_2, 
-                description=major_reveal.major_2_description, 
-                appearance_index=appearance_index + 1
-            )
+        new_choices = await create_choices(
+            db, build_choices(last_round.uuid, session_id, majors, major_reveal, len(last_round.appearances)), user.id, transaction=transaction
         )
-        
-        new_choices = await create_choices(db, (major_1, major_2), user.id, transaction=transaction)
-        
-        new_choices_response = (ChoiceResponse(
-            major_id=new_choices[0].uuid,
-            major_name=new_choices[0].major_name,
-            description=new_choices[0].description,
-            appearance_index=new_choices[0].appearance_index,
-            is_winner_in_comparison=None
-        ),
-        ChoiceResponse(
-            major_id=new_choices[1].uuid,
-            major_name=new_choices[1].major_name,
-            description=new_choices[1].description,
-            appearance_index=new_choices[1].appearance_index,
-            is_winner_in_comparison=None
-        ))
+        prefetch_next_group(session_id, last_round, session.base_information, unappear_majors - set(majors))
         
         return GetChoicesResponse(
-            choices=new_choices_response
+            choices=to_choice_responses(new_choices)
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
     
 @options_router.get("/get_round/{session_id}", response_model=GetRoundResponse)
 async def get_round(session_id: str, db: AsyncSession = Depends(get_db), user: UserInfo = Depends(get_current_user), transaction=None) -> GetRoundResponse:
+    set_llm_context(user_id=user.id, priority=LLMPriority.INTERACTIVE)
     try:
         session = await get_session(db, session_id, user.id, transaction=transaction)
         base_info = session.base_information
+        strategy = get_strategy(session)
         next_round_num = 1
-        appearance_index_1 = 0
-        appearance_index_2 = 1
-        current_round_majors = list(MAJOR_TREE.keys())
+        current_round_majors = strategy.next_round_majors([])
         
         if len(session.rounds) >= 1:
             next_round_num = session.current_round_number + 1
-            _, next_majors = get_winners_and_next_majors(session.rounds[-1])
+            next_majors = strategy.next_round_majors(session.rounds)
             
             if next_majors:
                 current_round_majors = next_majors
@@ -231,7 +236,9 @@ async def get_round(session_id: str, db: AsyncSession = Depends(get_db), user: U
                 # 如果没有下一轮专业，这种情况理论上不应该发生，因为应该已经生成报告
                 logger.warning(f"[get_round] 警告：上一轮没有产生下一轮专业，但仍然调用了get_round")
                 winners = [c.major_name for c in session.rounds[-1].appearances if c.is_winner_in_comparison]
-                current_round_majors = winners if winners else list(MAJOR_TREE.keys())
+                current_round_majors = winners if winners else strategy.next_round_majors([])
+        set_trace_attributes(round_number=next_round_num)
+        set_usage_context(session_id, next_round_num)
             
         # 确保 current_round_majors 至少有两个元素，否则无法进行比较
         if len(current_round_majors) < 2:
@@ -239,53 +246,32 @@ async def get_round(session_id: str, db: AsyncSession = Depends(get_db), user: U
             raise HTTPException(status_code=400, detail=f"下一轮专业数量不足，无法进行比较: {current_round_majors}")
             
         round_create = CreateRound(session_id=session_id, round_number=next_round_num, current_round_majors=set(current_round_majors))
+        reveal_prefetcher.cancel(session_id)
+        if ROUND_BATCH_ENABLED:
+            # 整轮分组已排好，一次性（分块并发）生成本轮所有专业的揭示
+            round_create.reveals = await gen_round_reveals(base_info, round_create.schedule)
         session_update = UpdateSession(session_id=session_id, current_round_number=next_round_num)
         new_round = await create_round(db, round_create, transaction=transaction)
         await update_session(db, session_update, transaction=transaction)
         
-        major_name_1, major_name_2 = random.sample(list(current_round_majors), 2)
-        major_reveal = await gen_majors_reveal(base_info, major_name_1, major_name_2)
-        # major_reveal = MajorsReveal(major_1_description="", major_2_description="") # 测试
-        
-        major_1, major_2 = (
-            CreateChoice(
-                round_id=new_round.uuid, 
-                session_id=session_id, 
-                major_name=major_name_1, 
-                description=major_reveal.major_1_description, 
-                appearance_index=appearance_index_1
-            ),
-            CreateChoice(
-                round_id=new_round.uuid, 
-                session_id=session_id, 
-                major_name=major_name_2, 
-                description=major_reveal.major_2_description, 
-                appearance_index=appearance_index_2
-            )
-        )
+        majors = list(round_create.schedule[0])
+        major_reveal = get_stored_reveal(new_round, majors)
+        if major_reveal:
+            await emit_majors_reveal(majors, major_reveal)
+        else:
+            major_reveal = await reveal_majors(base_info, majors)
+        # major_reveal = MajorsReveal(descriptions=["" for _ in majors]) # 测试
         
-        new_choices = await create_choices(db, (major_1, major_2), user.id, transaction=transaction)
+        new_choices = await create_choices(db, build_choices(new_round.uuid, session_id, majors, major_reveal, 0), user.id, transaction=transaction)
+        prefetch_next_group(session_id, new_round, base_info, set(current_round_majors) - set(majors))
         
         return GetRoundResponse(
             current_round_number=next_round_num,
             current_round_majors=list(current_round_majors),
-            choices=(
-                ChoiceResponse(
-                    major_id=new_choices[0].uuid,
-                    major_name=new_choices[0].major_name,
-                    description=new_choices[0].description,
-                    appearance_index=new_choices[0].appearance_index,
-                    is_winner_in_comparison=new_choices[0].is_winner_in_comparison
-                ),
-                ChoiceResponse(
-                    major_id=new_choices[1].uuid,
-                    major_name=new_choices[1].major_name,
-                    description=new_choices[1].description,
-                    appearance_index=new_choices[1].appearance_index,
-                    is_winner_in_comparison=new_choices[1].is_winner_in_comparison
-                )
-            )
+            choices=to_choice_responses(new_choices)
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
@@ -294,26 +280,16 @@ async def get_round(session_id: str, db: AsyncSession = Depends(get_db), user: U
 async def gen_report(session_id: str, user: UserInfo = Depends(get_current_user), db: AsyncSession = Depends(get_db), transaction=None) -> Report:
     """生成最终的报告"""
     logger.info(f"生成用户 {user.id} 的会话 {session_id} 的最终报告")
+    set_llm_context(user_id=user.id, priority=LLMPriority.REPORT)
+    set_usage_context(session_id)
     
     session = await get_session(db, session_id, user.id, transaction=transaction)
     
     if session.status != SessionStatus.FINISHED:
         raise HTTPException(status_code=400, detail="会话未完成，无法生成报告")
+    reveal_prefetcher.cancel(session_id)
     
-    final_majors = []
-    seen_majors = set()
-    
-    for round in reversed(session.rounds):
-        if len(final_majors) >= 3:
-            break
-        
-        for appearance in round.appearances:
-            if appearance.is_winner_in_comparison == True and appearance.major_name not in seen_majors:
-                final_majors.append(appearance.major_name)
-                seen_majors.add(appearance.major_name)
-                
-                if len(final_majors) >= 3:
-                    break
+    final_majors = get_strategy(session).final_majors(session.rounds)
     
     logger.debug(f"final_majors: {final_majors}")
     
@@ -342,7 +318,7 @@ async def gen_report(session_id: str, user: UserInfo = Depends(get_current_user)
     ])
     
     try:
-        wisdom_report = await gen_wisdom_report(student_info, final_majors)
+        wisdom_report = await report_wisdom(student_info, final_majors)
         logger.debug(f"wisdom_report: {wisdom_report}")
         report = Report(
             final_three_majors=wisdom_report.final_three_majors,
@@ -350,17 +326,128 @@ async def gen_report(session_id: str, user: UserInfo = Depends(get_current_user)
             final_recommendation=wisdom_report.final_recommendation
         )
         
-        await update_session(db, UpdateSession(session_id=session_id, current_round_number=session.current_round_number, report=report), transaction=transaction)
+        await update_session(db, UpdateSession(session_id=session_id, 
+                                               current_round_number=session.current_round_number, 
+                                               status=session.status, 
+                                               final_major_name=session.final_major_name, 
+                                               report=report), transaction=transaction)
         
         return Report(
             final_three_majors=wisdom_report.final_three_majors,
             final_three_majors_report=wisdom_report.final_three_majors_report,
             final_recommendation=wisdom_report.final_recommendation
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"生成报告时发生错误: {e}")
         raise HTTPException(status_code=500, detail=f"生成报告失败: {str(e)}")
 
+@options_router.get("/pairing_strategies", response_model=dict)
+async def pairing_strategies() -> dict:
+    """当前部署的默认配对策略，以及各策略预计每个会话需要的比较次数"""
+    return {
+        "default": default_strategy.name,
+        "strategies": [strategy.describe() for strategy in PAIRING_STRATEGIES.values()],
+    }
+
+@options_router.get("/llm_scheduler", response_model=dict)
+async def llm_scheduler_stats() -> dict:
+    """LLM 调用调度器的并发、各优先级的排队深度和排队等待时间，以及专业揭示的对冲情况"""
+    return {**llm_scheduler.stats(), "hedging": reveal_hedger.stats()}
+
+@options_router.get("/prefetch", response_model=dict)
+async def prefetch_stats() -> dict:
+    """揭示预取的已调度、被使用、被浪费、失败和因并发上限跳过的次数，以及进行中的预取和使用率"""
+    return reveal_prefetcher.stats()
+
+@options_router.get("/llm_cache", response_model=dict)
+async def llm_cache_stats() -> dict:
+    """LLM 结果缓存的内存/数据库命中、未命中、淘汰和过期次数，内存中的条目数和命中率"""
+    return llm_cache.stats()
+
+@options_router.get("/casdoor_http", response_model=dict)
+async def casdoor_http_stats() -> dict:
+    """Casdoor 共享连接池的请求数、错误数、进行中的请求和累计耗时，以及当前的连接数和空闲连接数"""
+    return pool_stats()
+
+@options_router.get("/llm_endpoints", response_model=dict)
+async def llm_endpoints_status() -> dict:
+    """各上游的熔断状态、恢复进度、延迟和错误率 EWMA"""
+    return llm_router.stats()
+
+@options_router.get("/llm_tiers", response_model=dict)
+async def llm_tiers_stats() -> dict:
+    """各模型层的调用次数、延迟、token 和花费，以及各任务的端到端延迟、回退次数和平均解析置信度"""
+    return model_tiers.stats()
+
+@options_router.get("/retry_budget", response_model=dict)
+async def retry_budget_stats() -> dict:
+    """重试次数、按原因的分布、因预算不足或 Retry-After 过长而放弃的次数，以及令牌桶的剩余令牌"""
+    return retry_budget.stats()
+
+@options_router.get("/llm_prompts", response_model=dict)
+async def llm_prompts_stats() -> dict:
+    """当前 prompt 版本、各任务静态前缀的长度，以及按任务和 prompt 版本统计的 prompt/前缀缓存命中/completion token"""
+    return {**prompt_layout(), "calls": prompt_usage.stats()}
+
+@options_router.get("/llm_usage", response_model=dict)
+async def llm_usage_stats() -> dict:
+    """LLM 调用明细账的写入统计：已记录、已写入、因缓冲区满或写入失败而丢弃的条数"""
+    return usage_ledger.stats()
+
+if LLM_USAGE_ENDPOINTS_ENABLED:
+    @options_router.get("/llm_usage/sessions", response_model=dict)
+    async def llm_usage_sessions(limit: int = Query(50, ge=1, le=500), user: UserInfo = Depends(get_current_user)) -> dict:
+        """最近有 LLM 调用的会话，每个会话的调用次数、token、花费和平均/最大延迟"""
+        return {"sessions": await usage_ledger.recent_sessions(limit)}
+
+    @options_router.get("/llm_usage/sessions/{session_id}", response_model=dict)
+    async def llm_usage_session(session_id: str, user: UserInfo = Depends(get_current_user)) -> dict:
+        """一个会话的 LLM 花费和延迟，按轮次和按生成函数拆分"""
+        usage = await usage_ledger.session_usage(session_id)
+        if usage is None:
+            raise HTTPException(status_code=404, detail="该会话没有 LLM 调用记录")
+        return usage
+
+    @options_router.get("/llm_usage/daily", response_model=dict)
+    async def llm_usage_daily(days: int = Query(7, ge=1, le=90), user: UserInfo = Depends(get_current_user)) -> dict:
+        """最近若干天每天的 LLM 调用次数、token、花费、平均/最大延迟，以及平均每个会话的花费"""
+        return {"days": await usage_ledger.daily_usage(days)}
+
+if TRACING_ENDPOINTS_ENABLED:
+    @options_router.get("/traces", response_model=dict)
+    async def recent_traces(limit: int = Query(50, ge=1, le=500), min_duration_ms: float = Query(0, ge=0),
+                            user: UserInfo = Depends(get_current_user)) -> dict:
+        """尾部采样保留下来的最近的请求 trace 摘要，以及采样统计"""
+        return {**trace_exporter.stats(), "traces": trace_exporter.recent(limit, min_duration_ms)}
+
+    @options_router.get("/traces/{trace_id}", response_model=dict)
+    async def trace_detail(trace_id: str, user: UserInfo = Depends(get_current_user)) -> dict:
+        """一个 trace 的完整 span 列表，span 通过 parent_id 组成树"""
+        trace = trace_exporter.get(trace_id)
+        if trace is None:
+            raise HTTPException(status_code=404, detail="trace 不存在或已被新的 trace 挤出缓冲区")
+        return trace
+
+@options_router.get("/get_choices_stream/{session_id}")
+async def get_choices_stream(session_id: str, user: UserInfo = Depends(get_current_user)) -> StreamingResponse:
+    """get_choices 的 SSE 版本：每个专业的揭示生成后立即推送 major 事件（同名的以最后一次为准），最后推送 result 事件"""
+    return sse_response(lambda db: get_choices(session_id, db, user))
+
+@options_router.get("/get_round_stream/{session_id}")
+async def get_round_stream(session_id: str, user: UserInfo = Depends(get_current_user)) -> StreamingResponse:
+    """get_round 的 SSE 版本：每个专业的揭示生成后立即推送 major 事件（同名的以最后一次为准），最后推送 result 事件"""
+    return sse_response(lambda db: get_round(session_id, db, user))
+
+@options_router.get("/gen_report_stream/{session_id}")
+async def gen_report_stream(session_id: str, user: UserInfo = Depends(get_current_user)) -> StreamingResponse:
+    """
+    gen_report 的 SSE 版本，依次推送:
+    final_three_majors、每个专业的 major_report、final_recommendation，最后推送 result 事件
+    """
+    return sse_response(lambda db: gen_report(session_id, user, db))
+
 @options_router.post("/save_and_next/{session_id}", response_model=dict)
 async def save_choice_and_generate_next(
     session_id: str, 
@@ -388,51 +475,28 @@ async def save_choice_and_generate_next(
             
             # 步骤2: 保存用户选择
             last_round_before = session.rounds[-1]
+            pending_ids = {c.uuid for c in last_round_before.appearances if c.is_winner_in_comparison is None}
+            if choice_request.choices and {c.major_id for c in choice_request.choices} != pending_ids:
+                raise HTTPException(status_code=400, detail="提交的选择必须恰好包含当前画面中的全部专业")
             logger.debug(f"[save_and_next] 更新前 last_round uuid={last_round_before.uuid}, appearances={last_round_before.appearances}, current_round_majors={last_round_before.current_round_majors}")
             choice_ids = [c.major_id for c in choice_request.choices]
             choice_results = [c.is_winner_in_comparison for c in choice_request.choices]
             logger.debug(f"[save_and_next] 将要更新的 choices: ids={choice_ids}, winners={choice_results}")
             if choice_request.choices:
-                update_choice_1 = UpdateChoice(
-                    uuid=choice_request.choices[0].major_id, 
-                    is_winner_in_comparison=choice_request.choices[0].is_winner_in_comparison
-                )
-                update_choice_2 = UpdateChoice(
-                    uuid=choice_request.choices[1].major_id, 
-                    is_winner_in_comparison=choice_request.choices[1].is_winner_in_comparison
-                )
-                await update_choices(db, (update_choice_1, update_choice_2), transaction=uow.transaction)
+                # 一个画面中的全部专业一起提交：胜者标记为胜出，其余都算输给胜者
+                await update_choices(db, [
+                    UpdateChoice(uuid=choice.major_id, is_winner_in_comparison=choice.is_winner_in_comparison)
+                    for choice in choice_request.choices
+                ], transaction=uow.transaction)
                 logger.debug("[save_and_next] update_choices 执行完毕")
             
             # 步骤3: 获取更新后的会话，判断下一步操作
             updated_session = await get_session(db, session_id, user.id, transaction=uow.transaction)
             last_round = updated_session.rounds[-1]
+            set_trace_attributes(round_number=last_round.round_number)
+            strategy = get_strategy(updated_session)
             
-            # 检查是否需要生成报告（最后一轮）
-            winners, next_majors = get_winners_and_next_majors(last_round)
-            
-            if len(next_majors) == 0:
-                # 无子专业，结束并生成报告
-                await update_session(db, UpdateSession(
-                    session_id=session_id,
-                    current_round_number=last_round.round_number + 1,
-                    status=SessionStatus.FINISHED,
-                    final_major_name=winners[0]
-                ), transaction=uow.transaction)
-                report_response = await gen_report(session_id, user, db, transaction=uow.transaction)
-                return {
-                    "status": "success",
-                    "operation": "GENERATE_REPORT",
-                    "data": report_response
-                }
-            
-            # 辅助函数：获取未出现的专业
-            def get_unappear_majors(round):
-                appeared_majors = {choice.major_name for choice in round.appearances if choice.is_winner_in_comparison is not None}
-                unappear_majors = set(round.current_round_majors) - appeared_majors
-                return unappear_majors
-            
-            # 检查当前轮次是否已完成
+            # 检查当前轮次是否已完成（轮次结束后由配对策略决定生成新一轮还是生成报告）
             unappear_majors = get_unappear_majors(last_round)
             
             # 报错测试
@@ -450,24 +514,24 @@ async def save_choice_and_generate_next(
                         description=f"{remaining_major}轮空晋级",
                         appearance_index=len(last_round.appearances)
                     )
-                    new_choices = await create_choices(db, (auto_win_choice, auto_win_choice), user.id, transaction=uow.transaction)
+                    new_choices = await create_choices(db, [auto_win_choice], user.id, transaction=uow.transaction)
                     logger.debug(f"[save_and_next] create_choices 返回 new_choices uuids={[c.uuid for c in new_choices]}")
                     auto_win_update = UpdateChoice(
                         uuid=new_choices[0].uuid,
                         is_winner_in_comparison=True
                     )
                     logger.debug(f"[save_and_next] auto-win update_choices 将更新 uuid={new_choices[0].uuid}")
-                    await update_choices(db, (auto_win_update, auto_win_update), transaction=uow.transaction)
+                    await update_choices(db, [auto_win_update], transaction=uow.transaction)
                     logger.debug("[save_and_next] auto-win update_choices 执行完毕")
                 
                 # 更新轮次状态
                 round_update = UpdateRound(round_id=last_round.uuid, status=RoundStatus.COMPLETED)
                 await update_round(db, round_update, transaction=uow.transaction)
                 
-                # 获取更新后的轮次，以便确定胜出者和下一步操作
-                updated_round = (await get_session(db, session_id, user.id, transaction=uow.transaction)).rounds[-1]
-                winners, next_majors = get_winners_and_next_majors(updated_round)
-                logger.debug(f"[save_and_next] 轮次完成后，胜出者: {winners}, 下一轮专业: {next_majors}")
+                # 获取更新后的轮次，以便确定下一步操作
+                updated_rounds = (await get_session(db, session_id, user.id, transaction=uow.transaction)).rounds
+                next_majors = strategy.next_round_majors(updated_rounds)
+                logger.debug(f"[save_and_next] 轮次完成后，策略 {strategy.name} 给出的下一轮专业: {next_majors}")
                 
                 # 根据下一轮专业情况决定下一步操作
                 if next_majors:
@@ -480,11 +544,12 @@ async def save_choice_and_generate_next(
                     }
                 else:
                     # 无下一轮专业，结束并生成报告
+                    final_majors = strategy.final_majors(updated_rounds)
                     await update_session(db, UpdateSession(
                         session_id=session_id,
                         current_round_number=last_round.round_number + 1,
                         status=SessionStatus.FINISHED,
-                        final_major_name=winners[0] if winners else None
+                        final_major_name=final_majors[0] if final_majors else None
                     ), transaction=uow.transaction)
                     report_response = await gen_report(session_id, user, db, transaction=uow.transaction)
                     return {
@@ -502,6 +567,8 @@ async def save_choice_and_generate_next(
                 "data": choices_response
             }
         
+        except HTTPException:
+            raise
         except Exception as e:
             # UnitOfWork会自动回滚事务
             logger.error(f"保存选择和生成下一步操作失败: {str(e)}")
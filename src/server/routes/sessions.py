@@ -1,14 +1,20 @@
 import json
-from typing import List
+from typing import List, Optional
 
-from fastapi import Depends, HTTPException, APIRouter
+from fastapi import Depends, HTTPException, APIRouter, Header, Query, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
 
-from database.crud import CreateSession, Session, create_session, get_session, get_sessions
+from config import SESSIONS_PAGE_SIZE, SESSIONS_PAGE_MAX_SIZE
+from database.crud import CreateSession, Session, create_session, get_session, get_session_delta, get_sessions, \
+    list_session_summaries
 from database.base import get_db
+from database.models import SessionStatus
 from routes.jwt_utils import get_current_user
-from schemas import BaseInformation, ChoiceResponse, RoundResponse, SessionResponse, UserInfo
+from schemas import BaseInformation, ChoiceResponse, RoundResponse, SessionDelta, SessionPage, SessionResponse, \
+    SessionWatermark, UserInfo
+from snapshots import SessionSnapshot, etag_matches, session_snapshots
+from pairing import default_strategy
     
 sessions_router = APIRouter()
 
@@ -25,9 +31,12 @@ async def base_information(info: BaseInformation, user: UserInfo = Depends(get_c
     """
     try:
         user_id: str = user.id
-        new_session_info: CreateSession = CreateSession(user_id=user_id, base_information=info)
+        new_session_info: CreateSession = CreateSession(user_id=user_id, base_information=info,
+                                                        pairing_strategy=default_strategy.name)
         new_session:Session = await create_session(db, new_session_info)
         return new_session.uuid
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
@@ -46,21 +55,93 @@ async def sessions_get(user: UserInfo = Depends(get_current_user), db: AsyncSess
         user_id: str = user.id
         sessions_id: str = await get_sessions(db, user_id)
         return sessions_id
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+@sessions_router.get("/sessions/page", response_model=SessionPage)
+async def sessions_page(limit: int = Query(SESSIONS_PAGE_SIZE, ge=1, le=SESSIONS_PAGE_MAX_SIZE),
+                        cursor: Optional[str] = None,
+                        user: UserInfo = Depends(get_current_user),
+                        db: AsyncSession = Depends(get_db)) -> SessionPage:
+    """按创建时间倒序分页拉取这个高中生的会话摘要
+
+    Args:
+        limit (int): 每页的会话数
+        cursor (str, optional): 上一页返回的 next_cursor，不传则从最新的会话开始
+        user (UserInfo, optional): JWT认证的用户信息. Defaults to Depends(get_current_user).
+
+    Returns:
+        SessionPage: 会话摘要（id、状态、当前轮次、最终专业）和下一页的游标
+    """
+    try:
+        return await list_session_summaries(db, user.id, limit, cursor)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 @sessions_router.get("/sessions/{session_id}", response_model=SessionResponse)
-async def session_get(session_id: str, user: UserInfo = Depends(get_current_user), db: AsyncSession = Depends(get_db)) -> SessionResponse:
+async def session_get(session_id: str,
+                      if_none_match: Optional[str] = Header(None),
+                      user: UserInfo = Depends(get_current_user),
+                      db: AsyncSession = Depends(get_db)) -> Response:
     """拉取这个高中生的特定会话的信息
 
+    响应带强 ETag；快照缓存命中时不访问数据库，If-None-Match 与 ETag 一致时返回 304
+
+    Args:
+        session_id (str): 会话 ID
+        if_none_match (str, optional): 客户端缓存的 ETag
+        user (UserInfo, optional): JWT认证的用户信息. Defaults to Depends(get_current_user).
+
+    Returns:
+        Response: 具体的会话信息（SessionResponse 的 JSON）
+    """
+    snapshot = session_snapshots.get(session_id)
+    if snapshot is None or snapshot.user_id != user.id:
+        version = session_snapshots.version(session_id)
+        session_response, finished = await build_session_response(session_id, user, db)
+        snapshot = SessionSnapshot.build(user.id, session_response, finished)
+        session_snapshots.put(session_id, version, snapshot)
+    
+    headers = {"ETag": snapshot.etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, snapshot.etag):
+        session_snapshots.counters["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+@sessions_router.get("/sessions/{session_id}/delta", response_model=SessionDelta)
+async def session_delta_get(session_id: str,
+                            round_number: int = Query(0, ge=0),
+                            appearance_index: int = Query(-1, ge=-1),
+                            user: UserInfo = Depends(get_current_user),
+                            db: AsyncSession = Depends(get_db)) -> SessionDelta:
+    """拉取这个会话在水位线之后的增量
+
     Args:
         session_id (str): 会话 ID
+        round_number (int): 客户端已有的最后一条出场记录所在的轮次，不传表示从头拉取
+        appearance_index (int): 客户端已有的最后一条出场记录的序号
         user (UserInfo, optional): JWT认证的用户信息. Defaults to Depends(get_current_user).
 
     Returns:
-        SessionResponse: 具体的会话信息
+        SessionDelta: 新增或变化的轮次和出场记录，以及下一次请求使用的水位线
     """
+    try:
+        watermark = SessionWatermark(round_number=round_number, appearance_index=appearance_index)
+        return await get_session_delta(db, session_id, user.id, watermark)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+async def build_session_response(session_id: str, user: UserInfo, db: AsyncSession) -> tuple[SessionResponse, bool]:
+    """从数据库加载会话并组装 SessionResponse，同时返回会话是否已结束"""
     try:
         user_id: str = user.id
         
@@ -103,7 +184,9 @@ async def session_get(session_id: str, user: UserInfo = Depends(get_current_user
         
         logger.debug(f"Session {session_id} retrieved successfully: {session_response}")
         
-        return session_response
+        return session_response, status == SessionStatus.FINISHED
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
\ No newline at end of file
@@ -0,0 +1,94 @@
+import asyncio
+import json
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, List, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+from loguru import logger
+
+from database.base import AsyncSessionLocal
+from llm import MajorsReveal, WisdomReport, gen_majors_reveal, gen_wisdom_report, stream_majors_reveal, stream_wisdom_report
+
+EventSink = Callable[[str, Any], Awaitable[None]]
+
+# 当前请求的 SSE 事件出口，非流式请求中为 None
+stream_event_sink: ContextVar[Optional[EventSink]] = ContextVar("stream_event_sink", default=None)
+
+def format_sse(event: str, data: Any) -> str:
+    payload = json.dumps(jsonable_encoder(data), ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+async def emit_event(event: str, data: Any):
+    sink = stream_event_sink.get()
+    if sink is not None:
+        await sink(event, data)
+
+async def emit_majors_reveal(majors: List[str], majors_reveal: MajorsReveal):
+    """把已生成好的揭示（如预取结果）按流式事件的格式推送出去"""
+    for major, description in zip(majors, majors_reveal.descriptions):
+        await emit_event("major", {"name": major, "description": description})
+
+async def reveal_majors(infos: str, majors: List[str]) -> MajorsReveal:
+    """流式请求中边生成边推送 major 事件，否则等同于 gen_majors_reveal"""
+    if stream_event_sink.get() is None:
+        return await gen_majors_reveal(infos, majors)
+    async for event, data in stream_majors_reveal(infos, majors):
+        if event == "done":
+            return data
+        await emit_event(event, data)
+    raise ValueError("流式生成专业揭示没有返回结果")
+
+async def report_wisdom(infos: str, final_majors: List[str]) -> WisdomReport:
+    """流式请求中边生成边推送报告各部分，否则等同于 gen_wisdom_report"""
+    if stream_event_sink.get() is None:
+        return await gen_wisdom_report(infos, final_majors)
+    async for event, data in stream_wisdom_report(infos, final_majors):
+        if event == "done":
+            return data
+        await emit_event(event, data)
+    raise ValueError("流式生成报告没有返回结果")
+
+def sse_response(run: Callable[[AsyncSession], Awaitable[BaseModel]]) -> StreamingResponse:
+    """
+    以 SSE 的形式执行一个路由处理函数
+
+    处理函数在独立的任务中运行，期间通过 emit_event 推送的事件会立即发送给客户端；
+    处理函数返回后发送 result 事件，失败时发送 error 事件。客户端断开时取消处理函数。
+    """
+    async def event_stream():
+        queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+
+        async def sink(event: str, data: Any):
+            await queue.put(format_sse(event, data))
+
+        async def worker():
+            stream_event_sink.set(sink)
+            async with AsyncSessionLocal() as db:
+                try:
+                    result = await run(db)
+                    await queue.put(format_sse("result", result))
+                except HTTPException as e:
+                    await queue.put(format_sse("error", {"status_code": e.status_code, "detail": e.detail}))
+                except Exception as e:
+                    logger.error(f"流式请求处理失败: {e}")
+                    await queue.put(format_sse("error", {"status_code": 500, "detail": "Internal Server Error"}))
+                finally:
+                    await queue.put(None)
+
+        task = asyncio.create_task(worker())
+        try:
+            while (item := await queue.get()) is not None:
+                yield item
+        finally:
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
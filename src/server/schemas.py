@@ -1,6 +1,6 @@
 from enum import Enum
 from typing import List, Optional, Tuple, final
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 
 class GenerrateType(Enum):
     CHOICES = "choices"
@@ -16,7 +16,16 @@ class MajorChoice(BaseModel):
     is_winner_in_comparison: bool
     
 class MajorChoiceRequest(BaseModel):
-    choices: Optional[Tuple[MajorChoice, MajorChoice]] = (None, None)
+    choices: Optional[List[MajorChoice]] = None  # 一个画面中的全部专业，恰好一个胜者
+    
+    @model_validator(mode="after")
+    def check_single_winner(self) -> "MajorChoiceRequest":
+        if self.choices is not None:
+            if len(self.choices) < 2:
+                raise ValueError("每次选择至少包含两个专业")
+            if sum(choice.is_winner_in_comparison for choice in self.choices) != 1:
+                raise ValueError("每次选择必须恰好有一个胜出专业")
+        return self
 
 class TokenResponse(BaseModel):
     access_token: str
@@ -72,13 +81,36 @@ class SessionResponse(BaseModel):
     rounds: List[RoundResponse]
     report: Optional[Report] = None
     
+class SessionWatermark(BaseModel):
+    round_number: int = 0
+    appearance_index: int = -1  # 默认值表示客户端还没有任何记录
+
+class SessionDelta(BaseModel):
+    status: str
+    current_round_number: int
+    final_major_name: Optional[str] = None
+    rounds: List[RoundResponse]  # 只包含水位线所在及之后的轮次，appearances 只包含新增或可能变化的记录
+    report: Optional[Report] = None  # 只在会话结束后返回
+    watermark: SessionWatermark
+
+class SessionSummary(BaseModel):
+    session_id: str
+    status: str
+    current_round_number: int
+    final_major_name: Optional[str] = None
+    created_at: float
+
+class SessionPage(BaseModel):
+    items: List[SessionSummary]
+    next_cursor: Optional[str] = None  # 为空表示已经是最后一页
+
 class PostChoicesResponse(BaseModel):
     generate_type: GenerrateType
     
 class GetChoicesResponse(BaseModel):
-    choices: Tuple[ChoiceResponse, ChoiceResponse]
+    choices: List[ChoiceResponse]
     
 class GetRoundResponse(BaseModel):
     current_round_number: int
     current_round_majors: List[str]
-    choices: Tuple[ChoiceResponse, ChoiceResponse]
\ No newline at end of file
+    choices: List[ChoiceResponse]
\ No newline at end of file
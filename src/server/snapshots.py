@@ -0,0 +1,121 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from pydantic import BaseModel
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session as OrmSession
+from loguru import logger
+
+from config import SESSION_SNAPSHOT_CACHE_SIZE, SESSION_SNAPSHOT_FINISHED_CACHE_SIZE
+
+@dataclass
+class SessionSnapshot:
+    user_id: str
+    body: bytes
+    etag: str
+    finished: bool
+
+    @classmethod
+    def build(cls, user_id: str, response: BaseModel, finished: bool) -> "SessionSnapshot":
+        body = response.model_dump_json().encode()
+        # 强 ETag 取自序列化后的字节，进程重启后同样的内容仍然得到同样的 ETag
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        return cls(user_id=user_id, body=body, etag=etag, finished=finished)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """按 If-None-Match 的语义比较，支持 * 和逗号分隔的多个 ETag，忽略弱校验前缀 W/"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+class SessionSnapshotCache:
+    """
+    GET /api/sessions/{session_id} 序列化结果的快照缓存
+
+    - 进行中和已结束的会话分别放在两个 LRU 中；已结束的会话不会再变化，
+      它的快照一经生成就一直复用，只有重新生成报告这类写操作才会让它失效
+    - crud 的写操作调用 mark_session_changed 让快照立即失效，事务提交后再失效一次，
+      避免并发读取在提交前读到旧数据并写回快照
+    - 每次失效都会递增会话的版本号，put 时版本号已变化的快照直接丢弃
+    """
+    def __init__(self, max_size: int, max_finished_size: int):
+        self.max_size = max_size
+        self.max_finished_size = max_finished_size
+        self._ongoing: OrderedDict[str, SessionSnapshot] = OrderedDict()
+        self._finished: OrderedDict[str, SessionSnapshot] = OrderedDict()
+        self._versions: OrderedDict[str, int] = OrderedDict()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "not_modified": 0,
+            "invalidations": 0,
+            "stale_puts": 0,
+            "evictions": 0,
+        }
+
+    def version(self, session_id: str) -> int:
+        return self._versions.get(session_id, 0)
+
+    def get(self, session_id: str) -> Optional[SessionSnapshot]:
+        for entries in (self._finished, self._ongoing):
+            snapshot = entries.get(session_id)
+            if snapshot is not None:
+                entries.move_to_end(session_id)
+                self.counters["hits"] += 1
+                return snapshot
+        self.counters["misses"] += 1
+        return None
+
+    def put(self, session_id: str, version: int, snapshot: SessionSnapshot):
+        """version 取自开始读取数据库之前，期间会话有写入时不缓存这份快照"""
+        if self.version(session_id) != version:
+            self.counters["stale_puts"] += 1
+            return
+        entries, max_size = (self._finished, self.max_finished_size) if snapshot.finished else (self._ongoing, self.max_size)
+        entries[session_id] = snapshot
+        entries.move_to_end(session_id)
+        while len(entries) > max_size:
+            entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def invalidate(self, session_id: str):
+        self._ongoing.pop(session_id, None)
+        self._finished.pop(session_id, None)
+        self._versions[session_id] = self.version(session_id) + 1
+        self._versions.move_to_end(session_id)
+        while len(self._versions) > self.max_size + self.max_finished_size:
+            self._versions.popitem(last=False)
+        self.counters["invalidations"] += 1
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "ongoing": len(self._ongoing),
+            "finished": len(self._finished),
+        }
+
+session_snapshots = SessionSnapshotCache(max_size=SESSION_SNAPSHOT_CACHE_SIZE,
+                                         max_finished_size=SESSION_SNAPSHOT_FINISHED_CACHE_SIZE)
+
+# 本事务中写过的会话，存放在数据库会话的 info 中，提交或回滚后再统一失效一次
+CHANGED_SESSIONS_KEY = "changed_sessions"
+
+def mark_session_changed(db: AsyncSession, session_id: str):
+    session_snapshots.invalidate(session_id)
+    db.info.setdefault(CHANGED_SESSIONS_KEY, set()).add(session_id)
+
+@event.listens_for(OrmSession, "after_commit")
+@event.listens_for(OrmSession, "after_rollback")
+def _invalidate_changed_sessions(session: OrmSession):
+    changed = session.info.pop(CHANGED_SESSIONS_KEY, None)
+    if changed:
+        for session_id in changed:
+            session_snapshots.invalidate(session_id)
+        logger.debug(f"[snapshot] 事务结束，失效 {len(changed)} 个会话快照")
@@ -0,0 +1,103 @@
+"""
+测试共用的运行环境，每个测试模块在导入服务端代码之前先导入本模块
+
+config 在导入时读取环境变量和当前目录下的 majors.json，main 挂载当前目录下的 dist，
+所以这里先切换到一个临时目录并设置好环境变量；discover 在同一个进程中导入所有测试模块，
+各模块看到的是同一份配置。上游和 Casdoor 指向不可达的本地端口，LLM 调用由 FakeCompletions 接管。
+"""
+import asyncio
+import atexit
+import os
+import re
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parents[3]
+WORKDIR = Path(tempfile.mkdtemp(prefix="takeone-test-"))
+
+shutil.copy(ROOT / "majors.json", WORKDIR / "majors.json")
+(WORKDIR / "dist").mkdir()
+os.chdir(WORKDIR)
+os.environ.update(
+    BASE_URL="http://127.0.0.1:9/v1",
+    API_KEY="test",
+    SECRET_KEY="test",
+    CASDOOR_ENDPOINT="http://127.0.0.1:9",
+    CASDOOR_TOKEN_ENDPOINT="http://127.0.0.1:9/token",
+    PREFETCH_ENABLED="false",
+    LLM_CACHE_ENABLED="false",
+    LLM_USAGE_ENABLED="false",
+    WRITE_QUEUE_ENABLED="false",
+    PAIRING_STRATEGY="knockout",
+)
+sys.path.insert(0, str(ROOT / "src" / "server"))
+
+@atexit.register
+def _cleanup():
+    os.chdir(ROOT)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+from loguru import logger
+
+logger.remove()
+
+BASE_INFORMATION = {
+    "max_living_expenses_from_parents": "1500",
+    "enough_savings_for_college": "是",
+    "pocket_money_usage": "买书和吃饭",
+    "willing_to_repeat_high_school_for_money": "否",
+    "city_tier": "二线",
+    "parents_in_public_sector": "否",
+    "has_stable_hobby": "是",
+    "self_learning_after_gaokao": "是",
+    "proactive_in_competitions": "否",
+    "likes_reading_extracurricular_books": "是",
+}
+
+class FakeCompletions:
+    """按 prompt 中要揭示的专业生成固定的揭示，报告返回固定的三个专业"""
+    async def create(self, model=None, messages=None, stream=False, **kwargs):
+        text = "\n".join(message["content"] for message in messages)
+        if "<Report>" in text:
+            content = ("<Report><FinalThreeMajors>a, b, c</FinalThreeMajors><ThreeMajorsReport>"
+                       + "".join(f"<Major><Name>{name}</Name><Description>{name}</Description></Major>" for name in "abc")
+                       + "</ThreeMajorsReport><FinalRecommendation>推荐</FinalRecommendation></Report>")
+        else:
+            majors = [major.strip() for major in re.findall(r"你要揭示的专业：\s*\n(.+)", text)[-1].split(",")]
+            content = "<Majors>" + "".join(f"<Major><Name>{major}</Name><Description>{major}的介绍</Description></Major>"
+                                           for major in majors) + "</Majors>"
+        if stream:
+            async def chunks():
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))], usage=None)
+            return chunks()
+        await asyncio.sleep(0)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+def install_fake_llm():
+    from llm_router import llm_router
+
+    for endpoint in llm_router.endpoints:
+        endpoint.client.chat.completions = FakeCompletions()
+
+def choose(choices: list[dict]) -> list[dict]:
+    """为 save_and_next 返回的一个画面选出胜者：子专业多的类别胜出，会话会多走几轮；只有一个子专业的类别无法继续比较，避开它"""
+    from config import MAJOR_TREE
+
+    winner = max(range(len(choices)), key=lambda index: len(MAJOR_TREE.get(choices[index]["major_name"], [])))
+    return [{"major_id": choice["major_id"], "is_winner_in_comparison": index == winner} for index, choice in enumerate(choices)]
+
+def fake_user():
+    from schemas import UserInfo
+
+    return UserInfo(id="test-user", name="test", email="test@example.com", email_verified_at="", created_at="", updated_at="")
+
+def api_error(status_code: int, code: str = None, headers: dict = None):
+    """上游返回 status_code 时 OpenAI SDK 抛出的异常，code 对应错误响应中的 error.code"""
+    import httpx
+    import openai
+
+    response = httpx.Response(status_code, headers=headers, request=httpx.Request("POST", "http://127.0.0.1:9/v1/chat/completions"))
+    return openai.APIStatusError(f"HTTP {status_code}", response=response, body={"code": code} if code else None)
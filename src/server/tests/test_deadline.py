@@ -0,0 +1,81 @@
+"""请求截止时间：中间件按请求头或默认值设置预算，预算用完时返回 504，操作的超时不超过剩余预算"""
+import asyncio
+import time
+import unittest
+
+import support
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from config import REQUEST_DEADLINE_HEADER, REQUEST_DEADLINE_MAX_SECONDS, REQUEST_DEADLINE_SECONDS
+from deadline import DeadlineExceeded, DeadlineMiddleware, clip_timeout, remaining, request_deadline, within_deadline
+
+app = FastAPI()
+app.add_middleware(DeadlineMiddleware)
+
+@app.get("/api/remaining")
+@app.get("/api/options/get_choices_stream/remaining")
+@app.get("/remaining")
+async def get_remaining():
+    return {"remaining": remaining()}
+
+@app.get("/api/slow")
+async def slow():
+    await within_deadline(asyncio.sleep(10), what="慢操作")
+
+class DeadlineMiddlewareTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.client = TestClient(app)
+
+    def remaining(self, path: str, budget: str = None):
+        headers = {REQUEST_DEADLINE_HEADER: budget} if budget is not None else {}
+        return self.client.get(path, headers=headers).json()["remaining"]
+
+    def test_default_budget(self):
+        self.assertAlmostEqual(self.remaining("/api/remaining"), REQUEST_DEADLINE_SECONDS, delta=1)
+        # 请求头无效时使用默认预算
+        self.assertAlmostEqual(self.remaining("/api/remaining", "abc"), REQUEST_DEADLINE_SECONDS, delta=1)
+        self.assertAlmostEqual(self.remaining("/api/remaining", "-1"), REQUEST_DEADLINE_SECONDS, delta=1)
+
+    def test_header_budget_is_capped(self):
+        self.assertAlmostEqual(self.remaining("/api/remaining", "5"), 5, delta=1)
+        self.assertAlmostEqual(self.remaining("/api/remaining", str(REQUEST_DEADLINE_MAX_SECONDS * 10)), REQUEST_DEADLINE_MAX_SECONDS, delta=1)
+
+    def test_streams_and_non_api_paths_have_no_default_budget(self):
+        self.assertIsNone(self.remaining("/api/options/get_choices_stream/remaining"))
+        self.assertAlmostEqual(self.remaining("/api/options/get_choices_stream/remaining", "5"), 5, delta=1)
+        self.assertIsNone(self.remaining("/remaining", "5"))
+
+    def test_exhausted_budget_returns_504(self):
+        start = time.monotonic()
+        response = self.client.get("/api/slow", headers={REQUEST_DEADLINE_HEADER: "0.2"})
+        self.assertEqual(response.status_code, 504)
+        self.assertLess(time.monotonic() - start, 5)
+
+class WithinDeadlineTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.token = request_deadline.set(time.monotonic() + 1)
+
+    async def asyncTearDown(self):
+        request_deadline.reset(self.token)
+
+    async def test_clip_timeout(self):
+        self.assertAlmostEqual(clip_timeout(None), 1, delta=0.1)
+        self.assertAlmostEqual(clip_timeout(10), 1, delta=0.1)
+        self.assertEqual(clip_timeout(0.5), 0.5)
+
+    async def test_own_timeout_raises_timeout_error(self):
+        # 操作自己的超时先到，调用方可以回退或重试
+        with self.assertRaises(asyncio.TimeoutError):
+            await within_deadline(asyncio.sleep(10), timeout=0.05)
+
+    async def test_budget_raises_deadline_exceeded(self):
+        with self.assertRaises(DeadlineExceeded):
+            await within_deadline(asyncio.sleep(10), timeout=10)
+        with self.assertRaises(DeadlineExceeded):
+            await within_deadline(asyncio.sleep(0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+"""对冲请求：阈值取最近耗时的分位数且不低于下限，超过阈值才对冲，每分钟的对冲次数受预算限制"""
+import asyncio
+import unittest
+
+import support
+
+from hedging import Hedger
+
+def hedger(**kwargs) -> Hedger:
+    options = dict(enabled=True, quantile=0.9, min_delay=0.05, min_samples=5, budget_per_minute=10)
+    options.update(kwargs)
+    hedger = Hedger(**options)
+    # 预先填入样本，使阈值等于下限
+    hedger._latencies.extend([0.01] * options["min_samples"])
+    return hedger
+
+def attempt(primary_delay: float, hedge_delay: float = 0.0, primary_error: bool = False):
+    calls: list[bool] = []
+    cancelled: list[bool] = []
+
+    async def run(hedge: bool) -> str:
+        calls.append(hedge)
+        try:
+            await asyncio.sleep(hedge_delay if hedge else primary_delay)
+        except asyncio.CancelledError:
+            cancelled.append(hedge)
+            raise
+        if primary_error and not hedge:
+            raise ValueError("primary")
+        return "hedge" if hedge else "primary"
+    return run, calls, cancelled
+
+class HedgerTest(unittest.IsolatedAsyncioTestCase):
+    def test_threshold(self):
+        h = Hedger(enabled=True, quantile=0.5, min_delay=0.2, min_samples=4, budget_per_minute=10)
+        h._latencies.extend([0.1, 0.3, 0.5])
+        self.assertIsNone(h.threshold())
+        h._latencies.append(0.7)
+        self.assertEqual(h.threshold(), 0.5)
+        h._latencies.clear()
+        h._latencies.extend([0.01] * 4)
+        self.assertEqual(h.threshold(), 0.2)
+
+    async def test_fast_call_is_not_hedged(self):
+        h = hedger()
+        run, calls, _ = attempt(0.0)
+        self.assertEqual(await h.run(run), "primary")
+        self.assertEqual(calls, [False])
+        self.assertEqual(h.counters["hedged"], 0)
+
+    async def test_slow_call_is_hedged_and_loser_cancelled(self):
+        h = hedger()
+        run, calls, cancelled = attempt(1.0)
+        self.assertEqual(await h.run(run), "hedge")
+        self.assertEqual(calls, [False, True])
+        await asyncio.sleep(0)
+        self.assertEqual(cancelled, [False])
+        self.assertEqual(h.counters["hedged"], 1)
+        self.assertEqual(h.counters["hedge_wins"], 1)
+
+    async def test_failed_primary_waits_for_hedge(self):
+        h = hedger()
+        run, _, _ = attempt(0.1, hedge_delay=0.1, primary_error=True)
+        self.assertEqual(await h.run(run), "hedge")
+
+    async def test_budget_limits_hedges_per_minute(self):
+        h = hedger(budget_per_minute=1, quantile=0.5)
+        # 对冲请求比原调用更慢，两次都由原调用胜出；第二次超过阈值时预算已经用完，不再对冲
+        for expected_calls in ([False, True], [False]):
+            run, calls, _ = attempt(0.1, hedge_delay=0.5)
+            self.assertEqual(await h.run(run), "primary")
+            self.assertEqual(calls, expected_calls)
+        self.assertEqual(h.counters["hedged"], 1)
+        self.assertEqual(h.counters["budget_exhausted"], 1)
+
+    async def test_disabled(self):
+        h = hedger(enabled=False)
+        run, calls, _ = attempt(0.1)
+        self.assertEqual(await h.run(run), "primary")
+        self.assertEqual(calls, [False])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+"""登录校验：JWT 用缓存的公钥本地校验，不是 JWT 或 kid 未知的 token 回退到 Casdoor 远程校验"""
+import time
+import unittest
+
+import support
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+
+from routes import jwt_utils
+
+PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+OTHER_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+def token(key=PRIVATE_KEY, **claims) -> str:
+    payload = {"sub": "local-user", "name": "local", "exp": time.time() + 3600, **claims}
+    return jwt.encode(payload, key, algorithm="RS256")
+
+class GetCurrentUserTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.saved = jwt_utils.signing_keys, jwt_utils.signing_keys_refreshed_at, jwt_utils.fetch_remote_user
+        jwt_utils.signing_keys = {None: PRIVATE_KEY.public_key()}
+        jwt_utils.signing_keys_refreshed_at = time.time()
+        self.remote_tokens: list[str] = []
+
+        async def fetch_remote_user(token: str):
+            self.remote_tokens.append(token)
+            return support.fake_user()
+        jwt_utils.fetch_remote_user = fetch_remote_user
+
+    async def asyncTearDown(self):
+        jwt_utils.signing_keys, jwt_utils.signing_keys_refreshed_at, jwt_utils.fetch_remote_user = self.saved
+
+    async def test_jwt_is_verified_locally_and_cached(self):
+        local = token()
+        self.assertEqual((await jwt_utils.get_current_user(local)).id, "local-user")
+        self.assertEqual((await jwt_utils.get_current_user(local)).id, "local-user")
+        self.assertEqual(self.remote_tokens, [])
+        self.assertGreaterEqual(jwt_utils.user_cache.counters["hits"], 1)
+
+    async def test_opaque_token_falls_back_to_remote(self):
+        self.assertEqual((await jwt_utils.get_current_user("opaque-access-token")).id, "test-user")
+        self.assertEqual(self.remote_tokens, ["opaque-access-token"])
+
+    async def test_unknown_signing_key_falls_back_to_remote(self):
+        jwt_utils.signing_keys = {}
+        unknown = token(kid="rotated")
+        self.assertEqual((await jwt_utils.get_current_user(unknown)).id, "test-user")
+        self.assertEqual(self.remote_tokens, [unknown])
+
+    async def test_invalid_jwt_is_rejected(self):
+        for invalid in (token(key=OTHER_KEY), token(exp=time.time() - 60)):
+            with self.subTest(invalid=invalid):
+                with self.assertRaises(HTTPException) as raised:
+                    await jwt_utils.get_current_user(invalid)
+                self.assertEqual(raised.exception.status_code, 401)
+        self.assertEqual(self.remote_tokens, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+"""上游路由：熔断器的打开、半开探测和恢复，只有可重试的错误才切换上游，切换受重试预算约束"""
+import asyncio
+import time
+import unittest
+
+import support
+from support import api_error
+
+import openai
+
+from common import classify_error, retry_budget
+from config import LLM_BREAKER_COOLDOWN, LLM_BREAKER_FAILURES
+from llm_router import BreakerState, Endpoint, EndpointRouter
+
+class ScriptedCompletions:
+    """按顺序抛出 outcomes 中的异常，outcome 为 None 时返回上游名"""
+    def __init__(self, name: str, calls: list[str], outcomes: list):
+        self.name = name
+        self.calls = calls
+        self.outcomes = outcomes
+
+    async def create(self, **kwargs):
+        self.calls.append(self.name)
+        await asyncio.sleep(0)
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if outcome is not None:
+            raise outcome
+        return self.name
+
+def endpoint(name: str) -> Endpoint:
+    return Endpoint(name=name, base_url="http://127.0.0.1:9/v1", api_key="test", model="test")
+
+class ClassifyErrorTest(unittest.TestCase):
+    def test_reasons(self):
+        self.assertEqual(classify_error(api_error(429)), "throttled")
+        self.assertIsNone(classify_error(api_error(429, code="insufficient_quota")))
+        self.assertEqual(classify_error(api_error(503)), "server")
+        self.assertEqual(classify_error(api_error(408)), "server")
+        self.assertIsNone(classify_error(api_error(400)))
+        self.assertIsNone(classify_error(api_error(401)))
+        self.assertEqual(classify_error(asyncio.TimeoutError()), "timeout")
+        self.assertEqual(classify_error(openai.APIConnectionError(request=api_error(500).request)), "network")
+        self.assertEqual(classify_error(ValueError("unparsable")), "other")
+
+class BreakerTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        e = endpoint("a")
+        now = time.monotonic()
+        for _ in range(LLM_BREAKER_FAILURES - 1):
+            e.record(1.0, ok=False, now=now)
+        e.record(1.0, ok=True, now=now)
+        self.assertEqual(e.state, BreakerState.CLOSED)
+        for _ in range(LLM_BREAKER_FAILURES):
+            e.record(1.0, ok=False, now=now)
+        self.assertEqual(e.state, BreakerState.OPEN)
+        self.assertEqual(e.counters["opened"], 1)
+        self.assertFalse(e.available(now))
+
+    def test_half_open_probe(self):
+        for ok, state in ((True, BreakerState.CLOSED), (False, BreakerState.OPEN)):
+            with self.subTest(ok=ok):
+                e = endpoint("a")
+                for _ in range(LLM_BREAKER_FAILURES):
+                    e.record(1.0, ok=False, now=0.0)
+                now = LLM_BREAKER_COOLDOWN
+                self.assertTrue(e.available(now))
+                e.acquire(now)
+                # 半开时只放行一个探测请求
+                self.assertEqual(e.state, BreakerState.HALF_OPEN)
+                self.assertFalse(e.available(now))
+                e.release()
+                e.record(1.0, ok=ok, now=now)
+                self.assertEqual(e.state, state)
+
+    def test_recovered_endpoint_ramps_up(self):
+        e = endpoint("a")
+        for _ in range(LLM_BREAKER_FAILURES):
+            e.record(1.0, ok=False, now=0.0)
+        e.record(1.0, ok=True, now=100.0)
+        self.assertEqual(e.ramp(100.0), Endpoint.RAMP_START)
+        self.assertLess(e.score(100.0, 1.0), e.score(100.0 + 1e6, 1.0))
+
+class FailoverTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.calls: list[str] = []
+        self.router = EndpointRouter([endpoint("a"), endpoint("b")])
+        self.tokens = retry_budget.tokens
+
+    async def asyncTearDown(self):
+        retry_budget.tokens = self.tokens
+        await self.router.close()
+
+    def script(self, *outcomes):
+        """两个上游共用同一个脚本：第 n 次调用（不论落在哪个上游）得到 outcomes[n]"""
+        shared = list(outcomes)
+        for e in self.router.endpoints:
+            e.client.chat.completions = ScriptedCompletions(e.name, self.calls, shared)
+
+    async def test_retryable_error_fails_over_to_other_endpoint(self):
+        self.script(api_error(503))
+        route = {}
+        result = await self.router.create([{"role": "user", "content": "hi"}], route=route)
+        self.assertEqual(len(self.calls), 2)
+        self.assertNotEqual(self.calls[0], self.calls[1])
+        self.assertEqual(result, self.calls[1])
+        self.assertEqual(route["endpoint"], self.calls[1])
+        self.assertEqual(self.router.counters["failovers"], 1)
+
+    async def test_non_retryable_error_does_not_fail_over(self):
+        self.script(api_error(400))
+        with self.assertRaises(openai.APIStatusError):
+            await self.router.create([{"role": "user", "content": "hi"}])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.router.counters["failovers"], 0)
+
+    async def test_failover_needs_retry_budget(self):
+        retry_budget.tokens = 0
+        retry_budget.per_second, per_second = 0, retry_budget.per_second
+        try:
+            self.script(api_error(503))
+            with self.assertRaises(openai.APIStatusError):
+                await self.router.create([{"role": "user", "content": "hi"}])
+        finally:
+            retry_budget.per_second = per_second
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.router.counters["failovers_suppressed"], 1)
+
+    async def test_open_endpoint_is_skipped(self):
+        a, b = self.router.endpoints
+        for _ in range(LLM_BREAKER_FAILURES):
+            a.record(1.0, ok=False, now=time.monotonic())
+        self.script()
+        for _ in range(5):
+            await self.router.create([{"role": "user", "content": "hi"}])
+        self.assertEqual(self.calls, ["b"] * 5)
+
+    async def test_cancelled_call_is_not_recorded(self):
+        a, b = self.router.endpoints
+
+        class Hanging:
+            async def create(self, **kwargs):
+                await asyncio.sleep(10)
+
+        a.client.chat.completions = b.client.chat.completions = Hanging()
+        task = asyncio.create_task(self.router.create([{"role": "user", "content": "hi"}]))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        for e in (a, b):
+            self.assertEqual(e.counters["errors"], 0)
+            self.assertIsNone(e.ewma_latency)
+            self.assertEqual(e.in_flight, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""LLM 调度器：按优先级和用户轮转出队，相同的进行中调用合并为一次"""
+import asyncio
+import unittest
+
+import support
+
+from llm_scheduler import LLMPriority, LLMScheduler, set_llm_context
+
+class LLMSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.scheduler = LLMScheduler(max_concurrency=1)
+        self.order: list[str] = []
+        self.gate = asyncio.Event()
+
+    async def hold_slot(self):
+        """占住唯一的并发名额，直到 gate 打开"""
+        async with self.scheduler.slot():
+            await self.gate.wait()
+
+    def call(self, name: str, priority: LLMPriority, user_id: str = "user", key=None):
+        async def factory():
+            self.order.append(name)
+            await asyncio.sleep(0)
+            return name
+
+        async def run():
+            set_llm_context(user_id=user_id, priority=priority)
+            return await self.scheduler.submit(key, factory)
+        return asyncio.create_task(run())
+
+    async def queue_behind_holder(self, *calls, stagger: bool = False):
+        holder = asyncio.create_task(self.hold_slot())
+        await asyncio.sleep(0)
+        tasks = []
+        for args in calls:
+            tasks.append(self.call(*args))
+            if stagger:
+                # 等这个调用真正开始排队再提交下一个
+                await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        self.gate.set()
+        await holder
+        return await asyncio.gather(*tasks)
+
+    async def test_dequeues_by_priority(self):
+        await self.queue_behind_holder(
+            ("background", LLMPriority.BACKGROUND),
+            ("report", LLMPriority.REPORT),
+            ("interactive", LLMPriority.INTERACTIVE),
+        )
+        self.assertEqual(self.order, ["interactive", "report", "background"])
+        self.assertEqual(self.scheduler.counters["queued"], 3)
+        self.assertEqual(self.scheduler.stats()["in_flight"], 0)
+
+    async def test_round_robin_between_users(self):
+        await self.queue_behind_holder(
+            ("a1", LLMPriority.INTERACTIVE, "a"),
+            ("a2", LLMPriority.INTERACTIVE, "a"),
+            ("a3", LLMPriority.INTERACTIVE, "a"),
+            ("b1", LLMPriority.INTERACTIVE, "b"),
+        )
+        self.assertEqual(self.order, ["a1", "b1", "a2", "a3"])
+
+    async def test_identical_calls_share_one_flight(self):
+        results = await asyncio.gather(
+            self.call("first", LLMPriority.INTERACTIVE, key="same"),
+            self.call("second", LLMPriority.INTERACTIVE, key="same"),
+        )
+        self.assertEqual(results, ["first", "first"])
+        self.assertEqual(self.order, ["first"])
+        self.assertEqual(self.scheduler.counters["deduplicated"], 1)
+        self.assertEqual(self.scheduler.stats()["single_flights"], 0)
+
+    async def test_flight_cancelled_only_when_every_waiter_is(self):
+        holder = asyncio.create_task(self.hold_slot())
+        await asyncio.sleep(0)
+        first = self.call("first", LLMPriority.INTERACTIVE, key="same")
+        second = self.call("second", LLMPriority.INTERACTIVE, key="same")
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        self.gate.set()
+        await holder
+        self.assertEqual(await second, "first")
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+        self.gate.clear()
+        holder = asyncio.create_task(self.hold_slot())
+        await asyncio.sleep(0)
+        only = self.call("only", LLMPriority.INTERACTIVE, key="other")
+        await asyncio.sleep(0.01)
+        only.cancel()
+        await asyncio.sleep(0.01)
+        self.gate.set()
+        await holder
+        self.assertEqual(self.order, ["first"])
+        self.assertEqual(self.scheduler.stats()["queue_depth"]["interactive"], 0)
+
+    async def test_merged_interactive_call_promotes_background_call(self):
+        # stagger=False 时合并发生在预取调用开始排队之前，True 时发生在它已经排队之后
+        for stagger in (False, True):
+            with self.subTest(stagger=stagger):
+                self.order.clear()
+                self.gate.clear()
+                await self.queue_behind_holder(
+                    ("prefetch", LLMPriority.BACKGROUND, "user", f"same-{stagger}"),
+                    ("report", LLMPriority.REPORT),
+                    ("interactive", LLMPriority.INTERACTIVE, "user", f"same-{stagger}"),
+                    stagger=stagger,
+                )
+                self.assertEqual(self.order, ["prefetch", "report"])
+        self.assertEqual(self.scheduler.counters["promoted"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
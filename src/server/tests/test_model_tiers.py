@@ -0,0 +1,97 @@
+"""模型分层：首选层超时或解析置信度过低时改用另一层，请求有截止时间时首选层的超时给回退留出时间"""
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+
+import support
+
+from deadline import DeadlineExceeded, request_deadline
+from model_tiers import ModelTier, ModelTiers
+
+def tiers(fast_timeout: float = 0.05, large_timeout: float = 1.0, same_model: bool = False) -> ModelTiers:
+    return ModelTiers(
+        models={ModelTier.FAST: "model", ModelTier.LARGE: "model" if same_model else "large-model"},
+        timeouts={ModelTier.FAST: fast_timeout, ModelTier.LARGE: large_timeout},
+        prices={ModelTier.FAST: None, ModelTier.LARGE: (1.0, 2.0)},
+        min_confidence=0.5,
+    )
+
+def attempt(delays: dict[ModelTier, float] = None, confidences: dict[ModelTier, float] = None, fail: ModelTier = None):
+    """按层返回带 parse_confidence 的结果，calls 记录每次调用的 (层, 是否回退)"""
+    calls: list[tuple[ModelTier, bool]] = []
+
+    async def run(tier: ModelTier, fallback: bool):
+        calls.append((tier, fallback))
+        await asyncio.sleep((delays or {}).get(tier, 0))
+        if tier is fail:
+            raise ValueError(tier.value)
+        return SimpleNamespace(tier=tier, parse_confidence=(confidences or {}).get(tier, 1.0))
+    return run, calls
+
+class ModelTiersTest(unittest.IsolatedAsyncioTestCase):
+    async def test_preferred_tier(self):
+        t = tiers()
+        run, calls = attempt()
+        self.assertIs((await t.run("majors_reveal", run)).tier, ModelTier.FAST)
+        self.assertIs((await t.run("wisdom_report", run)).tier, ModelTier.LARGE)
+        self.assertEqual(calls, [(ModelTier.FAST, False), (ModelTier.LARGE, False)])
+
+    async def test_timeout_falls_back_to_other_tier(self):
+        t = tiers()
+        run, calls = attempt(delays={ModelTier.FAST: 1.0})
+        self.assertIs((await t.run("majors_reveal", run)).tier, ModelTier.LARGE)
+        self.assertEqual(calls, [(ModelTier.FAST, False), (ModelTier.LARGE, True)])
+        self.assertEqual(t.tier_counters[ModelTier.FAST]["timeouts"], 1)
+        self.assertEqual(t.task_counters["majors_reveal"]["timeout_fallbacks"], 1)
+        self.assertEqual(t.task_counters["majors_reveal"]["fallback_wins"], 1)
+
+    async def test_no_fallback_when_both_tiers_use_the_same_model(self):
+        t = tiers(same_model=True)
+        run, calls = attempt(delays={ModelTier.FAST: 0.1}, confidences={ModelTier.FAST: 0.0})
+        self.assertIs((await t.run("majors_reveal", run)).tier, ModelTier.FAST)
+        self.assertEqual(calls, [(ModelTier.FAST, False)])
+
+    async def test_low_confidence_keeps_the_better_result(self):
+        cases = (
+            ({ModelTier.FAST: 0.2, ModelTier.LARGE: 0.9}, None, ModelTier.LARGE),
+            ({ModelTier.FAST: 0.2, ModelTier.LARGE: 0.1}, None, ModelTier.FAST),
+            ({ModelTier.FAST: 0.2}, ModelTier.LARGE, ModelTier.FAST),
+        )
+        for confidences, fail, expected in cases:
+            with self.subTest(confidences=confidences, fail=fail):
+                t = tiers()
+                run, calls = attempt(confidences=confidences, fail=fail)
+                self.assertIs((await t.run("majors_reveal", run)).tier, expected)
+                self.assertEqual(calls, [(ModelTier.FAST, False), (ModelTier.LARGE, True)])
+                self.assertEqual(t.task_counters["majors_reveal"]["low_confidence_fallbacks"], 1)
+
+    async def test_deadline_leaves_time_for_fallback(self):
+        t = tiers(fast_timeout=10, large_timeout=0.3)
+        token = request_deadline.set(time.monotonic() + 1.0)
+        try:
+            self.assertAlmostEqual(t._timeout(ModelTier.FAST), 0.7, delta=0.05)
+            # 另一层的超时比剩余预算还长时，首选层至少保留一半预算；首选层不限超时时也只用这部分预算
+            self.assertAlmostEqual(tiers(fast_timeout=10, large_timeout=0)._timeout(ModelTier.LARGE), 0.5, delta=0.05)
+        finally:
+            request_deadline.reset(token)
+        self.assertEqual(t._timeout(ModelTier.FAST), 10)
+
+    async def test_expired_deadline_does_not_fall_back(self):
+        t = tiers()
+        run, calls = attempt()
+        token = request_deadline.set(time.monotonic() - 1)
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                await t.run("majors_reveal", run)
+        finally:
+            request_deadline.reset(token)
+        self.assertEqual(calls, [])
+
+    def test_cost(self):
+        t = tiers()
+        self.assertIsNone(t.cost(ModelTier.FAST, 1000, 1000))
+        self.assertAlmostEqual(t.cost(ModelTier.LARGE, 1_000_000, 500_000), 2.0)
+
+if __name__ == "__main__":
+    unittest.main()
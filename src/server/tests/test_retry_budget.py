@@ -0,0 +1,120 @@
+"""重试预算：令牌按时间和首次调用补充，用完后不再重试；Retry-After 过长或超出请求预算时也不重试"""
+import time
+import unittest
+
+import support
+from support import api_error
+
+import openai
+
+from common import RetryBudget, retry, retry_attempt
+from config import RETRY_AFTER_MAX
+from deadline import DeadlineExceeded, request_deadline
+
+def flaky(*errors):
+    """依次抛出 errors 中的异常，之后返回调用时所处的 retry_attempt"""
+    remaining = list(errors)
+    attempts: list[int] = []
+
+    async def call():
+        attempts.append(retry_attempt.get())
+        if remaining:
+            raise remaining.pop(0)
+        return retry_attempt.get()
+    return call, attempts
+
+class RetryBudgetTest(unittest.TestCase):
+    def test_tokens(self):
+        budget = RetryBudget(ratio=0.5, per_second=0, capacity=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        self.assertEqual(budget.counters["suppressed_budget"], 1)
+        # 每次首次调用存入 ratio 个令牌，两次首次调用换来一次重试
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        for _ in range(10):
+            budget.deposit()
+        self.assertEqual(budget.tokens, 2)
+
+    def test_refill_per_second(self):
+        budget = RetryBudget(ratio=0, per_second=10, capacity=5)
+        budget.tokens = 0
+        budget._updated -= 0.25
+        self.assertTrue(budget.withdraw())
+        self.assertAlmostEqual(budget.tokens, 1.5, delta=0.1)
+        budget._updated -= 100
+        budget._refill()
+        self.assertEqual(budget.tokens, 5)
+
+class RetryTest(unittest.IsolatedAsyncioTestCase):
+    def budget(self, tokens: float = 10) -> RetryBudget:
+        budget = RetryBudget(ratio=0, per_second=0, capacity=10)
+        budget.tokens = tokens
+        return budget
+
+    async def test_retries_retryable_errors(self):
+        budget = self.budget()
+        call, attempts = flaky(api_error(503), api_error(429))
+        self.assertEqual(await retry(delay=0, budget=budget)(call)(), 3)
+        self.assertEqual(attempts, [1, 2, 3])
+        self.assertEqual(budget.counters["retries"], 2)
+        self.assertEqual(budget.counters["recovered"], 1)
+        self.assertEqual(budget.reasons["server"], 1)
+        self.assertEqual(budget.reasons["throttled"], 1)
+        self.assertEqual(budget.tokens, 8)
+
+    async def test_does_not_retry_non_retryable_errors(self):
+        budget = self.budget()
+        call, attempts = flaky(api_error(429, code="insufficient_quota"))
+        with self.assertRaises(openai.APIStatusError):
+            await retry(delay=0, budget=budget)(call)()
+        self.assertEqual(attempts, [1])
+        self.assertEqual(budget.counters["non_retryable"], 1)
+
+    async def test_gives_up_after_max_retries(self):
+        budget = self.budget()
+        call, attempts = flaky(*[api_error(503)] * 5)
+        with self.assertRaises(openai.APIStatusError):
+            await retry(max_retries=2, delay=0, budget=budget)(call)()
+        self.assertEqual(attempts, [1, 2, 3])
+        self.assertEqual(budget.counters["exhausted"], 1)
+
+    async def test_empty_budget_stops_retries(self):
+        budget = self.budget(tokens=1)
+        call, attempts = flaky(api_error(503), api_error(503))
+        with self.assertRaises(openai.APIStatusError):
+            await retry(delay=0, budget=budget)(call)()
+        self.assertEqual(attempts, [1, 2])
+        self.assertEqual(budget.counters["suppressed_budget"], 1)
+
+    async def test_retry_after(self):
+        budget = self.budget()
+        call, attempts = flaky(api_error(429, headers={"retry-after-ms": "50"}))
+        start = time.monotonic()
+        await retry(delay=0, budget=budget)(call)()
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+        call, attempts = flaky(api_error(429, headers={"retry-after": str(RETRY_AFTER_MAX + 1)}))
+        with self.assertRaises(openai.APIStatusError):
+            await retry(delay=0, budget=budget)(call)()
+        self.assertEqual(attempts, [1])
+        self.assertEqual(budget.counters["suppressed_retry_after"], 1)
+
+    async def test_wait_past_deadline_raises_deadline_exceeded(self):
+        budget = self.budget()
+        call, attempts = flaky(api_error(429, headers={"retry-after": "5"}))
+        token = request_deadline.set(time.monotonic() + 1)
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                await retry(delay=0, budget=budget)(call)()
+        finally:
+            request_deadline.reset(token)
+        self.assertEqual(attempts, [1])
+        self.assertEqual(budget.counters["suppressed_deadline"], 1)
+        self.assertEqual(budget.tokens, 10)
+
+if __name__ == "__main__":
+    unittest.main()
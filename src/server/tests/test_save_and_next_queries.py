@@ -0,0 +1,66 @@
+"""
+每次 save_and_next 发出的 SQL 语句数
+
+会话树每个请求只加载一次（会话、轮次、出场记录各一条 SELECT），写入直接复用已加载的对象，
+不再按主键重新查询。这里用 before_cursor_execute 统计走完整个会话时每次请求的语句数，超过上限即失败。
+LLM 用假的上游代替，预取、LLM 缓存、调用明细账和写队列都关闭，只剩请求本身的语句。
+
+在仓库根目录运行：
+    python -m unittest discover -s src/server/tests
+"""
+import unittest
+from collections import Counter
+
+from support import BASE_INFORMATION, choose, fake_user, install_fake_llm
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+import main
+from database.base import engine
+from routes.jwt_utils import get_current_user
+
+MAX_SELECTS = 3     # 会话、轮次、出场记录各一条
+MAX_STATEMENTS = 10  # 新一轮：3 条 SELECT，插入轮次和出场记录，更新上一轮、出场记录和会话
+
+class SaveAndNextStatementsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        install_fake_llm()
+        main.app.dependency_overrides[get_current_user] = fake_user
+        cls.statements: list[str] = []
+        event.listen(engine.sync_engine, "before_cursor_execute", cls._record)
+
+    @classmethod
+    def tearDownClass(cls):
+        event.remove(engine.sync_engine, "before_cursor_execute", cls._record)
+        main.app.dependency_overrides.clear()
+
+    @classmethod
+    def _record(cls, conn, cursor, statement, parameters, context, executemany):
+        cls.statements.append(statement.split(None, 1)[0].upper())
+
+    def save_and_next(self, client: TestClient, session_id: str, choices) -> tuple[dict, Counter]:
+        self.statements.clear()
+        response = client.post(f"/api/options/save_and_next/{session_id}", json={"choices": choices})
+        self.assertEqual(response.status_code, 200, response.text)
+        return response.json(), Counter(self.statements)
+
+    def test_statements_per_save_and_next(self):
+        operations = Counter()
+        with TestClient(main.app) as client:
+            session_id = client.post("/api/base_information", json=BASE_INFORMATION).json()
+            result, counts = self.save_and_next(client, session_id, None)
+            while True:
+                operations[result["operation"]] += 1
+                with self.subTest(session_id=session_id, operation=result["operation"], statements=dict(counts)):
+                    self.assertLessEqual(counts["SELECT"], MAX_SELECTS)
+                    self.assertLessEqual(sum(counts.values()), MAX_STATEMENTS)
+                if result["operation"] == "GENERATE_REPORT":
+                    break
+                result, counts = self.save_and_next(client, session_id, choose(result["data"]["choices"]))
+        # 三种操作都要覆盖到，否则上限没有检查到最重的请求
+        self.assertTrue({"GENERATE_ROUND", "GENERATE_CHOICES", "GENERATE_REPORT"} <= set(operations), operations)
+
+if __name__ == "__main__":
+    unittest.main()
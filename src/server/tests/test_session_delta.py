@@ -0,0 +1,85 @@
+"""会话增量：客户端按水位线合并每一步的增量后，与完整的会话详情一致，且每一步的增量大小与会话进度无关"""
+import unittest
+
+from support import BASE_INFORMATION, choose, fake_user, install_fake_llm
+
+from fastapi.testclient import TestClient
+
+import main
+from config import MAX_COMPARISON_SIZE
+from routes.jwt_utils import get_current_user
+
+class ClientCopy:
+    """客户端保存的会话：轮次按 round_number，出场记录按 major_id 覆盖合并"""
+    def __init__(self):
+        self.rounds: dict[int, dict] = {}
+        self.watermark = {"round_number": 0, "appearance_index": -1}
+        self.status = None
+
+    def merge(self, delta: dict):
+        for round in delta["rounds"]:
+            appearances = self.rounds.get(round["round_number"], {}).get("appearances", {})
+            appearances.update({appearance["major_id"]: appearance for appearance in round["appearances"]})
+            self.rounds[round["round_number"]] = {**round, "appearances": appearances}
+        self.watermark = delta["watermark"]
+        self.status = delta["status"]
+
+    def as_session(self) -> list[dict]:
+        return [
+            {**round, "appearances": sorted(round["appearances"].values(), key=lambda appearance: appearance["appearance_index"])}
+            for _, round in sorted(self.rounds.items())
+        ]
+
+class SessionDeltaTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        install_fake_llm()
+        main.app.dependency_overrides[get_current_user] = fake_user
+
+    @classmethod
+    def tearDownClass(cls):
+        main.app.dependency_overrides.clear()
+
+    def test_merged_deltas_match_full_session(self):
+        with TestClient(main.app) as client:
+            session_id = client.post("/api/base_information", json=BASE_INFORMATION).json()
+            copy = ClientCopy()
+            result = client.post(f"/api/options/save_and_next/{session_id}", json={"choices": None}).json()
+            steps = 0
+            while True:
+                response = client.get(f"/api/sessions/{session_id}/delta", params=copy.watermark)
+                self.assertEqual(response.status_code, 200, response.text)
+                delta = response.json()
+                # 每一步最多带回水位线所在的一组、新的一组，以及一轮结束时轮空晋级的记录
+                self.assertLessEqual(sum(len(round["appearances"]) for round in delta["rounds"]), 2 * MAX_COMPARISON_SIZE + 1)
+                self.assertLessEqual(len(delta["rounds"]), 2)
+                copy.merge(delta)
+
+                full = client.get(f"/api/sessions/{session_id}").json()
+                self.assertEqual(copy.as_session(), full["rounds"])
+                self.assertEqual(copy.status, full["status"])
+                steps += 1
+                if result["operation"] == "GENERATE_REPORT":
+                    self.assertIsNotNone(delta["report"])
+                    break
+                self.assertIsNone(delta["report"])
+                result = client.post(f"/api/options/save_and_next/{session_id}",
+                                     json={"choices": choose(result["data"]["choices"])}).json()
+            self.assertGreater(steps, 3)
+
+            # 已经是最新的水位线时只返回水位线所在的轮次
+            delta = client.get(f"/api/sessions/{session_id}/delta", params=copy.watermark).json()
+            self.assertEqual(delta["watermark"], copy.watermark)
+            self.assertLessEqual(len(delta["rounds"]), 1)
+
+    def test_other_users_session_is_not_found(self):
+        with TestClient(main.app) as client:
+            session_id = client.post("/api/base_information", json=BASE_INFORMATION).json()
+            main.app.dependency_overrides[get_current_user] = lambda: fake_user().model_copy(update={"id": "other-user"})
+            try:
+                self.assertEqual(client.get(f"/api/sessions/{session_id}/delta").status_code, 404)
+            finally:
+                main.app.dependency_overrides[get_current_user] = fake_user
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""会话详情快照：强 ETag 和 304，写入后快照立即失效，读取期间有写入时不缓存旧快照"""
+import unittest
+
+from support import BASE_INFORMATION, choose, fake_user, install_fake_llm
+
+from fastapi.testclient import TestClient
+
+import main
+from routes.jwt_utils import get_current_user
+from snapshots import SessionSnapshot, SessionSnapshotCache, etag_matches
+from schemas import SessionWatermark
+
+class EtagMatchesTest(unittest.TestCase):
+    def test_if_none_match(self):
+        etag = '"abc"'
+        self.assertTrue(etag_matches('"abc"', etag))
+        self.assertTrue(etag_matches('W/"abc"', etag))
+        self.assertTrue(etag_matches('"x", "abc"', etag))
+        self.assertTrue(etag_matches("*", etag))
+        self.assertFalse(etag_matches('"x"', etag))
+        self.assertFalse(etag_matches(None, etag))
+
+class SessionSnapshotCacheTest(unittest.TestCase):
+    def snapshot(self, round_number: int = 1, finished: bool = False) -> SessionSnapshot:
+        """快照只关心响应序列化后的字节，用一个小的响应模型代替完整的会话"""
+        return SessionSnapshot.build("user", SessionWatermark(round_number=round_number), finished)
+
+    def test_stale_put_is_dropped(self):
+        cache = SessionSnapshotCache(max_size=10, max_finished_size=10)
+        version = cache.version("s")
+        # 读取数据库期间会话被写入
+        cache.invalidate("s")
+        cache.put("s", version, self.snapshot(1))
+        self.assertIsNone(cache.get("s"))
+        self.assertEqual(cache.counters["stale_puts"], 1)
+        cache.put("s", cache.version("s"), self.snapshot(2))
+        self.assertIsNotNone(cache.get("s"))
+
+    def test_finished_sessions_have_their_own_lru(self):
+        cache = SessionSnapshotCache(max_size=1, max_finished_size=2)
+        cache.put("finished", 0, self.snapshot(finished=True))
+        for session_id in ("a", "b", "c"):
+            cache.put(session_id, 0, self.snapshot())
+        self.assertIsNotNone(cache.get("finished"))
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.stats()["evictions"], 2)
+
+    def test_etag_depends_only_on_content(self):
+        self.assertEqual(self.snapshot(1).etag, self.snapshot(1).etag)
+        self.assertNotEqual(self.snapshot(1).etag, self.snapshot(2).etag)
+
+class SessionEtagTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        install_fake_llm()
+        main.app.dependency_overrides[get_current_user] = fake_user
+
+    @classmethod
+    def tearDownClass(cls):
+        main.app.dependency_overrides.clear()
+
+    def test_not_modified_until_the_session_changes(self):
+        with TestClient(main.app) as client:
+            session_id = client.post("/api/base_information", json=BASE_INFORMATION).json()
+            result = client.post(f"/api/options/save_and_next/{session_id}", json={"choices": None}).json()
+            etags = set()
+            for _ in range(3):
+                response = client.get(f"/api/sessions/{session_id}")
+                self.assertEqual(response.status_code, 200)
+                etag = response.headers["ETag"]
+                self.assertNotIn(etag, etags)
+                etags.add(etag)
+                self.assertEqual(client.get(f"/api/sessions/{session_id}", headers={"If-None-Match": etag}).status_code, 304)
+
+                result = client.post(f"/api/options/save_and_next/{session_id}", json={"choices": choose(result["data"]["choices"])}).json()
+                # 写入之后旧的 ETag 不再匹配
+                response = client.get(f"/api/sessions/{session_id}", headers={"If-None-Match": etag})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers["ETag"], etag)
+
+            # 快照属于创建它的用户，其他用户即使命中缓存也读不到
+            main.app.dependency_overrides[get_current_user] = lambda: fake_user().model_copy(update={"id": "other-user"})
+            try:
+                self.assertEqual(client.get(f"/api/sessions/{session_id}").status_code, 404)
+            finally:
+                main.app.dependency_overrides[get_current_user] = fake_user
+
+if __name__ == "__main__":
+    unittest.main()
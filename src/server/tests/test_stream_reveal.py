@@ -0,0 +1,43 @@
+"""流式揭示：最终结果与已推送的描述不一致时，按最终结果重新推送这个专业，同名事件以最后一次为准"""
+import unittest
+from types import SimpleNamespace
+
+import support
+
+from llm import stream_majors_reveal
+from llm_router import llm_router
+
+MAJORS = ["计算机科学与技术", "临床医学"]
+
+class TruncatedStreamCompletions:
+    """流式调用只返回第一个专业就结束，整体解析失败后回退到非流式调用，得到另一份描述"""
+    async def create(self, model=None, messages=None, stream=False, **kwargs):
+        if stream:
+            async def chunks():
+                for token in ("<Majors><Major><Name>", MAJORS[0], "</Name><Description>流式</Description></Major>"):
+                    yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))], usage=None)
+            return chunks()
+        content = "<Majors>" + "".join(f"<Major><Name>{major}</Name><Description>重新生成</Description></Major>"
+                                       for major in MAJORS) + "</Majors>"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+class StreamRevealTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.completions = [endpoint.client.chat.completions for endpoint in llm_router.endpoints]
+        for endpoint in llm_router.endpoints:
+            endpoint.client.chat.completions = TruncatedStreamCompletions()
+
+    async def asyncTearDown(self):
+        for endpoint, completions in zip(llm_router.endpoints, self.completions):
+            endpoint.client.chat.completions = completions
+
+    async def test_corrected_major_is_pushed_again(self):
+        events = [(event, data) async for event, data in stream_majors_reveal("{}", MAJORS)]
+        self.assertEqual([event for event, _ in events], ["major", "major", "major", "done"])
+        self.assertEqual(events[0][1], {"name": MAJORS[0], "description": "流式"})
+        latest = {data["name"]: data["description"] for event, data in events if event == "major"}
+        self.assertEqual(latest, dict(zip(MAJORS, events[-1][1].descriptions)))
+        self.assertEqual(latest[MAJORS[0]], "重新生成")
+
+if __name__ == "__main__":
+    unittest.main()
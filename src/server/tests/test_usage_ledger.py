@@ -0,0 +1,53 @@
+"""LLM 调用明细账：写入缓冲区的调用按会话、轮次、函数和日期在数据库中汇总"""
+import time
+import unittest
+
+import support
+
+from database.base import init_db
+from usage_ledger import LLMCallRecord, UsageLedger
+
+def call(session_id, round_number, function, latency_ms, cost=0.01, outcome="ok", attempt=1):
+    return LLMCallRecord(function=function, tier="fast", session_id=session_id, round_number=round_number, attempt=attempt,
+                         prompt_tokens=100, completion_tokens=10, cached_tokens=50, cost=cost, latency_ms=latency_ms, outcome=outcome)
+
+class UsageLedgerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await init_db()
+        self.ledger = UsageLedger(enabled=True, flush_seconds=60, batch_size=100, buffer_size=100, retention_days=0)
+        self.session_id = f"usage-{time.monotonic_ns()}"
+        for record in (
+            call(self.session_id, 1, "gen_majors_reveal", 100),
+            call(self.session_id, 1, "gen_majors_reveal", 300, outcome="upstream_error", attempt=2),
+            call(self.session_id, 2, "gen_majors_reveal", 200),
+            call(self.session_id, None, "gen_report", 1000, cost=None),
+        ):
+            self.ledger.record(record)
+
+    async def test_session_usage(self):
+        usage = await self.ledger.session_usage(self.session_id)
+        self.assertEqual(self.ledger.counters["written"], 4)
+        self.assertEqual(usage["calls"], 4)
+        self.assertEqual(usage["failed_calls"], 1)
+        self.assertEqual(usage["retries"], 1)
+        self.assertEqual(usage["prompt_tokens"], 400)
+        self.assertEqual(usage["cached_tokens"], 200)
+        # 最终报告没有配置价格，总花费不完整
+        self.assertIsNone(usage["cost"])
+        self.assertEqual(usage["latency_ms"], {"avg": 400, "max": 1000})
+        self.assertEqual([round["round_number"] for round in usage["rounds"]], [1, 2, None])
+        self.assertAlmostEqual(usage["rounds"][0]["cost"], 0.02)
+        self.assertEqual(usage["functions"]["gen_majors_reveal"]["calls"], 3)
+        self.assertIsNone(await self.ledger.session_usage("missing"))
+
+    async def test_recent_sessions_and_daily_usage(self):
+        sessions = await self.ledger.recent_sessions(10)
+        self.assertEqual(sessions[0]["session_id"], self.session_id)
+        self.assertEqual(sessions[0]["calls"], 4)
+        today = (await self.ledger.daily_usage(1))[-1]
+        self.assertEqual(today["date"], time.strftime("%Y-%m-%d"))
+        self.assertGreaterEqual(today["sessions"], 1)
+        self.assertGreaterEqual(today["calls"], 4)
+
+if __name__ == "__main__":
+    unittest.main()
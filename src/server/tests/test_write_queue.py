@@ -0,0 +1,104 @@
+"""组提交写队列：按时间窗口和批量上限分批，同一批次中各操作的结果互不影响，调用方中途被取消也不会中断整批事务"""
+import asyncio
+import unittest
+
+import support
+
+from sqlalchemy import func, select
+
+from database.base import AsyncSessionLocal, init_db
+from database.models import Session
+from database.write_queue import GROUP_COMMIT, WriteQueue, group_commit, write_queue
+
+def insert_session(user_id: str, delay: float = 0.0, error: bool = False):
+    async def operation(db):
+        db.add(Session(user_id=user_id, base_information=support.BASE_INFORMATION))
+        await db.flush()
+        if delay:
+            await asyncio.sleep(delay)
+        if error:
+            raise ValueError(user_id)
+        return user_id
+    return operation
+
+async def count_sessions(user_id: str) -> int:
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(select(func.count()).select_from(Session).where(Session.user_id == user_id))).scalar()
+
+class WriteQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await init_db()
+        # 时间窗口足够长，保证测试中提交的操作落在同一个批次里
+        self.queue = WriteQueue(window_ms=100, max_batch=10)
+        self.queue.start()
+
+    async def asyncTearDown(self):
+        await self.queue.stop()
+
+    async def test_batches_by_window_and_max_batch(self):
+        results = await asyncio.gather(*[self.queue.submit(insert_session(f"max-batch-{i}")) for i in range(25)])
+        self.assertEqual(results, [f"max-batch-{i}" for i in range(25)])
+        self.assertEqual(self.queue.counters["batches"], 3)
+        # 时间窗口结束后提交的操作进入下一个批次
+        await self.queue.submit(insert_session("window-1"))
+        await asyncio.sleep(0.15)
+        await self.queue.submit(insert_session("window-2"))
+        self.assertEqual(self.queue.stats()["batches"], 5)
+        self.assertEqual(self.queue.stats()["operations"], 27)
+        self.assertEqual(self.queue.stats()["queue_depth"], 0)
+        self.assertEqual(await count_sessions("max-batch-24"), 1)
+
+    async def test_group_commit_routes_writes_through_running_queue(self):
+        transactions = []
+
+        @group_commit
+        async def write(db, value, transaction=None):
+            transactions.append(transaction)
+            return value
+
+        self.assertEqual(await write(None, 1), 1)
+        write_queue.start()
+        try:
+            self.assertEqual(await write(None, 2), 2)
+            # 调用方已经在外部事务中时直接执行
+            self.assertEqual(await write(None, 3, transaction="outer"), 3)
+        finally:
+            await write_queue.stop()
+        self.assertEqual(transactions, [None, GROUP_COMMIT, "outer"])
+
+    async def test_batch_commits_each_operation_and_isolates_failures(self):
+        results = await asyncio.gather(
+            self.queue.submit(insert_session("batch-ok-1")),
+            self.queue.submit(insert_session("batch-failed", error=True)),
+            self.queue.submit(insert_session("batch-ok-2")),
+            return_exceptions=True,
+        )
+        self.assertEqual(results[0], "batch-ok-1")
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], "batch-ok-2")
+        self.assertEqual(self.queue.counters["batches"], 1)
+        self.assertEqual(self.queue.counters["failed_operations"], 1)
+        self.assertEqual(await count_sessions("batch-ok-1"), 1)
+        self.assertEqual(await count_sessions("batch-failed"), 0)
+        self.assertEqual(await count_sessions("batch-ok-2"), 1)
+
+    async def test_waiter_cancelled_while_its_operation_runs(self):
+        for error in (True, False):
+            with self.subTest(error=error):
+                prefix = f"cancelled-{error}"
+                before = asyncio.create_task(self.queue.submit(insert_session(f"{prefix}-before")))
+                cancelled = asyncio.create_task(self.queue.submit(insert_session(f"{prefix}-cancelled", delay=0.3, error=error)))
+                after = asyncio.create_task(self.queue.submit(insert_session(f"{prefix}-after")))
+                # 等批次开始执行被取消的操作后再取消它的调用方
+                await asyncio.sleep(0.2)
+                cancelled.cancel()
+                self.assertEqual(await before, f"{prefix}-before")
+                self.assertEqual(await after, f"{prefix}-after")
+                with self.assertRaises(asyncio.CancelledError):
+                    await cancelled
+                self.assertEqual(await count_sessions(f"{prefix}-before"), 1)
+                self.assertEqual(await count_sessions(f"{prefix}-after"), 1)
+                self.assertTrue(self.queue.running)
+
+if __name__ == "__main__":
+    unittest.main()
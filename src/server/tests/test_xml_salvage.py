@@ -0,0 +1,115 @@
+"""模型输出的 XML 修复：能挽救的输出按修复方式扣减解析置信度，完全无法挽救时才抛出 XMLSalvageError"""
+import unittest
+
+import support
+
+from llm import IncrementalXMLParser, XMLSalvageError, match_majors, parse_majors_reveal, parse_wisdom_report, salvage_xml
+
+MAJORS = ["计算机科学与技术", "临床医学"]
+
+def majors_xml(*pairs: tuple[str, str]) -> str:
+    return "<Majors>" + "".join(f"<Major><Name>{name}</Name><Description>{description}</Description></Major>"
+                                for name, description in pairs) + "</Majors>"
+
+WELL_FORMED = majors_xml((MAJORS[0], "写代码"), (MAJORS[1], "看病人"))
+
+def report_xml(final: str = "<FinalThreeMajors>a, b, c</FinalThreeMajors>", names: str = "abc",
+               recommendation: str = "<FinalRecommendation>推荐</FinalRecommendation>") -> str:
+    majors = "".join(f"<Major><Name>{name}</Name><Description>{name}的报告</Description></Major>" for name in names)
+    return f"<Report>{final}<ThreeMajorsReport>{majors}</ThreeMajorsReport>{recommendation}</Report>"
+
+class SalvageXMLTest(unittest.TestCase):
+    def assertSalvaged(self, text: str, repairs: list[str], confidence: float):
+        reveal = parse_majors_reveal(text, MAJORS)
+        self.assertEqual(reveal.descriptions, ["写代码", "看病人"])
+        self.assertEqual(reveal.repairs, repairs)
+        self.assertEqual(reveal.parse_confidence, confidence)
+
+    def test_well_formed(self):
+        self.assertSalvaged(WELL_FORMED, [], 1.0)
+
+    def test_code_fence_and_prose(self):
+        self.assertSalvaged(f"```xml\n{WELL_FORMED}\n```", ["stripped_code_fence"], 1.0)
+        self.assertSalvaged(f"以下是揭示：\n{WELL_FORMED}\n希望对你有帮助", ["stripped_prose"], 0.95)
+
+    def test_unescaped_text(self):
+        reveal = parse_majors_reveal(majors_xml((MAJORS[0], "C&C++ 与 a<b"), (MAJORS[1], "看病人")), MAJORS)
+        self.assertEqual(reveal.descriptions[0], "C&C++ 与 a<b")
+        self.assertEqual(reveal.repairs, ["escaped_text"])
+
+    def test_truncated_output(self):
+        self.assertSalvaged(WELL_FORMED.removesuffix("</Description></Major></Majors>"), ["balanced_tags"], 0.8)
+
+    def test_missing_root(self):
+        self.assertSalvaged(WELL_FORMED.removeprefix("<Majors>").removesuffix("</Majors>"), ["balanced_tags"], 0.8)
+
+    def test_regex_extraction(self):
+        # 控制字符让 XML 解析器在任何修复下都失败
+        reveal = parse_majors_reveal(majors_xml((MAJORS[0], "写代码\x01"), (MAJORS[1], "看病人")), MAJORS)
+        self.assertEqual(reveal.descriptions[1], "看病人")
+        self.assertEqual(reveal.repairs, ["regex_extraction"])
+        self.assertEqual(reveal.parse_confidence, 0.6)
+
+    def test_unsalvageable(self):
+        with self.assertRaises(XMLSalvageError):
+            salvage_xml("抱歉，我无法回答这个问题", "Majors")
+        with self.assertRaises(XMLSalvageError):
+            parse_majors_reveal(majors_xml((MAJORS[0], "写代码")), MAJORS)
+
+class MatchMajorsTest(unittest.TestCase):
+    def test_exact_fuzzy_and_positional(self):
+        self.assertEqual(match_majors([(MAJORS[1], "b"), (MAJORS[0], "a")], MAJORS), ({MAJORS[1]: "b", MAJORS[0]: "a"}, []))
+        matched, repairs = match_majors([("计算机科学", "a"), (MAJORS[1], "b")], MAJORS)
+        self.assertEqual(matched, {MAJORS[0]: "a", MAJORS[1]: "b"})
+        self.assertEqual(repairs, ["fuzzy_name"])
+        # 精确匹配的保持不变，只有对不上的按顺序对应
+        matched, repairs = match_majors([(MAJORS[1], "b"), ("专业一", "a")], MAJORS)
+        self.assertEqual(matched, {MAJORS[1]: "b", MAJORS[0]: "a"})
+        self.assertEqual(repairs, ["positional_name"])
+
+    def test_no_positional_match_when_counts_differ(self):
+        matched, repairs = match_majors([("专业一", "a")], MAJORS)
+        self.assertEqual(matched, {})
+        self.assertEqual(repairs, [])
+
+class WisdomReportTest(unittest.TestCase):
+    def test_well_formed(self):
+        report = parse_wisdom_report(report_xml())
+        self.assertEqual(report.final_three_majors, ["a", "b", "c"])
+        self.assertEqual(report.parse_confidence, 1.0)
+
+    def test_repairs(self):
+        report = parse_wisdom_report(report_xml(final=""), ["x", "y", "z"])
+        self.assertEqual(report.final_three_majors, ["a", "b", "c"])
+        self.assertEqual(report.repairs, ["names_from_report"])
+        report = parse_wisdom_report(report_xml(names="abcd"))
+        self.assertEqual(len(report.final_three_majors_report), 3)
+        self.assertEqual(report.repairs, ["truncated_report"])
+
+    def test_unsalvageable(self):
+        with self.assertRaises(XMLSalvageError):
+            parse_wisdom_report(report_xml(names="ab"))
+        with self.assertRaises(XMLSalvageError):
+            parse_wisdom_report(report_xml(recommendation=""))
+
+class IncrementalXMLParserTest(unittest.TestCase):
+    def test_emits_majors_as_they_close(self):
+        parser = IncrementalXMLParser("Majors")
+        names = []
+        for char in f"好的：\n{WELL_FORMED}\n以上":
+            names += [element.findtext("Name") for path, element in parser.feed(char) if element.tag == "Major"]
+        self.assertEqual(names, MAJORS)
+        self.assertTrue(parser.finished)
+        self.assertFalse(parser.broken)
+        self.assertEqual(parser.document, WELL_FORMED)
+
+    def test_broken_stream_falls_back_to_whole_document(self):
+        parser = IncrementalXMLParser("Majors")
+        text = majors_xml((MAJORS[0], "C&C++"), (MAJORS[1], "看病人"))
+        for char in text:
+            parser.feed(char)
+        self.assertTrue(parser.broken)
+        self.assertEqual(parse_majors_reveal(parser.document, MAJORS).descriptions[0], "C&C++")
+
+if __name__ == "__main__":
+    unittest.main()
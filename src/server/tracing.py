@@ -0,0 +1,223 @@
+import asyncio
+import json
+import random
+import secrets
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from pathlib import Path
+from typing import Any, Optional
+
+from loguru import logger
+
+from config import TRACING_ENABLED, TRACE_SLOW_MS, TRACE_SAMPLE_RATE, TRACE_BUFFER_SIZE, TRACE_EXPORT_PATH, TRACE_MAX_SPANS
+
+@dataclass
+class Span:
+    trace: "Trace"
+    name: str
+    parent_id: Optional[str]
+    span_id: str = field(default_factory=lambda: secrets.token_hex(8))
+    start: float = field(default_factory=time.time)
+    end: Optional[float] = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> Optional[float]:
+        return None if self.end is None else (self.end - self.start) * 1000
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": None if self.end is None else round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+class Trace:
+    """一个请求内的所有 span，第一个 span 是根 span"""
+    def __init__(self, name: str, **attributes):
+        self.trace_id = secrets.token_hex(16)
+        self.spans: list[Span] = []
+        self.dropped = 0
+        self.root = Span(trace=self, name=name, parent_id=None, attributes=attributes)
+        self.spans.append(self.root)
+
+    def add(self, span: Span) -> bool:
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return False
+        self.spans.append(span)
+        return True
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "start": self.root.start,
+            "duration_ms": None if self.root.end is None else round(self.root.duration_ms, 3),
+            "error": self.root.error or next((span.error for span in self.spans if span.error), None),
+            "attributes": self.root.attributes,
+            "dropped_spans": self.dropped,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+# 当前正在进行的 span；后台任务创建时会复制一份，不属于请求的后台任务需要自行清除
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+@contextmanager
+def span(name: str, activate: bool = True, **attributes):
+    """
+    在当前 span 下开启一个子 span，没有进行中的 trace 时什么也不做（返回 None）
+
+    异常会记录到 span 上并继续抛出，被取消只记为 cancelled 属性。
+    在异步生成器里跨 yield 使用时要传 activate=False：生成器与调用方共用上下文，
+    设置 current_span 会让调用方在两次 yield 之间开启的 span 错挂到这里
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(trace=parent.trace, name=name, parent_id=parent.span_id, attributes=attributes)
+    if not parent.trace.add(child):
+        yield None
+        return
+    token = current_span.set(child) if activate else None
+    try:
+        yield child
+    except asyncio.CancelledError:
+        child.set(cancelled=True)
+        raise
+    except BaseException as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        child.end = time.time()
+        if token is not None:
+            current_span.reset(token)
+
+def traced(name: Optional[str] = None):
+    """把协程函数的每次调用记录为一个 span，缺省使用函数名"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def set_attributes(**attributes):
+    """给当前 span 添加属性"""
+    current = current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+def set_trace_attributes(**attributes):
+    """给当前请求的根 span 添加属性，如会话 ID、轮次"""
+    current = current_span.get()
+    if current is not None:
+        current.trace.root.set(**attributes)
+
+class TraceExporter:
+    """
+    尾部采样后导出完整的 trace
+
+    请求结束后才决定是否保留：慢于 slow_ms 或出错的 trace 全部保留，其余按 sample_rate 随机保留。
+    保留的 trace 放进内存环形缓冲区供调试接口查询，配置了 export_path 时同时追加写入 JSON Lines 文件
+    """
+    def __init__(self, slow_ms: float, sample_rate: float, buffer_size: int, export_path: str):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.export_path = Path(export_path) if export_path else None
+        self._buffer: deque[dict] = deque(maxlen=buffer_size)
+        self.counters = {"traces": 0, "kept_slow": 0, "kept_error": 0, "kept_sampled": 0, "dropped": 0}
+
+    def _keep_reason(self, trace: Trace) -> Optional[str]:
+        if any(span.error for span in trace.spans):
+            return "error"
+        if trace.root.duration_ms >= self.slow_ms:
+            return "slow"
+        if random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def export(self, trace: Trace):
+        self.counters["traces"] += 1
+        reason = self._keep_reason(trace)
+        if reason is None:
+            self.counters["dropped"] += 1
+            return
+        self.counters[f"kept_{reason}"] += 1
+        record = {**trace.to_dict(), "sampled_by": reason}
+        self._buffer.append(record)
+        if self.export_path is not None:
+            line = json.dumps(record, ensure_ascii=False, default=str)
+            asyncio.get_running_loop().run_in_executor(None, self._write, line)
+
+    def _write(self, line: str):
+        try:
+            self.export_path.parent.mkdir(parents=True, exist_ok=True)
+            with self.export_path.open("a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"写入 trace 文件 {self.export_path} 失败: {e}")
+
+    def recent(self, limit: int = 50, min_duration_ms: float = 0) -> list[dict]:
+        """最近保留的 trace 摘要，最新的在前"""
+        traces = [trace for trace in reversed(self._buffer) if (trace["duration_ms"] or 0) >= min_duration_ms]
+        return [{key: value for key, value in trace.items() if key != "spans"} | {"span_count": len(trace["spans"])}
+                for trace in traces[:limit]]
+
+    def get(self, trace_id: str) -> Optional[dict]:
+        return next((trace for trace in self._buffer if trace["trace_id"] == trace_id), None)
+
+    def stats(self) -> dict:
+        return {**self.counters, "buffered": len(self._buffer), "slow_ms": self.slow_ms, "sample_rate": self.sample_rate}
+
+trace_exporter = TraceExporter(slow_ms=TRACE_SLOW_MS, sample_rate=TRACE_SAMPLE_RATE,
+                               buffer_size=TRACE_BUFFER_SIZE, export_path=TRACE_EXPORT_PATH)
+
+class TracingMiddleware:
+    """为每个 /api 请求开启一个根 span，结束后交给 trace_exporter 做尾部采样，并在响应头中返回 X-Trace-Id"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not TRACING_ENABLED or scope["type"] != "http" or not scope["path"].startswith("/api/"):
+            return await self.app(scope, receive, send)
+
+        trace = Trace(f"{scope['method']} {scope['path']}", method=scope["method"], path=scope["path"])
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                trace.root.set(status=message["status"])
+                message["headers"] = [*message.get("headers", []), (b"x-trace-id", trace.trace_id.encode())]
+            await send(message)
+
+        token = current_span.set(trace.root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            trace.root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current_span.reset(token)
+            trace.root.end = time.time()
+            route = scope.get("route")
+            if route is not None:
+                # 用路由模板命名根 span，路径参数作为属性，便于按接口聚合
+                trace.root.name = f"{scope['method']} {route.path}"
+                trace.root.set(**scope.get("path_params", {}))
+            if trace.root.attributes.get("status", 500) >= 500 and trace.root.error is None:
+                trace.root.error = f"HTTP {trace.root.attributes.get('status', 500)}"
+            trace_exporter.export(trace)
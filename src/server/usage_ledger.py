@@ -0,0 +1,251 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Any, Optional
+
+from loguru import logger
+from sqlalchemy import case, delete, distinct, func, insert, select
+
+from common import retry_attempt
+from model_tiers import ModelTier, model_tiers
+from prompt_usage import cached_tokens
+from database.base import UsageSessionLocal
+from database.models import LLMUsageEntry
+from config import LLM_USAGE_ENABLED, LLM_USAGE_FLUSH_SECONDS, LLM_USAGE_BATCH_SIZE, LLM_USAGE_BUFFER_SIZE, \
+    LLM_USAGE_RETENTION_DAYS
+
+# 当前请求所属的会话和轮次，LLM 调用明细按它们归属；预取任务创建时复制一份，仍归属触发它的会话
+usage_session_id: ContextVar[Optional[str]] = ContextVar("usage_session_id", default=None)
+usage_round_number: ContextVar[Optional[int]] = ContextVar("usage_round_number", default=None)
+
+def set_usage_context(session_id: str, round_number: Optional[int] = None):
+    """设置之后的 LLM 调用归属的会话和轮次，最终报告不属于任何轮次"""
+    usage_session_id.set(session_id)
+    usage_round_number.set(round_number)
+
+FAILED_OUTCOMES = ("parse_error", "upstream_error")
+
+@dataclass
+class LLMCallRecord:
+    """一次上游调用的明细，字段与 llm_usage 表的列一一对应"""
+    function: str
+    tier: str
+    stream: bool = False
+    hedge: bool = False
+    session_id: Optional[str] = field(default_factory=usage_session_id.get)
+    round_number: Optional[int] = field(default_factory=usage_round_number.get)
+    attempt: int = field(default_factory=retry_attempt.get)
+    model: Optional[str] = None
+    endpoint: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    cost: Optional[float] = None
+    ttft_ms: Optional[float] = None
+    latency_ms: float = 0.0
+    outcome: str = "ok"
+    parse_confidence: Optional[float] = None
+    created_at: float = field(default_factory=time.time)
+
+    def set_route(self, route: dict):
+        self.model = route.get("model")
+        self.endpoint = route.get("endpoint")
+
+    def set_usage(self, usage: Any):
+        if usage is None:
+            return
+        self.prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        self.completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        self.cached_tokens = cached_tokens(usage)
+        self.cost = model_tiers.cost(ModelTier(self.tier), self.prompt_tokens, self.completion_tokens)
+
+    def set_parsed(self, confidence: float):
+        self.parse_confidence = confidence
+        self.outcome = "ok" if confidence >= 1.0 else "repaired"
+
+def _aggregates() -> list:
+    """按分组在数据库中汇总的列；SQLite 没有分位数函数，延迟给出平均值和最大值"""
+    entry = LLMUsageEntry
+    return [
+        func.count().label("calls"),
+        func.sum(case((entry.outcome.in_(FAILED_OUTCOMES), 1), else_=0)).label("failed_calls"),
+        func.sum(case((entry.attempt > 1, 1), else_=0)).label("retries"),
+        func.coalesce(func.sum(entry.prompt_tokens), 0).label("prompt_tokens"),
+        func.coalesce(func.sum(entry.cached_tokens), 0).label("cached_tokens"),
+        func.coalesce(func.sum(entry.completion_tokens), 0).label("completion_tokens"),
+        # 有任何一次调用没有配置价格时，总花费不完整，返回 None
+        case((func.count(entry.cost) == func.count(), func.sum(entry.cost)), else_=None).label("cost"),
+        func.sum(entry.latency_ms).label("latency_ms_sum"),
+        func.avg(entry.latency_ms).label("latency_ms_avg"),
+        func.max(entry.latency_ms).label("latency_ms_max"),
+        func.avg(entry.ttft_ms).label("ttft_ms_avg"),
+        func.max(entry.ttft_ms).label("ttft_ms_max"),
+        func.min(entry.created_at).label("first_call_at"),
+        func.max(entry.created_at).label("last_call_at"),
+        func.count(distinct(entry.session_id)).label("sessions"),
+    ]
+
+def _summary(row: Any) -> dict:
+    return {
+        "calls": row.calls,
+        "failed_calls": row.failed_calls,
+        "retries": row.retries,
+        "prompt_tokens": row.prompt_tokens,
+        "cached_tokens": row.cached_tokens,
+        "completion_tokens": row.completion_tokens,
+        "cost": row.cost,
+        "latency_ms_sum": row.latency_ms_sum,
+        "latency_ms": {"avg": row.latency_ms_avg, "max": row.latency_ms_max},
+        "ttft_ms": {"avg": row.ttft_ms_avg, "max": row.ttft_ms_max},
+    }
+
+class UsageLedger:
+    """
+    LLM 调用明细账
+
+    llm.py 的每次上游调用结束后调用 record，记录只追加到内存缓冲区，不在请求路径上等待数据库；
+    后台任务每 flush_seconds 秒或缓冲达到 batch_size 条时一次性批量写入。
+    写入失败或缓冲区已满时丢弃记录并计数，明细账不影响请求本身。
+    """
+    def __init__(self, enabled: bool, flush_seconds: float, batch_size: int, buffer_size: int, retention_days: int):
+        self.enabled = enabled
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.retention_days = retention_days
+        self._buffer: list[LLMCallRecord] = []
+        self._wakeup = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self.counters = {"recorded": 0, "written": 0, "dropped_full": 0, "dropped_failed": 0, "flushes": 0, "pruned": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._writer is not None and not self._writer.done()
+
+    def start(self):
+        if self.enabled and not self.running:
+            self._writer = asyncio.create_task(self._run())
+            logger.info(f"LLM 调用明细账已启动，每 {self.flush_seconds}s 或 {self.batch_size} 条批量写入")
+
+    async def stop(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        await self.flush()
+
+    def record(self, call: LLMCallRecord):
+        if not self.enabled:
+            return
+        if len(self._buffer) >= self.buffer_size:
+            self.counters["dropped_full"] += 1
+            return
+        self.counters["recorded"] += 1
+        self._buffer.append(call)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        await self._prune()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """把缓冲区中的记录一次性写入数据库"""
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        try:
+            async with UsageSessionLocal() as db:
+                await db.execute(insert(LLMUsageEntry), [asdict(call) for call in batch])
+                await db.commit()
+        except Exception as e:
+            self.counters["dropped_failed"] += len(batch)
+            logger.error(f"写入 {len(batch)} 条 LLM 调用明细失败: {e}")
+            return
+        self.counters["flushes"] += 1
+        self.counters["written"] += len(batch)
+
+    async def _prune(self):
+        if self.retention_days <= 0:
+            return
+        try:
+            async with UsageSessionLocal() as db:
+                result = await db.execute(delete(LLMUsageEntry).where(LLMUsageEntry.created_at < time.time() - self.retention_days * 86400))
+                await db.commit()
+        except Exception as e:
+            logger.error(f"清理过期的 LLM 调用明细失败: {e}")
+            return
+        self.counters["pruned"] += result.rowcount or 0
+
+    ### 聚合查询，调用前先写入缓冲区，使结果包含刚刚结束的调用
+
+    async def session_usage(self, session_id: str) -> Optional[dict]:
+        """一个会话的总计，以及按轮次和按函数的分项，最终报告的轮次为 null"""
+        await self.flush()
+        query = select(*_aggregates()).where(LLMUsageEntry.session_id == session_id)
+        async with UsageSessionLocal() as db:
+            total = (await db.execute(query)).one()
+            if not total.calls:
+                return None
+            rounds = (await db.execute(
+                query.add_columns(LLMUsageEntry.round_number).group_by(LLMUsageEntry.round_number)
+                .order_by(LLMUsageEntry.round_number.is_(None), LLMUsageEntry.round_number)
+            )).all()
+            functions = (await db.execute(query.add_columns(LLMUsageEntry.function).group_by(LLMUsageEntry.function))).all()
+        return {
+            "session_id": session_id,
+            "first_call_at": total.first_call_at,
+            "last_call_at": total.last_call_at,
+            **_summary(total),
+            "rounds": [{"round_number": row.round_number, **_summary(row)} for row in rounds],
+            "functions": {row.function: _summary(row) for row in functions},
+        }
+
+    async def recent_sessions(self, limit: int) -> list[dict]:
+        """最近有 LLM 调用的会话及其总计，最新的在前"""
+        await self.flush()
+        async with UsageSessionLocal() as db:
+            rows = (await db.execute(
+                select(LLMUsageEntry.session_id, *_aggregates())
+                .where(LLMUsageEntry.session_id.is_not(None))
+                .group_by(LLMUsageEntry.session_id)
+                .order_by(func.max(LLMUsageEntry.created_at).desc())
+                .limit(limit)
+            )).all()
+        return [{"session_id": row.session_id, "last_call_at": row.last_call_at, **_summary(row)} for row in rows]
+
+    async def daily_usage(self, days: int) -> list[dict]:
+        """最近 days 天（按服务器本地日期）每天的总计，以及当天调用过 LLM 的会话数和平均每个会话的花费"""
+        await self.flush()
+        since = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp() - (days - 1) * 86400
+        day = func.date(LLMUsageEntry.created_at, "unixepoch", "localtime")
+        async with UsageSessionLocal() as db:
+            rows = (await db.execute(
+                select(day.label("date"), *_aggregates())
+                .where(LLMUsageEntry.created_at >= since)
+                .group_by(day)
+                .order_by(day)
+            )).all()
+        return [{
+            "date": row.date,
+            **_summary(row),
+            "sessions": row.sessions,
+            "cost_per_session": row.cost / row.sessions if row.sessions and row.cost is not None else None,
+        } for row in rows]
+
+    def stats(self) -> dict:
+        return {**self.counters, "enabled": self.enabled, "running": self.running, "buffered": len(self._buffer)}
+
+usage_ledger = UsageLedger(enabled=LLM_USAGE_ENABLED, flush_seconds=LLM_USAGE_FLUSH_SECONDS, batch_size=LLM_USAGE_BATCH_SIZE,
+                           buffer_size=LLM_USAGE_BUFFER_SIZE, retention_days=LLM_USAGE_RETENTION_DAYS)